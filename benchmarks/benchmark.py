@@ -0,0 +1,152 @@
+# SPDX-License-Identifier: MIT
+# Records wall time and peak memory for the public tabfix entry points on synthetic workbooks
+from multiprocessing import get_context
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tabfix  # noqa: E402
+from benchmarks import workbook_generator  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SCALES = {
+    'small': {'dashboards': 10, 'worksheets': 20, 'zones': 10, 'parameters': 4, 'filters': 4, 'highlighters': 2,
+              'bitmaps': 2, 'device_layouts': 1, 'fields': 10},
+    'medium': {'dashboards': 100, 'worksheets': 200, 'zones': 20, 'parameters': 8, 'filters': 8, 'highlighters': 4,
+               'bitmaps': 4, 'device_layouts': 2, 'fields': 40},
+    'large': {'dashboards': 400, 'worksheets': 800, 'zones': 40, 'parameters': 10, 'filters': 10,
+              'highlighters': 5, 'bitmaps': 5, 'device_layouts': 2, 'fields': 100},
+}
+
+
+def get_peak_memory():
+    # Peak resident set size in bytes. Linux keeps ru_maxrss across fork and exec, so prefer the
+    # high water mark of this process's own address space where it is available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def get_item_for_manifest(tree, configuration):
+    index = tabfix.WorkbookIndex(tree)
+    for dashboard_name in configuration:
+        for item in configuration[dashboard_name]:
+            tabfix.get_item(tree, dashboard_name, item, index)
+
+
+# Each benchmark is a function of (workbook path, manifest, output path) returning a function to time
+BENCHMARKS = {
+    'load_workbook': lambda path, configuration, output: lambda: tabfix.load_workbook(path),
+    'check_accessibility': lambda path, configuration, output: lambda: tabfix.check_accessibility(path),
+    'check_accessibility_streaming':
+        lambda path, configuration, output: lambda: tabfix.check_accessibility_streaming(path),
+    'fix_tabs': lambda path, configuration, output: lambda: tabfix.fix_tabs(path, output, configuration),
+    'fix_tabs_spliced':
+        lambda path, configuration, output: lambda: tabfix.fix_tabs(path, output, configuration, splice=True),
+}
+
+
+def add_tree_benchmark(name, function):
+    # Benchmarks of functions that take a parsed tree; parsing is not included in the time
+    def setup(path, configuration, output):
+        tree = tabfix.load_workbook(path)
+        return lambda: function(tree, configuration)
+    BENCHMARKS[name] = setup
+
+
+add_tree_benchmark('WorkbookIndex', lambda tree, configuration: tabfix.WorkbookIndex(tree))
+add_tree_benchmark('get_item', get_item_for_manifest)
+add_tree_benchmark('fix_tabs_in_tree', lambda tree, configuration: tabfix.fix_tabs_in_tree(tree, configuration))
+add_tree_benchmark('fix_tabs_parallel',
+                   lambda tree, configuration: tabfix.fix_tabs_in_tree(tree, configuration, workers=os.cpu_count()))
+add_tree_benchmark('check_accessibility_parallel', lambda tree, configuration: tabfix.check_accessibility_parallel(tree))
+add_tree_benchmark('check_accessibility_in_tree',
+                   lambda tree, configuration: tabfix.check_accessibility_in_tree(tree))
+for check in ['check_alt_text', 'check_titles_and_captions', 'check_vertical_text', 'check_mark_labels']:
+    add_tree_benchmark(check, lambda tree, configuration, check=check: getattr(tabfix, check)(tree))
+
+
+def run_benchmark(name, path, configuration, output, queue):
+    # Runs in its own process so that the peak memory belongs to this benchmark alone
+    function = BENCHMARKS[name](path, configuration, output)
+    baseline = get_peak_memory()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    peak = get_peak_memory()
+    queue.put({
+        'seconds': round(seconds, 4),
+        'peak_memory': peak,
+        'added_memory': None if peak is None else peak - baseline
+    })
+
+
+def measure(name, path, configuration, output):
+    context = get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_benchmark, args=(name, path, configuration, output, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def run(scales, benchmarks, style='2020', directory=None):
+    directory = directory or tempfile.mkdtemp(prefix='tabfix-benchmark-')
+    results = []
+    for scale in scales:
+        options = dict(SCALES[scale], style=style)
+        path = os.path.join(directory, scale + '.twb')
+        workbook_generator.write_workbook(path, **options)
+        configuration = workbook_generator.generate_manifest(**options)
+        for name in benchmarks:
+            result = measure(name, path, configuration, os.path.join(directory, scale + '-output.twb'))
+            result.update({'scale': scale, 'benchmark': name, 'workbook_size': os.path.getsize(path)})
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def format_memory(value):
+    return '-' if value is None else (value / (1024 * 1024)).__format__('.1f') + ' MB'
+
+
+def print_result(result):
+    print(result['scale'].ljust(8) + result['benchmark'].ljust(32) + (result['seconds'].__format__('.4f') + ' s').rjust(12) +
+          format_memory(result['peak_memory']).rjust(12) + format_memory(result['added_memory']).rjust(12))
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Benchmark tabfix on synthetic workbooks.')
+    argparser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['small', 'medium'],
+                           help='The workbook sizes to run')
+    argparser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                           help='The entry points to measure')
+    argparser.add_argument('--style', choices=workbook_generator.STYLES, default='2020',
+                           help='The zone attribute style of the generated workbooks')
+    argparser.add_argument('--output', metavar='<report>', type=str, default=None,
+                           help='Save the results as JSON')
+    args = argparser.parse_args()
+
+    print('scale'.ljust(8) + 'benchmark'.ljust(32) + 'time'.rjust(12) + 'peak'.rjust(12) + 'added'.rjust(12))
+    results = run(args.scales, args.benchmarks, args.style)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,238 @@
+# SPDX-License-Identifier: MIT
+# Generates synthetic Tableau workbooks of any size for benchmarking tabfix
+from lxml.etree import Element, ElementTree, SubElement
+import argparse
+import itertools
+
+DATASOURCE = 'federated.0000000000000000000000000000'
+
+STYLES = ['2019.4', '2020']
+
+# Counts that apply to each dashboard rather than to the whole workbook
+DASHBOARD_OPTIONS = ['zones', 'parameters', 'filters', 'highlighters', 'bitmaps', 'device_layouts', 'actions']
+
+
+def set_zone_type(zone, zone_type, style):
+    # Later versions of Tableau write the zone type twice, behind a feature flag
+    if style == '2019.4':
+        zone.set('type', zone_type)
+    else:
+        zone.set('_.fcp.SetMembershipControl.false...type', zone_type)
+        zone.set('_.fcp.SetMembershipControl.true...type-v2', zone_type)
+
+
+def add_zone(parent, ids, zone_type, style, attributes=None):
+    zone = SubElement(parent, 'zone')
+    if zone_type is not None:
+        set_zone_type(zone, zone_type, style)
+    zone.set('h', '10000')
+    zone.set('id', ids.__next__().__str__())
+    for name, value in (attributes or {}).items():
+        zone.set(name, value)
+    zone.set('w', '10000')
+    zone.set('x', '0')
+    zone.set('y', '0')
+    zone_style = SubElement(zone, 'zone-style')
+    SubElement(zone_style, 'format', {'attr': 'border-style', 'value': 'none'})
+    SubElement(zone_style, 'format', {'attr': 'margin', 'value': '4'})
+    return zone
+
+
+def get_dashboard_name(i):
+    return 'Dashboard ' + (i + 1).__str__()
+
+
+def get_worksheet_name(i):
+    return 'Sheet ' + (i + 1).__str__()
+
+
+def get_field_name(i):
+    return 'Field ' + (i + 1).__str__()
+
+
+def get_field_reference(i):
+    return '[' + DATASOURCE + '].[none:' + get_field_name(i) + ':nk]'
+
+
+def add_datasources(workbook, parameters, fields):
+    datasources = SubElement(workbook, 'datasources')
+    datasource = SubElement(datasources, 'datasource', {
+        'hasconnection': 'false', 'inline': 'true', 'name': 'Parameters', 'version': '18.1'})
+    for i in range(parameters):
+        column = SubElement(datasource, 'column', {
+            'caption': 'Parameter ' + (i + 1).__str__() + ' Alias', 'datatype': 'string',
+            'name': '[Parameter ' + (i + 1).__str__() + ']', 'param-domain-type': 'list', 'role': 'measure',
+            'type': 'nominal', 'value': '"A"'})
+        SubElement(column, 'calculation', {'class': 'tableau', 'formula': '"A"'})
+
+    datasource = SubElement(datasources, 'datasource', {
+        'caption': 'Synthetic data', 'inline': 'true', 'name': DATASOURCE, 'version': '18.1'})
+    for i in range(fields):
+        SubElement(datasource, 'column', {
+            'caption': get_field_name(i) + ' Caption', 'datatype': 'string', 'name': '[' + get_field_name(i) + ']',
+            'role': 'dimension', 'type': 'nominal'})
+
+
+def add_worksheets(workbook, worksheets, fields):
+    parent = SubElement(workbook, 'worksheets')
+    for i in range(worksheets):
+        field = i % max(fields, 1)
+        worksheet = SubElement(parent, 'worksheet', {'name': get_worksheet_name(i)})
+        table = SubElement(worksheet, 'table')
+        view = SubElement(table, 'view')
+        SubElement(SubElement(view, 'datasources'), 'datasource', {'name': DATASOURCE})
+        dependencies = SubElement(view, 'datasource-dependencies', {'datasource': DATASOURCE})
+        SubElement(dependencies, 'column', {
+            'datatype': 'string', 'name': '[' + get_field_name(field) + ']', 'role': 'dimension', 'type': 'nominal'})
+        rule = SubElement(SubElement(table, 'style'), 'style-rule', {'element': 'label'})
+        # Every third worksheet has rotated labels, and every other one has mark labels
+        if i % 3 == 0:
+            SubElement(rule, 'format', {'attr': 'text-orientation', 'field': get_field_reference(field), 'value': '-90'})
+        pane = SubElement(SubElement(table, 'panes'), 'pane')
+        rule = SubElement(SubElement(pane, 'style'), 'style-rule', {'element': 'mark'})
+        if i % 2 == 0:
+            SubElement(rule, 'format', {'attr': 'mark-labels-show', 'value': 'true'})
+        SubElement(table, 'rows').text = get_field_reference(field)
+
+
+def add_dashboard_zones(parent, dashboard_index, options, ids):
+    style = options['style']
+    worksheets = max(options['worksheets'], 1)
+    fields = max(options['fields'], 1)
+    number = (dashboard_index + 1).__str__()
+    root = add_zone(parent, ids, 'layout-basic', style)
+    container = add_zone(root, ids, 'layout-flow', style, {'param': 'vert'})
+
+    text = add_zone(container, ids, 'text', style)
+    SubElement(SubElement(text, 'formatted-text'), 'run').text = 'Introduction to dashboard ' + number
+
+    button = add_zone(container, ids, 'dashboard-object', style)
+    button = SubElement(button, 'button', {'action': 'tabdoc:goto-sheet', 'button-type': 'text'})
+    SubElement(SubElement(button, 'button-visual-state'), 'caption').text = 'Navigate from dashboard ' + number
+
+    for i in range(options['parameters']):
+        zone = add_zone(container, ids, 'paramctrl', style, {
+            'mode': 'compact', 'param': '[Parameters].[Parameter ' + (i + 1).__str__() + ']'})
+        if i % 2 == 1:
+            zone.set('custom-title', 'true')
+            SubElement(SubElement(zone, 'formatted-text'), 'run').text = 'Parameter ' + (i + 1).__str__() + ' Title'
+
+    for i in range(options['zones']):
+        attributes = {'name': get_worksheet_name((dashboard_index + i) % worksheets)}
+        if i % 2 == 0:
+            attributes['show-caption'] = 'true'
+        if i % 4 == 1:
+            attributes['show-title'] = 'false'
+        add_zone(container, ids, None, style, attributes)
+
+    for i in range(options['filters']):
+        add_zone(container, ids, 'filter', style, {
+            'name': get_worksheet_name((dashboard_index + i) % worksheets), 'param': get_field_reference(i % fields),
+            'values': 'database'})
+
+    for i in range(options['highlighters']):
+        add_zone(container, ids, 'highlighter', style, {
+            'name': get_worksheet_name((dashboard_index + i) % worksheets), 'param': get_field_reference(i % fields)})
+
+    for i in range(options['bitmaps']):
+        attributes = {'is-scaled': '1', 'param': 'Images/image' + (i + 1).__str__() + '.png'}
+        if i % 2 == 1:
+            attributes['alt-text'] = 'Image ' + (i + 1).__str__()
+        add_zone(container, ids, 'bitmap', style, attributes)
+
+
+def add_actions(workbook, dashboards, worksheets, zones, actions):
+    # Filter and highlight actions from the views on each dashboard to the whole dashboard
+    parent = SubElement(workbook, 'actions')
+    for i in range(dashboards):
+        for j in range(actions):
+            number = (i * actions + j + 1).__str__()
+            action = SubElement(parent, 'action', {'caption': 'Action ' + number, 'name': '[Action' + number + ']'})
+            SubElement(action, 'activation', {'auto-clear': 'true', 'type': 'on-select'})
+            SubElement(action, 'source', {'dashboard': get_dashboard_name(i), 'type': 'sheet',
+                                          'worksheet': get_worksheet_name((i + j % max(zones, 1)) % worksheets)})
+            command = SubElement(action, 'command', {'command': ['tsc:tsl-filter', 'tsc:brush'][j % 2]})
+            SubElement(command, 'param', {'name': 'target', 'value': get_dashboard_name(i)})
+
+
+def generate_workbook(dashboards=2, worksheets=4, zones=4, parameters=2, filters=2, highlighters=1, bitmaps=1,
+                      device_layouts=0, actions=0, fields=4, style='2020'):
+    options = {
+        'worksheets': worksheets, 'zones': zones, 'parameters': parameters, 'filters': filters,
+        'highlighters': highlighters, 'bitmaps': bitmaps, 'fields': fields, 'style': style
+    }
+    workbook = Element('workbook', {
+        'original-version': '18.1', 'source-build': '2020.4.0 (20204.20.1106.0321)', 'version': '18.1'})
+    if style != '2019.4':
+        manifest = SubElement(workbook, 'document-format-change-manifest')
+        SubElement(manifest, '_.fcp.SetMembershipControl.true...SetMembershipControl')
+    add_datasources(workbook, parameters, fields)
+    if actions > 0:
+        add_actions(workbook, dashboards, max(worksheets, 1), zones, actions)
+    add_worksheets(workbook, worksheets, fields)
+
+    parent = SubElement(workbook, 'dashboards')
+    # Zone ids are unique across the workbook, as they are in workbooks saved by Tableau
+    ids = itertools.count(1)
+    for i in range(dashboards):
+        dashboard = SubElement(parent, 'dashboard', {'name': get_dashboard_name(i)})
+        SubElement(dashboard, 'size', {'maxheight': '800', 'maxwidth': '1000', 'minheight': '800', 'minwidth': '1000'})
+        first_id = ids.__next__()
+        add_dashboard_zones(SubElement(dashboard, 'zones'), i, options, itertools.chain([first_id], ids))
+        if device_layouts > 0:
+            layouts = SubElement(dashboard, 'devicelayouts')
+            for j in range(device_layouts):
+                name = ['Phone', 'Tablet'][j % 2] + ('' if j < 2 else ' ' + (j // 2 + 1).__str__())
+                layout = SubElement(layouts, 'devicelayout', {'auto-generated': 'true', 'name': name})
+                SubElement(layout, 'size', {'maxheight': '700', 'minheight': '700', 'sizing-mode': 'vscroll'})
+                # Device layouts reuse the ids of the desktop zones they mirror
+                add_dashboard_zones(SubElement(layout, 'zones'), i, options, itertools.count(first_id))
+
+    windows = SubElement(workbook, 'windows')
+    for i in range(worksheets):
+        SubElement(windows, 'window', {'class': 'worksheet', 'name': get_worksheet_name(i)})
+    for i in range(dashboards):
+        SubElement(windows, 'window', {'class': 'dashboard', 'name': get_dashboard_name(i)})
+    return ElementTree(workbook)
+
+
+def generate_manifest(dashboards=2, worksheets=4, zones=4, parameters=2, filters=2, highlighters=1, bitmaps=1,
+                      fields=4, **options):
+    # A manifest naming an item of every kind the generator creates, in reverse document order
+    configuration = {}
+    for i in range(dashboards):
+        number = (i + 1).__str__()
+        items = ['Introduction to dashboard ' + number, 'Navigate from dashboard ' + number]
+        for j in range(parameters):
+            items.append('Parameter ' + (j + 1).__str__() + (' Title' if j % 2 == 1 else ''))
+        for j in range(min(zones, worksheets)):
+            items.append(get_worksheet_name((i + j) % worksheets))
+        for j in range(min(filters, fields)):
+            items.append(get_field_name(j))
+        for j in range(min(highlighters, fields)):
+            items.append('Highlight ' + get_field_name(j))
+        for j in range(bitmaps):
+            items.append('image' + (j + 1).__str__() + '.png')
+        configuration[get_dashboard_name(i)] = list(reversed(items))
+    return configuration
+
+
+def write_workbook(path, **options):
+    tree = generate_workbook(**options)
+    tree.write(path, encoding='utf-8', xml_declaration=True)
+    return tree
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Generate a synthetic Tableau workbook for benchmarking.')
+    argparser.add_argument('output_path', metavar='<output>', type=str, help='The workbook to create')
+    for option, default in [('dashboards', 2), ('worksheets', 4), ('zones', 4), ('parameters', 2), ('filters', 2),
+                            ('highlighters', 1), ('bitmaps', 1), ('device_layouts', 0), ('actions', 0),
+                            ('fields', 4)]:
+        argparser.add_argument('--' + option.replace('_', '-'), dest=option, type=int, default=default,
+                               help='The number of ' + option.replace('_', ' ') +
+                                    (' per dashboard' if option in DASHBOARD_OPTIONS else ''))
+    argparser.add_argument('--style', choices=STYLES, default='2020',
+                           help='Write zone types in the 2019.4 style or the later feature-flagged style')
+    args = vars(argparser.parse_args())
+    write_workbook(args.pop('output_path'), **args)
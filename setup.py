@@ -15,6 +15,9 @@ setup(
     long_description=open('README.md').read(),
     long_description_content_type='text/markdown',
     install_requires=['lxml==4.6.2', 'pyyaml==5.4.1'],
+    extras_require={
+        'colour': ['numpy'],
+    },
     entry_points={
         'console_scripts': ['tabfix=tabfix:main'],
     },
@@ -1,29 +1,111 @@
 # SPDX-License-Identifier: MIT
-from lxml.etree import XMLParser, parse
-import argparse
+from lxml.etree import Element, SubElement, XMLParser, XPath, fromstring, iterparse, iterwalk, parse, tostring
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP64_LIMIT, BadZipFile
+import copy
+import glob
+import hashlib
+import itertools
+import json
+import mmap
 import os
-import csv
-from yaml import load, loader
+import re
+import struct
+import sys
+import time
+
+# Modules that only some commands need are imported when first used, so that --help and
+# check-only runs start quickly. numpy is False until get_numpy() has tried to import it.
+numpy = False
 
 # We need to use the 'huge' parser as these docs are really big
 p = XMLParser(huge_tree=True)
 
 
-def get_item(tree, dashboard_name, item):
-    zone = get_view(tree, dashboard_name, item)
-    if zone is None:
-        zone = get_button(tree, dashboard_name, item)
-    if zone is None:
-        zone = get_parameter(tree, dashboard_name, item)
-    if zone is None:
-        zone = get_filter(tree, dashboard_name, item)
-    if zone is None:
-        zone = get_text(tree, dashboard_name, item)
-    if zone is None:
-        zone = get_image(tree, dashboard_name, item)
-    if zone is None:
-        zone = get_highlighter_by_filter(tree, dashboard_name, item)
-    return zone
+class Profile(object):
+    """
+    Timers and counters for finding out where a run spends its time. Nothing is recorded
+    unless enabled is set, e.g. by the --profile option.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.timers = {}
+        self.counters = {}
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+
+    @contextmanager
+    def timer(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        timer = self.timers.setdefault(name, [0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def wrap(self, obj, method_name, name):
+        # Replace a method on one object with a timed version, so untimed runs pay nothing
+        method = getattr(obj, method_name)
+
+        def timed(*args):
+            start = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                self.add_time(name, time.perf_counter() - start)
+        setattr(obj, method_name, timed)
+
+    def report(self):
+        return {
+            "timers": dict((name, {"calls": timer[0], "seconds": round(timer[1], 6)})
+                           for name, timer in sorted(self.timers.items())),
+            "counters": dict(sorted(self.counters.items()))
+        }
+
+    def format_report(self):
+        lines = ["Timer".ljust(40) + "Calls".rjust(10) + "Seconds".rjust(12)]
+        for name, timer in sorted(self.timers.items()):
+            lines.append(name.ljust(40) + timer[0].__str__().rjust(10) + timer[1].__format__('.6f').rjust(12))
+        lines.append("Counter".ljust(40) + "Count".rjust(10))
+        for name, value in sorted(self.counters.items()):
+            lines.append(name.ljust(40) + value.__str__().rjust(10))
+        return "\n".join(lines)
+
+
+profile = Profile()
+
+
+def get_item(tree, dashboard_name, item, index=None):
+    if index is None:
+        index = WorkbookQueries(tree)
+    # Resolvers are tried in order of precedence
+    for resolver in RESOLVERS:
+        if profile.enabled:
+            with profile.timer('resolver.' + resolver.__name__):
+                zone = resolver(tree, dashboard_name, item, index)
+        else:
+            zone = resolver(tree, dashboard_name, item, index)
+        if zone is not None:
+            profile.count('resolver.' + resolver.__name__ + '.matched')
+            return zone
+    profile.count('resolver.unmatched')
+    return None
 
 
 def get_parent_tag(item, tag):
@@ -49,258 +131,3322 @@ def get_parent_zone(item):
     return get_parent_tag(item, 'zone')
 
 
-def get_image(tree, dashboard_name, path):
-    match = "substring(@param, string-length(@param) - string-length('"+path+"') + 1) = '"+path+"'"
-    query = ".//dashboard[@name='" + dashboard_name + "']//zone[(@_.fcp.SetMembershipControl.false...type='bitmap' or @type='bitmap') and "+match+"]"
-    image = tree.xpath(query)
-    if image is not None and image.__len__() > 0:
-        zone = image[0]
-        return zone
-    return None
+PARAMETER_PREFIX = '[Parameters].'
+
+
+def text_nodes(element):
+    # The equivalent of XPath's text(): the element text plus the tails of its children
+    yield element.text
+    for child in element:
+        yield child.tail
+
+
+def colon_terms(param):
+    # Every X for which contains(param, ':X:') is true
+    positions = [i for i, c in enumerate(param) if c == ':']
+    for i in range(positions.__len__()):
+        for j in range(i + 1, positions.__len__()):
+            yield param[positions[i] + 1:positions[j]]
+
+
+class WorkbookIndex(object):
+    """
+    Lookup tables for the addressable zones in every dashboard, built in a single
+    walk of the tree. Each table keeps the first match in document order so lookups
+    give the same answers as the equivalent XPath queries.
+    """
+
+    def __init__(self, tree):
+        self.columns = {}
+        self.parameter_columns = {}
+        self.dashboards = {}
+        self.zones = {}
+        self.layout_zones = {}
+        self.views = {}
+        self.buttons = {}
+        self.parameters = {}
+        self.parameter_titles = {}
+        self.parameter_titles_v2 = {}
+        self.filters = {}
+        self.texts = {}
+        self.images = ImageTable()
+        self.highlighters = {}
+        self.highlighters_v2 = {}
+
+        root = tree.getroot() if hasattr(tree, 'getroot') else tree
+        with profile.timer('index'):
+            self.add_columns(root)
+            for dashboard in root.iter('dashboard'):
+                self.add_dashboard(dashboard)
+
+    def add_columns(self, root):
+        for column in root.iter('column'):
+            caption = column.get('caption')
+            name = column.get('name')
+            if caption is None or name is None:
+                continue
+            self.columns.setdefault(caption, name)
+            if name.startswith('[Parameter '):
+                self.parameter_columns.setdefault(caption, name)
+
+    def add_dashboard(self, dashboard):
+        dashboard_name = dashboard.get('name')
+        self.dashboards.setdefault(dashboard_name, []).append(dashboard)
+        zones = self.zones.setdefault(dashboard_name, [])
+        layout_zones = self.layout_zones.setdefault(dashboard_name, [])
+        zone_stack = []
+        button_stack = []
+        in_layouts = False
+        visited = 0
+        for event, element in iterwalk(dashboard, events=('start', 'end')):
+            tag = element.tag
+            if event == 'end':
+                if tag == 'zone':
+                    zone_stack.pop()
+                elif tag == 'button':
+                    button_stack.pop()
+                elif tag == 'devicelayouts':
+                    in_layouts = False
+                continue
+
+            visited += 1
+            if tag == 'zone':
+                zone_stack.append(element)
+                # Zones in phone and tablet layouts are numbered to match the desktop zones they mirror
+                if in_layouts:
+                    layout_zones.append(element)
+                else:
+                    zones.append(element)
+                self.add_zone(dashboard_name, element)
+            elif tag == 'devicelayouts':
+                in_layouts = True
+            elif tag == 'button':
+                # Only buttons inside a zone can be addressed by their caption
+                button_stack.append(zone_stack.__len__() > 0 or (button_stack.__len__() > 0 and button_stack[-1]))
+            elif tag == 'caption':
+                if button_stack.__len__() > 0 and button_stack[-1]:
+                    for text in text_nodes(element):
+                        if text is not None:
+                            self.buttons.setdefault((dashboard_name, text), zone_stack[-1])
+            elif tag == 'run':
+                zone = zone_stack[-1] if zone_stack.__len__() > 0 else None
+                texts = [text for text in text_nodes(element) if text is not None]
+                for text in texts:
+                    self.texts.setdefault((dashboard_name, text), zone)
+                parent = element.getparent()
+                if zone is not None and parent.tag == 'formatted-text' and parent.getparent() is zone:
+                    for text in texts:
+                        if zone.get('type') == 'paramctrl':
+                            self.parameter_titles.setdefault((dashboard_name, text), zone)
+                        if zone.get('_.fcp.SetMembershipControl.true...type-v2') == 'paramctrl':
+                            self.parameter_titles_v2.setdefault((dashboard_name, text), zone)
+        profile.count('elements.index', visited)
+
+    def add_zone(self, dashboard_name, zone):
+        name = zone.get('name')
+        param = zone.get('param')
+        if name is not None and param is None:
+            self.views.setdefault((dashboard_name, name), zone)
+        if param is None:
+            return
+        self.parameters.setdefault((dashboard_name, param), zone)
+        for term in colon_terms(param):
+            self.filters.setdefault((dashboard_name, term), zone)
+            if zone.get('type') == 'highlighter':
+                self.highlighters.setdefault((dashboard_name, term), zone)
+            if zone.get('_.fcp.SetMembershipControl.true...type-v2') == 'highlighter':
+                self.highlighters_v2.setdefault((dashboard_name, term), zone)
+        if zone.get('_.fcp.SetMembershipControl.false...type') == 'bitmap' or zone.get('type') == 'bitmap':
+            self.images.add(dashboard_name, param, zone)
+
+
+class ImageTable(object):
+    """
+    The image zones of each dashboard, by file name. Images are matched on any ending of their
+    path, usually the file name, and get gives the first match in document order as IMAGE_QUERY
+    does. A path with a folder in it can only match images with the same file name, so only
+    those are compared; otherwise the file names of the dashboard are searched.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.count = 0
+
+    def add(self, dashboard_name, path, zone):
+        name = path.rsplit('/', 1)[-1]
+        self.names.setdefault(dashboard_name, {}).setdefault(name, []).append((self.count, path, zone))
+        self.count += 1
+
+    def get(self, key):
+        dashboard_name, path = key
+        names = self.names.get(dashboard_name, {})
+        if '/' in path:
+            images = names.get(path.rsplit('/', 1)[-1], [])
+        else:
+            images = [image for name, name_images in names.items() if name.endswith(path) for image in name_images]
+        matches = [image for image in images if image[1].endswith(path)]
+        if not matches:
+            return None
+        return min(matches, key=lambda image: image[0])[2]
+
+
+# Queries are compiled once and take the names they look for as variables, so any name is safe to use
+ZONE_IN_DASHBOARD = "//dashboard[@name=$dashboard]//zone"
+VIEW_QUERY = XPath(ZONE_IN_DASHBOARD + "[@name=$name and not(@param)]")
+BUTTON_QUERY = XPath(ZONE_IN_DASHBOARD + "//button//caption[text()=$name]")
+PARAMETER_QUERY = XPath(ZONE_IN_DASHBOARD + "[@param=$name]")
+PARAMETER_TITLE_QUERY = XPath(ZONE_IN_DASHBOARD + "[@type='paramctrl']/formatted-text/run[text()=$name]")
+PARAMETER_TITLE_V2_QUERY = XPath(ZONE_IN_DASHBOARD +
+                                 "[@_.fcp.SetMembershipControl.true...type-v2='paramctrl']/formatted-text/run[text()=$name]")
+FILTER_QUERY = XPath(ZONE_IN_DASHBOARD + "[contains(@param, concat(':', $name, ':'))]")
+TEXT_QUERY = XPath("//dashboard[@name=$dashboard]//run[text()=$name]")
+IMAGE_QUERY = XPath(ZONE_IN_DASHBOARD + "[(@_.fcp.SetMembershipControl.false...type='bitmap' or @type='bitmap') and "
+                    "substring(@param, string-length(@param) - string-length($name) + 1) = $name]")
+HIGHLIGHTER_QUERY = XPath(ZONE_IN_DASHBOARD + "[@type='highlighter' and contains(@param, concat(':', $name, ':'))]")
+HIGHLIGHTER_V2_QUERY = XPath(ZONE_IN_DASHBOARD + "[@_.fcp.SetMembershipControl.true...type-v2='highlighter' and "
+                             "contains(@param, concat(':', $name, ':'))]")
+COLUMN_QUERY = XPath("//column[@caption=$name]")
+PARAMETER_COLUMN_QUERY = XPath("//column[@caption=$name and starts-with(@name, '[Parameter ')]")
+
+
+class QueryTable(object):
+    """
+    Looks up a single key of a WorkbookIndex table by running a compiled query. Keys are
+    either a name or a (dashboard name, name) pair; convert turns the first element found
+    into the value the index would hold.
+    """
+
+    def __init__(self, tree, query, convert=None):
+        self.tree = tree
+        self.query = query
+        self.convert = convert
+
+    def get(self, key):
+        if isinstance(key, tuple):
+            results = self.query(self.tree, dashboard=key[0], name=key[1])
+        else:
+            results = self.query(self.tree, name=key)
+        profile.count('xpath')
+        if results.__len__() == 0:
+            return None
+        if self.convert is not None:
+            return self.convert(results[0])
+        return results[0]
 
 
-def get_text(tree, dashboard_name, text):
-    view = tree.xpath("//dashboard[@name='" + dashboard_name + "']//run[text()='" + text + "']")
-    if view is not None and view.__len__() > 0:
-        zone = get_parent_zone(view[0])
-        return zone
-    return None
+class WorkbookQueries(object):
+    """
+    The lookup tables of WorkbookIndex, answered with a query per lookup rather than by
+    indexing the whole workbook up front. This is quicker for a few lookups; use a
+    WorkbookIndex for many.
+    """
 
+    def __init__(self, tree):
+        self.views = QueryTable(tree, VIEW_QUERY)
+        self.buttons = QueryTable(tree, BUTTON_QUERY, get_parent_zone)
+        self.parameters = QueryTable(tree, PARAMETER_QUERY)
+        self.parameter_titles = QueryTable(tree, PARAMETER_TITLE_QUERY, get_parent_zone)
+        self.parameter_titles_v2 = QueryTable(tree, PARAMETER_TITLE_V2_QUERY, get_parent_zone)
+        self.filters = QueryTable(tree, FILTER_QUERY)
+        self.texts = QueryTable(tree, TEXT_QUERY, get_parent_zone)
+        self.images = QueryTable(tree, IMAGE_QUERY)
+        self.highlighters = QueryTable(tree, HIGHLIGHTER_QUERY)
+        self.highlighters_v2 = QueryTable(tree, HIGHLIGHTER_V2_QUERY)
+        self.columns = QueryTable(tree, COLUMN_QUERY, get_column_name)
+        self.parameter_columns = QueryTable(tree, PARAMETER_COLUMN_QUERY, get_column_name)
 
-def get_view(tree, dashboard_name, viewname):
-    view = tree.xpath("//dashboard[@name='" + dashboard_name + "']//zone[@name='" + viewname + "' and not(@param)]")
-    if view is not None and view.__len__() > 0:
-        zone = view[0]
-        return zone
-    return None
 
+def get_column_name(column):
+    return column.get("name")
+
+
+def get_image(tree, dashboard_name, path, index=None):
+    if index is None:
+        index = WorkbookQueries(tree)
+    return index.images.get((dashboard_name, path))
+
+
+def get_text(tree, dashboard_name, text, index=None):
+    if index is None:
+        index = WorkbookQueries(tree)
+    return index.texts.get((dashboard_name, text))
 
-def get_button(tree, dashboard_name, caption):
-    button = tree.xpath("//dashboard[@name='" + dashboard_name + "']//zone//button//caption[text()='" + caption + "']")
-    if button is not None and button.__len__() > 0:
-        zone = get_parent_zone(button[0])
-        return zone
-    return None
 
+def get_view(tree, dashboard_name, viewname, index=None):
+    if index is None:
+        index = WorkbookQueries(tree)
+    return index.views.get((dashboard_name, viewname))
 
-def get_highlighter_by_filter(tree, dashboard_name, filter):
+
+def get_button(tree, dashboard_name, caption, index=None):
+    if index is None:
+        index = WorkbookQueries(tree)
+    return index.buttons.get((dashboard_name, caption))
+
+
+def get_highlighter_by_filter(tree, dashboard_name, filter, index=None):
     if filter.startswith("Highlight "):
+        if index is None:
+            index = WorkbookQueries(tree)
         filter = filter.split("Highlight ")[1]
-        highlighters = tree.xpath(".//dashboard[@name='"+dashboard_name+"']//zone[@type='highlighter' and contains(@param, ':" + filter + ":')]")
-        if highlighters is not None and highlighters.__len__() > 0:
-            return highlighters[0]
-        highlighters = tree.xpath(".//dashboard[@name='"+dashboard_name+"']//zone[@_.fcp.SetMembershipControl.true...type-v2='highlighter' and contains(@param, ':" + filter + ":')]")
-        if highlighters is not None and highlighters.__len__() > 0:
-            return highlighters[0]
+        zone = index.highlighters.get((dashboard_name, filter))
+        if zone is None:
+            zone = index.highlighters_v2.get((dashboard_name, filter))
+        return zone
     return None
 
 
-def get_parameter_by_alias(tree, alias):
+def get_parameter_by_alias(tree, alias, index=None):
     # column caption='The First Parameter' datatype='string' name='[Parameter 1]'
-    reference = tree.xpath("//column[@caption='" + alias + "' and starts-with(@name, '[Parameter ')]")
-    if reference is not None and reference.__len__() > 0:
-        return reference[0].get("name")
-    return None
+    if index is None:
+        index = WorkbookQueries(tree)
+    return index.parameter_columns.get(alias)
 
 
-def get_parameter(tree, dashboard_name, parameter):
-    param = '[Parameters].['+parameter+']'
-    parameters = tree.xpath(".//dashboard[@name='"+dashboard_name+"']//zone[@param='" + param + "']")
-    if parameters is not None and parameters.__len__() > 0:
-        zone = parameters[0]
+def get_parameter(tree, dashboard_name, parameter, index=None):
+    if index is None:
+        index = WorkbookQueries(tree)
+    zone = index.parameters.get((dashboard_name, PARAMETER_PREFIX + '[' + parameter + ']'))
+    if zone is not None:
         return zone
 
     # Parameter with a custom title
-    parameters = tree.xpath(".//dashboard[@name='"+dashboard_name+"']//zone[@type='paramctrl']/formatted-text/run[text()='"+parameter+"']")
-    if parameters is not None and parameters.__len__() > 0:
-        zone = get_parent_zone(parameters[0])
+    zone = index.parameter_titles.get((dashboard_name, parameter))
+    if zone is not None:
         return zone
 
     # Parameter with a custom title for later versions
-    parameters = tree.xpath(".//dashboard[@name='"+dashboard_name+"']//zone[@_.fcp.SetMembershipControl.true...type-v2='paramctrl'='paramctrl']/formatted-text/run[text()='"+parameter+"']")
-    if parameters is not None and parameters.__len__() > 0:
-        zone = get_parent_zone(parameters[0])
+    zone = index.parameter_titles_v2.get((dashboard_name, parameter))
+    if zone is not None:
         return zone
 
     # Parameters with aliases
-    reference = get_parameter_by_alias(tree, parameter)
+    reference = get_parameter_by_alias(tree, parameter, index)
     if reference is not None:
-        param = '[Parameters].' + reference
-        parameters = tree.xpath(".//dashboard[@name='" + dashboard_name + "']//zone[@param='" + param + "']")
-        if parameters is not None and parameters.__len__() > 0:
-            zone = parameters[0]
-            return zone
+        return index.parameters.get((dashboard_name, PARAMETER_PREFIX + reference))
 
     return None
 
 
-def get_filter_by_alias(tree, alias):
-    reference = tree.xpath("//column[@caption='" + alias + "']")
-    if reference is not None and reference.__len__() > 0:
-        name = reference[0].get("name")
-        if name.startswith('[') and name.endswith(']'):
-            name = name[1:-1]
-        return name
-    return None
+def get_filter_by_alias(tree, alias, index=None):
+    if index is None:
+        index = WorkbookQueries(tree)
+    name = index.columns.get(alias)
+    if name is not None and name.startswith('[') and name.endswith(']'):
+        name = name[1:-1]
+    return name
 
 
-def get_filter(tree, dashboard_name, filter):
-    filter_search = ':'+filter+':'
-    parameter = tree.xpath(".//dashboard[@name='"+dashboard_name+"']//zone[contains(@param, '" + filter_search + "')]")
-    if parameter is not None and parameter.__len__() > 0:
-        zone = parameter[0]
+def get_filter(tree, dashboard_name, filter, index=None):
+    if index is None:
+        index = WorkbookQueries(tree)
+    zone = index.filters.get((dashboard_name, filter))
+    if zone is not None:
         return zone
 
-    reference = get_filter_by_alias(tree, filter)
+    reference = get_filter_by_alias(tree, filter, index)
     if reference is not None:
-        filter_search = ':'+reference+':'
-        filters = tree.xpath(".//dashboard[@name='"+dashboard_name+"']//zone[contains(@param, '" + filter_search + "')]")
-        if filters is not None and filters.__len__() > 0:
-            zone = filters[0]
-            return zone
+        return index.filters.get((dashboard_name, reference))
 
     return None
 
 
-def check_accessibility(input_filename):
-    with open(input_filename, 'r', encoding='utf-8') as f:  # open in readonly mode
-        tree = parse(f, parser=p)
-        warnings = []
-        warnings = warnings + check_alt_text(tree)
-        warnings = warnings + check_titles_and_captions(tree)
-        warnings = warnings + check_vertical_text(tree)
-        warnings = warnings + check_mark_labels(tree)
+RESOLVERS = [get_view, get_button, get_parameter, get_filter, get_text, get_image, get_highlighter_by_filter]
+
+
+def is_packaged_workbook(filename):
+    return filename.lower().endswith('.twbx')
+
+
+def get_packaged_workbook_info(archive):
+    # A packaged workbook holds a single .twb at the top level alongside its extracts and images
+    workbooks = [info for info in archive.infolist() if info.filename.lower().endswith('.twb')]
+    if workbooks.__len__() == 0:
+        raise BadZipFile("No workbook found in packaged workbook")
+    for info in workbooks:
+        if '/' not in info.filename:
+            return info
+    return workbooks[0]
+
+
+@contextmanager
+def open_workbook(input_filename):
+    # Hand lxml the raw bytes so it doesn't have to re-encode a decoded copy of the document
+    if is_packaged_workbook(input_filename):
+        with ZipFile(input_filename) as archive:
+            with archive.open(get_packaged_workbook_info(archive)) as f:
+                yield f
+    else:
+        with open(input_filename, 'rb') as f:
+            yield f
+
+
+def load_workbook(input_filename):
+    with profile.timer('parse'), open_workbook(input_filename) as f:
+        return parse(f, parser=p)
+
+
+def save_workbook(tree, output_filename, input_filename=None, splice=None):
+    with profile.timer('serialize'):
+        write_workbook(tree, output_filename, input_filename, splice)
+
+
+def write_workbook(tree, output_filename, input_filename=None, splice=None):
+    if splice is not None and input_filename is not None:
+        with open_workbook_data(input_filename) as data:
+            edits = splice.get_edits(data)
+            if edits is not None:
+                write_workbook_xml(lambda f: write_spliced(data, edits, f), output_filename, input_filename)
+                return
+        profile.count('splice.fallback')
+    write_workbook_xml(lambda f: tree.write(f, encoding='utf-8'), output_filename, input_filename)
+
+
+def write_workbook_xml(write, output_filename, input_filename=None):
+    # write is called with a binary file to write the workbook XML to
+    if not is_packaged_workbook(output_filename):
+        with open(output_filename, 'wb') as f:
+            write(f)
+    elif input_filename is not None and is_packaged_workbook(input_filename):
+        save_packaged_workbook(write, input_filename, output_filename)
+    else:
+        with ZipFile(output_filename, 'w', ZIP_DEFLATED) as target:
+            name = os.path.splitext(os.path.basename(output_filename))[0] + '.twb'
+            with target.open(name, 'w') as f:
+                write(f)
+
+
+def save_packaged_workbook(write, input_filename, output_filename):
+    # Only the workbook itself is recompressed; extracts and images are copied as they are
+    with ZipFile(input_filename) as source, ZipFile(output_filename, 'w') as target:
+        workbook_info = get_packaged_workbook_info(source)
+        for info in source.infolist():
+            if info is workbook_info:
+                rewritten = ZipInfo(info.filename, info.date_time)
+                rewritten.compress_type = ZIP_DEFLATED
+                rewritten.external_attr = info.external_attr
+                with target.open(rewritten, 'w') as f:
+                    write(f)
+            else:
+                copy_packaged_member(source, target, info)
+
+
+@contextmanager
+def open_workbook_data(input_filename):
+    # The workbook XML as a buffer; a plain workbook is mapped rather than read into memory
+    if is_packaged_workbook(input_filename):
+        with open_workbook(input_filename) as f:
+            yield f.read()
+    else:
+        with open(input_filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+SPLICE_MARKUP = re.compile(rb'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<(/?)(zone|devicelayouts)(?=[\s/>])', re.S)
+SPLICE_START_TAG_END = re.compile(rb'(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+SPLICE_ENCODING = re.compile(rb'^(?:\xef\xbb\xbf)?<\?xml[^>]*encoding\s*=\s*["\']([^"\']*)["\']')
+
+
+def get_attribute_pattern(name):
+    return re.compile(rb'(\s+)' + re.escape(name.encode('utf-8')) + rb'(\s*=\s*)(["\'])([^"\']*)\3')
+
+
+class WorkbookSplice(object):
+    """
+    Remembers the id and is-modified attributes of every zone, and the device layouts, of a
+    workbook before it is fixed. A fixed workbook can then be written by copying the original
+    bytes and only replacing the start tags of zones that changed and cutting out the device
+    layouts that were removed, rather than serializing the whole tree again.
+    """
+    attributes = ('id', 'is-modified')
+
+    def __init__(self, tree):
+        self.zones = list(tree.iter('zone'))
+        self.original = [tuple(zone.get(name) for name in self.attributes) for zone in self.zones]
+        self.layouts = list(tree.iter('devicelayouts'))
+
+    def get_edits(self, data):
+        # Returns (start, end, replacement) byte ranges in document order, or None when the
+        # bytes don't match the tree and the workbook has to be serialized instead
+        match = SPLICE_ENCODING.match(data[:200])
+        if match is not None and match.group(1).lower() not in [b'utf-8', b'utf8', b'us-ascii', b'ascii']:
+            return None
+        zone_tags = []
+        layout_ranges = []
+        layout_start = None
+        for match in SPLICE_MARKUP.finditer(data):
+            if match.group(2) is None:
+                continue
+            if match.group(1):
+                if match.group(2) == b'devicelayouts' and layout_start is not None:
+                    layout_ranges.append((layout_start, match.end()))
+                    layout_start = None
+                continue
+            end = SPLICE_START_TAG_END.match(data, match.end())
+            if end is None:
+                return None
+            if match.group(2) == b'zone':
+                zone_tags.append((match.start(), end.end()))
+            elif end.group(1):
+                layout_ranges.append((match.start(), end.end()))
+            elif layout_start is None:
+                layout_start = match.start()
+            else:
+                return None
+        if zone_tags.__len__() != self.zones.__len__() or layout_ranges.__len__() != self.layouts.__len__():
+            return None
+
+        removed = []
+        for layout, (start, end) in zip(self.layouts, layout_ranges):
+            if layout.getparent() is None:
+                # Like lxml, remove the whitespace that follows the device layouts too
+                tail = data.find(b'<', end)
+                removed.append((start, end if tail < 0 else tail, b''))
+
+        edits = list(removed)
+        for zone, original, (start, end) in zip(self.zones, self.original, zone_tags):
+            current = tuple(zone.get(name) for name in self.attributes)
+            if current == original or any(start >= r[0] and end <= r[1] for r in removed):
+                continue
+            tag = self.splice_start_tag(bytes(data[start:end]), original, current)
+            if tag is None:
+                return None
+            edits.append((start, end, tag))
+        edits.sort()
+        profile.count('splice.edits', edits.__len__())
+        return edits
+
+    def splice_start_tag(self, tag, original, current):
+        quote = b"'"
+        for name, old, new in zip(self.attributes, original, current):
+            match = get_attribute_pattern(name).search(tag)
+            if (match is None) != (old is None) or (match is not None and match.group(4).decode('utf-8') != old):
+                return None
+            if match is not None:
+                quote = match.group(3)
+            if new == old:
+                continue
+            value = escape_attribute(new, quote)
+            if match is None:
+                end = -2 if tag.endswith(b'/>') else -1
+                tag = tag[:end].rstrip() + b' ' + name.encode('utf-8') + b'=' + quote + value + quote + tag[end:]
+            elif new is None:
+                tag = tag[:match.start()] + tag[match.end():]
+            else:
+                tag = tag[:match.start(4)] + value + tag[match.end(4):]
+        return tag
+
+
+def escape_attribute(value, quote):
+    value = value.replace('&', '&amp;').replace('<', '&lt;')
+    if quote == b'"':
+        value = value.replace('"', '&quot;')
+    else:
+        value = value.replace("'", '&apos;')
+    return value.encode('utf-8')
+
+
+def write_spliced(data, edits, f):
+    view = memoryview(data)
+    position = 0
+    try:
+        for start, end, replacement in edits:
+            f.write(view[position:start])
+            f.write(replacement)
+            position = end
+        f.write(view[position:])
+    finally:
+        view.release()
+
+
+def strip_zip64_extra(extra):
+    # FileHeader adds its own zip64 field when one is needed
+    stripped = b''
+    i = 0
+    while i + 4 <= extra.__len__():
+        header_id, size = struct.unpack('<HH', extra[i:i + 4])
+        if header_id != 1:
+            stripped += extra[i:i + 4 + size]
+        i += 4 + size
+    return stripped
+
+
+# Copying a member without recompressing it writes straight into the archive through parts of
+# ZipFile that are not in its documented API, so they are checked for first
+RAW_COPY_ATTRIBUTES = ['fp', 'start_dir', 'filelist', 'NameToInfo', '_didModify']
+
+
+def can_copy_raw(source, target):
+    return hasattr(source, 'fp') and hasattr(ZipInfo, 'FileHeader') and \
+        all(hasattr(target, name) for name in RAW_COPY_ATTRIBUTES)
+
+
+def copy_packaged_member(source, target, info):
+    if not can_copy_raw(source, target):
+        copy_packaged_member_recompressed(source, target, info)
+        return
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(30)
+    if header[0:4] != b'PK\x03\x04':
+        raise BadZipFile("Bad local file header for " + info.filename)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    source.fp.seek(info.header_offset + 30 + name_length + extra_length)
+
+    copied = copy.copy(info)
+    copied.flag_bits &= ~0x08  # sizes and CRC go in the local header rather than a data descriptor
+    copied.extra = strip_zip64_extra(info.extra)
+    copied.header_offset = target.fp.tell()
+    target.fp.write(copied.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.fp.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise BadZipFile("Truncated data for " + info.filename)
+        target.fp.write(chunk)
+        remaining -= chunk.__len__()
+
+    target.start_dir = target.fp.tell()
+    target.filelist.append(copied)
+    target.NameToInfo[copied.filename] = copied
+    target._didModify = True
+
+
+def copy_packaged_member_recompressed(source, target, info):
+    # The same copy through the public API, which decompresses the member and compresses it again
+    copied = copy.copy(info)
+    copied.extra = strip_zip64_extra(info.extra)
+    with source.open(info) as f, target.open(copied, 'w', force_zip64=info.file_size > ZIP64_LIMIT) as output:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            output.write(chunk)
+
+
+def check_accessibility(input_filename, streaming=False, codes=None, max_warnings=None):
+    if streaming:
+        return check_accessibility_streaming(input_filename, codes, max_warnings)
+    return check_accessibility_in_tree(load_workbook(input_filename), codes, max_warnings)
+
+
+def check_accessibility_in_tree(tree, codes=None, max_warnings=None):
+    with profile.timer('check'):
+        return check_rules(walk_workbook(tree, get_rule_tags()), codes, max_warnings)
+
+
+def check_tree(tree, codes=None, max_warnings=None, cache=None, workers=None):
+    if workers is not None and workers > 1:
+        return check_accessibility_parallel(tree, codes, max_warnings, workers, cache)
+    if cache is None:
+        return check_accessibility_in_tree(tree, codes, max_warnings)
+    with profile.timer('check_cached'):
+        return check_accessibility_cached(tree, cache, codes, max_warnings)
+
+
+def check_accessibility_streaming(input_filename, codes=None, max_warnings=None):
+    # Produces the same warnings as check_accessibility_in_tree without keeping the whole tree in memory
+    with profile.timer('check_streaming'), open_workbook(input_filename) as f:
+        return check_rules(iterparse_workbook(f), codes, max_warnings)
+
+
+def iter_accessibility(input_filename, streaming=False, codes=None, max_warnings=None):
+    # Like check_accessibility, but yields each warning as soon as it is found, in document order
+    if streaming:
+        return iter_accessibility_streaming(input_filename, codes, max_warnings)
+    return iter_accessibility_in_tree(load_workbook(input_filename), codes, max_warnings)
+
+
+def iter_accessibility_in_tree(tree, codes=None, max_warnings=None):
+    return iter_rules(walk_workbook(tree, get_rule_tags()), codes, max_warnings)
+
+
+def iter_accessibility_streaming(input_filename, codes=None, max_warnings=None):
+    with open_workbook(input_filename) as f:
+        for warning in iter_rules(iterparse_workbook(f), codes, max_warnings):
+            yield warning
+
+
+def walk_workbook(tree, tags):
+    root = tree.getroot() if hasattr(tree, 'getroot') else tree
+    return iterwalk(root, events=('start', 'end'), tag=list(tags))
+
+
+def iterparse_workbook(f):
+    for event, element in iterparse(f, events=('start', 'end'), huge_tree=True):
+        yield event, element
+        if event == 'end':
+            # Rules read attributes on the start event, so finished elements can be dropped
+            element.clear(keep_tail=True)
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+
+
+RULES = []
+
+
+def register_rule(rule):
+    RULES.append(rule)
+    return rule
+
+
+def get_rule_codes():
+    return [code for rule in RULES for code in rule.codes]
+
+
+def get_rule_tags():
+    return set(tag for rule in RULES for tag in rule.tags) | {'dashboard', 'worksheet', 'zone'}
+
+
+class RuleContext(object):
+    """
+    What check_rules knows about the current position in the workbook. sheet_zones maps
+    each view name to the dashboards that show it, in document order, as far as the walk
+    has got.
+    """
+
+    def __init__(self):
+        self.dashboard = None
+        self.worksheet = None
+        self.sheet_zones = {}
+
+
+class Rule(object):
+    """
+    An accessibility check. check_rules calls start and end for each element whose tag is
+    in tags and finish once the whole workbook has been seen; each returns a list of
+    warnings, or None. Rules with by_worksheet set list the warnings about views that they
+    return from finish worksheet by worksheet, and check_dashboards puts them back in that
+    order.
+    """
+    codes = ()
+    tags = ()
+    by_worksheet = False
+
+    def start(self, element, context):
+        return None
+
+    def end(self, element, context):
+        return None
+
+    def finish(self, context):
+        return None
+
+
+def walk_rules(events, codes=None, max_warnings=None):
+    # A single walk of the workbook that hands each element to every rule interested in it,
+    # yielding the position of the rule in RULES with each warning as it is found
+    rules = [rule() for rule in RULES if codes is None or any(code in codes for code in rule.codes)]
+    handlers = {}
+    for position, rule in enumerate(rules):
+        for tag in rule.tags:
+            handlers.setdefault(tag, []).append((position, rule))
+        if profile.enabled:
+            for method_name in ['start', 'end', 'finish']:
+                profile.wrap(rule, method_name, 'rule.' + '/'.join(rule.codes))
+    context = RuleContext()
+    count = 0
+    visited = 0
+
+    def selected(warnings):
+        if not warnings:
+            return []
+        warnings = [as_warning_record(warning) for warning in warnings]
+        if codes is not None:
+            return [warning for warning in warnings if warning.code in codes]
         return warnings
 
+    try:
+        for event, element in events:
+            tag = element.tag
+            if event == 'start':
+                visited += 1
+                if tag == 'dashboard':
+                    context.dashboard = element.get('name')
+                elif tag == 'worksheet':
+                    context.worksheet = element.get('name')
+                elif tag == 'zone' and is_view_zone(element) and element.get('name') is not None:
+                    context.sheet_zones.setdefault(element.get('name'), []).append(context.dashboard)
+                for position, rule in handlers.get(tag, []):
+                    for warning in selected(rule.start(element, context)):
+                        count += 1
+                        yield position, warning
+            else:
+                for position, rule in handlers.get(tag, []):
+                    for warning in selected(rule.end(element, context)):
+                        count += 1
+                        yield position, warning
+                if tag == 'dashboard':
+                    context.dashboard = None
+                elif tag == 'worksheet':
+                    context.worksheet = None
+            if max_warnings is not None and count >= max_warnings:
+                return
+        for position, rule in enumerate(rules):
+            for warning in selected(rule.finish(context)):
+                yield position, warning
+    finally:
+        profile.count('elements.rules', visited)
+
+
+def iter_rules(events, codes=None, max_warnings=None):
+    for count, (position, warning) in enumerate(walk_rules(events, codes, max_warnings)):
+        if max_warnings is not None and count >= max_warnings:
+            break
+        yield warning
+
+
+def check_rules(events, codes=None, max_warnings=None):
+    # Warnings are listed rule by rule, in the order the rules were registered. The whole walk
+    # is needed to sort them, so max_warnings keeps the first of the sorted list, as
+    # check_dashboards does; only iter_rules can stop the walk early.
+    found = sorted(walk_rules(events, codes), key=lambda pair: pair[0])
+    warnings = [warning for position, warning in found]
+    if max_warnings is not None:
+        warnings = warnings[:max_warnings]
+    return warnings
 
-def check_mark_labels(tree):
-    formats = tree.xpath("//worksheet[not(.//format[@attr='mark-labels-show'])]")
+
+def is_view_zone(zone):
+    return zone.get('_.fcp.SetMembershipControl.false...type') is None and zone.get("type") is None
+
+
+def is_image_zone(zone):
+    return zone.get('_.fcp.SetMembershipControl.false...type') == 'bitmap' or zone.get('type') == 'bitmap'
+
+
+def is_text_zone(zone):
+    return zone.get('_.fcp.SetMembershipControl.false...type') == 'text' or zone.get('type') == 'text'
+
+
+def is_vertical_text_format(format):
+    return format.get('attr') == 'text-orientation' and format.get('value') in ['-90', '90']
+
+
+class WarningRecord(Mapping):
+    """
+    A warning found by a rule. Dashboard and item names are interned so that the many
+    warnings about the same objects share their strings, and the message is only put
+    together when it is asked for. Records can be used wherever a warning dict was, and
+    as_dict gives a plain dict for JSON.
+    """
+    __slots__ = ('code', 'dashboard', 'item', 'details', 'text')
+    fields = ('code', 'dashboard', 'item', 'message')
+
+    def __init__(self, code, dashboard, item, details=(), text=None):
+        self.code = code
+        self.dashboard = intern_name(dashboard)
+        self.item = intern_name(item)
+        self.details = details
+        self.text = text
+
+    @classmethod
+    def from_dict(cls, warning):
+        return cls(warning["code"], warning["dashboard"], warning["item"], tuple(warning.get("details", ())),
+                   text=warning["message"])
+
+    @property
+    def message(self):
+        if self.text is not None:
+            return self.text
+        return WARNING_MESSAGES[self.code](self)
+
+    @property
+    def worksheet(self):
+        # The view a warning is about, if it is about one
+        if self.code in SHEET_CODES or (self.code == 'A2' and self.details[0] == 'text in view'):
+            return self.item
+        return None
+
+    def as_dict(self):
+        return {"code": self.code, "dashboard": self.dashboard, "item": self.item, "message": self.message}
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return self.fields.__len__()
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def __reduce__(self):
+        return WarningRecord, (self.code, self.dashboard, self.item, self.details, self.text)
+
+
+def intern_name(name):
+    return sys.intern(name) if isinstance(name, str) else name
+
+
+def as_warning_record(warning):
+    # Rules may still return warnings as dicts
+    return warning if isinstance(warning, WarningRecord) else WarningRecord.from_dict(warning)
+
+
+def as_dicts(warnings):
+    return [warning.as_dict() if isinstance(warning, WarningRecord) else warning for warning in warnings]
+
+
+def mark_labels_warning(dashboard_name, sheet):
+    return WarningRecord("B3", dashboard_name, sheet)
+
+
+def vertical_text_warning(dashboard_name, sheet):
+    return WarningRecord("B1", dashboard_name, sheet)
+
+
+def alt_text_warning(dashboard_name, path):
+    return WarningRecord("A4", dashboard_name, path)
+
+
+def title_and_caption_warnings(zone, dashboard_name, item):
     warnings = []
-    for format in formats:
-        sheet = get_parent_tag(format, 'worksheet').get("name")
-        zones = tree.xpath("//zone[@name='"+sheet+"']")
-        for zone in zones:
-            if zone.get('_.fcp.SetMembershipControl.false...type') is None and zone.get("type") is None:
-                dashboard_name = get_parent_dashboard_name(zone)
-                warnings.append(
-                    {
-                        "code": "B3",
-                        "dashboard": dashboard_name,
-                        "item": sheet,
-                        "message": "B3 no mark labels for view '"+sheet+"' in dashboard '"+dashboard_name+"'"
-                    })
+    if zone.get('show-title') and zone.get('show-title') == 'false':
+        warnings.append(WarningRecord("A5", dashboard_name, item))
+    if not zone.get('show-caption') or zone.get('show-caption') == 'false':
+        warnings.append(WarningRecord("A6", dashboard_name, item))
     return warnings
 
 
+def mark_labels_message(warning):
+    return "B3 no mark labels for view '" + warning.item + "' in dashboard '" + warning.dashboard + "'"
+
+
+def vertical_text_message(warning):
+    return "B1 text is rotated for view '" + warning.item + "' in dashboard '" + warning.dashboard + "'"
+
+
+def alt_text_message(warning):
+    short_name = warning.item.split("/")[-1]
+    return "A4 image '" + short_name + "' with missing alternative text in dashboard '" + warning.dashboard + "'"
+
+
+def title_message(warning):
+    return "A5 Object '" + warning.item + "' in dashboard '" + warning.dashboard + "' has no title"
+
+
+def caption_message(warning):
+    return "A6 Object '" + warning.item + "' in dashboard '" + warning.dashboard + "' has no caption"
+
+
+@register_rule
+class AltTextRule(Rule):
+    codes = ('A4',)
+    tags = ('zone',)
+
+    def start(self, zone, context):
+        if is_image_zone(zone) and not zone.get("alt-text"):
+            return [alt_text_warning(context.dashboard, zone.get("param"))]
+
+
+@register_rule
+class TitleAndCaptionRule(Rule):
+    codes = ('A5', 'A6')
+    tags = ('zone',)
+
+    def start(self, zone, context):
+        if is_view_zone(zone) and zone.get('name') is not None:
+            return title_and_caption_warnings(zone, context.dashboard, zone.get('name'))
+
+
+@register_rule
+class VerticalTextRule(Rule):
+    codes = ('B1',)
+    tags = ('format',)
+    by_worksheet = True
+
+    def __init__(self):
+        self.sheets = []
+
+    def start(self, format, context):
+        if context.worksheet is not None and is_vertical_text_format(format):
+            self.sheets.append(context.worksheet)
+
+    def finish(self, context):
+        # Wait until every dashboard has been seen, as worksheets come before dashboards
+        return [vertical_text_warning(dashboard_name, sheet)
+                for sheet in self.sheets for dashboard_name in context.sheet_zones.get(sheet, [])]
+
+
+@register_rule
+class MarkLabelsRule(Rule):
+    codes = ('B3',)
+    tags = ('worksheet', 'format')
+    by_worksheet = True
+
+    def __init__(self):
+        self.sheets = []
+        self.has_mark_labels = False
+
+    def start(self, element, context):
+        if element.tag == 'worksheet':
+            self.has_mark_labels = False
+        elif element.get('attr') == 'mark-labels-show':
+            self.has_mark_labels = True
+
+    def end(self, element, context):
+        if element.tag == 'worksheet' and not self.has_mark_labels:
+            self.sheets.append(context.worksheet)
+
+    def finish(self, context):
+        return [mark_labels_warning(dashboard_name, sheet)
+                for sheet in self.sheets for dashboard_name in context.sheet_zones.get(sheet, [])]
+
+
+WHITE = (255, 255, 255)
+CONTRAST_NORMAL_TEXT = 4.5
+CONTRAST_LARGE_TEXT = 3.0
+# The smallest difference in CIELAB that makes two colours easy to tell apart
+COLOUR_DISTANCE = 10.0
+LUMINANCE = (0.2126, 0.7152, 0.0722)
+SRGB_TO_XYZ = (
+    (0.4124, 0.3576, 0.1805),
+    (0.2126, 0.7152, 0.0722),
+    (0.0193, 0.1192, 0.9505)
+)
+D65 = (0.95047, 1.0, 1.08883)
+# Machado, Oliveira and Fernandes (2009) simulations of full dichromacy, applied to linear RGB
+COLOUR_DEFICIENCIES = OrderedDict([
+    ('protanopia', ((0.152286, 1.052583, -0.204868),
+                    (0.114503, 0.786281, 0.099216),
+                    (-0.003882, -0.048116, 1.051998))),
+    ('deuteranopia', ((0.367322, 0.860646, -0.227968),
+                      (0.280085, 0.672501, 0.047413),
+                      (-0.011820, 0.042940, 0.968881))),
+    ('tritanopia', ((1.255528, -0.076749, -0.178779),
+                    (-0.078411, 0.930809, 0.147602),
+                    (0.004733, 0.691367, 0.303900)))
+])
+
+
+def parse_colour(value):
+    # Tableau writes colours as #rrggbb, sometimes followed by an alpha value
+    if value is None:
+        return None
+    value = value.strip()
+    if not value.startswith('#'):
+        return None
+    digits = value[1:]
+    if digits.__len__() in [3, 4]:
+        digits = ''.join(c + c for c in digits[:3])
+    try:
+        return tuple(int(digits[i:i + 2], 16) for i in [0, 2, 4])
+    except ValueError:
+        return None
+
+
+def format_colour(colour):
+    return '#' + ''.join('%02x' % c for c in colour)
+
+
+def to_linear(channel):
+    channel = channel / 255.0
+    if channel <= 0.04045:
+        return channel / 12.92
+    return ((channel + 0.055) / 1.055) ** 2.4
+
+
+def to_lab(linear):
+    # CIELAB coordinates of a linear RGB colour
+    xyz = [sum(m * c for m, c in zip(row, linear)) / white for row, white in zip(SRGB_TO_XYZ, D65)]
+    f = [t ** (1 / 3.0) if t > (6 / 29.0) ** 3 else t / (3 * (6 / 29.0) ** 2) + 4 / 29.0 for t in xyz]
+    return 116 * f[1] - 16, 500 * (f[0] - f[1]), 200 * (f[1] - f[2])
+
+
+def get_numpy():
+    global numpy
+    if numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+def simulate(linear, matrix):
+    return tuple(min(1.0, max(0.0, sum(m * c for m, c in zip(row, linear)))) for row in matrix)
+
+
+def get_contrast_ratios(foregrounds, backgrounds):
+    # WCAG contrast ratios of pairs of (r, g, b) colours
+    if not foregrounds:
+        return []
+    if get_numpy() is not None:
+        luminance = numpy.array(LUMINANCE)
+        first = get_linear_array(foregrounds) @ luminance
+        second = get_linear_array(backgrounds) @ luminance
+        return ((numpy.maximum(first, second) + 0.05) / (numpy.minimum(first, second) + 0.05)).tolist()
+    ratios = []
+    for foreground, background in zip(foregrounds, backgrounds):
+        first, second = [sum(w * to_linear(c) for w, c in zip(LUMINANCE, colour)) for colour in [foreground, background]]
+        ratios.append((max(first, second) + 0.05) / (min(first, second) + 0.05))
+    return ratios
+
+
+def get_colour_distances(firsts, seconds, deficiency=None):
+    # Distances in CIELAB between pairs of (r, g, b) colours, as seen with a colour vision deficiency if given
+    if not firsts:
+        return []
+    matrix = None if deficiency is None else COLOUR_DEFICIENCIES[deficiency]
+    if get_numpy() is not None:
+        first = get_lab_array(get_linear_array(firsts), matrix)
+        second = get_lab_array(get_linear_array(seconds), matrix)
+        return numpy.sqrt(((first - second) ** 2).sum(axis=1)).tolist()
+    distances = []
+    for first, second in zip(firsts, seconds):
+        first, second = [tuple(to_linear(c) for c in colour) for colour in [first, second]]
+        if matrix is not None:
+            first, second = simulate(first, matrix), simulate(second, matrix)
+        distances.append(sum((a - b) ** 2 for a, b in zip(to_lab(first), to_lab(second))) ** 0.5)
+    return distances
+
+
+def get_linear_array(colours):
+    channels = numpy.array(colours, dtype=float) / 255.0
+    return numpy.where(channels <= 0.04045, channels / 12.92, ((channels + 0.055) / 1.055) ** 2.4)
+
+
+def get_lab_array(linear, matrix=None):
+    if matrix is not None:
+        linear = numpy.clip(linear @ numpy.array(matrix).T, 0.0, 1.0)
+    xyz = linear @ numpy.array(SRGB_TO_XYZ).T / numpy.array(D65)
+    f = numpy.where(xyz > (6 / 29.0) ** 3, numpy.cbrt(xyz), xyz / (3 * (6 / 29.0) ** 2) + 4 / 29.0)
+    return numpy.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+def is_large_text(size, bold):
+    # WCAG counts 18pt text, or 14pt bold text, as large
+    try:
+        size = float(size)
+    except (TypeError, ValueError):
+        return False
+    return size >= 18 or (bold and size >= 14)
+
+
+def contrast_warning(dashboard_name, kind, item, foreground, background, ratio, minimum):
+    return WarningRecord("A2", dashboard_name, item, (kind, foreground, background, ratio, minimum))
+
+
+def colour_blind_warning(dashboard_name, sheet, first, second, deficiencies):
+    return WarningRecord("B5", dashboard_name, sheet, (first, second, tuple(deficiencies)))
+
+
+def contrast_message(warning):
+    kind, foreground, background, ratio, minimum = warning.details
+    return "A2 " + kind + " '" + warning.item + "' in dashboard '" + warning.dashboard + \
+           "' has a contrast ratio of " + ('%.2f' % ratio) + ":1 (" + format_colour(foreground) + " on " + \
+           format_colour(background) + "), below " + ('%.1f' % minimum) + ":1"
+
+
+def colour_blind_message(warning):
+    first, second, deficiencies = warning.details
+    return "B5 colours " + format_colour(first) + " and " + format_colour(second) + " for view '" + warning.item + \
+           "' in dashboard '" + warning.dashboard + "' are hard to tell apart with " + ', '.join(deficiencies)
+
+
+@register_rule
+class ColourContrastRule(Rule):
+    """
+    Collects the text colours of worksheets, dashboard text and buttons with the background
+    they are shown on, and checks all of their contrast ratios at once when the walk is done.
+    Backgrounds of zones come after their content, so they are only resolved in finish.
+    """
+    codes = ('A2',)
+    tags = ('zone', 'zone-style', 'style-rule', 'format', 'run', 'button', 'button-caption-font-style', 'caption')
+    by_worksheet = True
+
+    def __init__(self):
+        # Each text is (dashboard, worksheet, zone, kind, item, foreground, background, large)
+        self.texts = []
+        self.zone_parents = []
+        self.zone_backgrounds = []
+        self.zones = []
+        self.sheet_backgrounds = {}
+        self.dashboard_backgrounds = {}
+        self.in_zone_style = False
+        self.style_element = None
+        self.button = None
+
+    def start(self, element, context):
+        tag = element.tag
+        if tag == 'zone':
+            self.zone_parents.append(self.zones[-1] if self.zones else None)
+            self.zone_backgrounds.append(None)
+            self.zones.append(self.zone_parents.__len__() - 1)
+        elif tag == 'zone-style':
+            self.in_zone_style = True
+        elif tag == 'style-rule':
+            self.style_element = element.get('element')
+        elif tag == 'button':
+            self.button = {"foreground": None, "background": None, "large": False, "caption": 'button'}
+        elif tag == 'button-caption-font-style' and self.button is not None:
+            self.button["foreground"] = parse_colour(element.get('fontcolor'))
+            self.button["large"] = is_large_text(element.get('fontsize'), 'Bold' in (element.get('fontname') or ''))
+        elif tag == 'format':
+            self.add_format(element, context)
+
+    def add_format(self, format, context):
+        colour = parse_colour(format.get('value'))
+        if colour is None:
+            return
+        if format.get('attr') == 'background-color':
+            if self.button is not None:
+                self.button["background"] = colour
+            elif self.in_zone_style and self.zones:
+                self.zone_backgrounds[self.zones[-1]] = colour
+            elif self.style_element in ['table', 'worksheet', 'dashboard']:
+                if context.worksheet is not None:
+                    self.sheet_backgrounds.setdefault(context.worksheet, colour)
+                elif context.dashboard is not None and not self.zones:
+                    self.dashboard_backgrounds.setdefault(context.dashboard, colour)
+        elif format.get('attr') == 'color' and context.worksheet is not None and self.style_element != 'mark':
+            self.texts.append((None, context.worksheet, None, 'text in view', context.worksheet, colour, None, False))
+
+    def end(self, element, context):
+        tag = element.tag
+        if tag == 'zone':
+            self.zones.pop()
+        elif tag == 'zone-style':
+            self.in_zone_style = False
+        elif tag == 'style-rule':
+            self.style_element = None
+        elif tag == 'caption' and self.button is not None and element.text:
+            self.button["caption"] = element.text.strip()
+        elif tag == 'button':
+            if self.button["foreground"] is not None and context.dashboard is not None:
+                self.texts.append((context.dashboard, None, self.zones[-1] if self.zones else None, 'button',
+                                   self.button["caption"], self.button["foreground"], self.button["background"],
+                                   self.button["large"]))
+            self.button = None
+        elif tag == 'run':
+            colour = parse_colour(element.get('fontcolor'))
+            if colour is None:
+                return
+            large = is_large_text(element.get('fontsize'), element.get('bold') == 'true')
+            item = (element.text or '').strip()
+            if context.worksheet is not None:
+                self.texts.append((None, context.worksheet, None, 'text in view', context.worksheet, colour, None,
+                                   large))
+            elif context.dashboard is not None:
+                self.texts.append((context.dashboard, None, self.zones[-1] if self.zones else None, 'text', item,
+                                   colour, None, large))
+
+    def get_background(self, dashboard_name, sheet, zone):
+        if sheet is not None:
+            return self.sheet_backgrounds.get(sheet, WHITE)
+        while zone is not None:
+            if self.zone_backgrounds[zone] is not None:
+                return self.zone_backgrounds[zone]
+            zone = self.zone_parents[zone]
+        return self.dashboard_backgrounds.get(dashboard_name, WHITE)
+
+    def finish(self, context):
+        texts = []
+        for dashboard_name, sheet, zone, kind, item, foreground, background, large in self.texts:
+            if background is None:
+                background = self.get_background(dashboard_name, sheet, zone)
+            texts.append((dashboard_name, sheet, kind, item, foreground, background, large))
+        ratios = get_contrast_ratios([text[4] for text in texts], [text[5] for text in texts])
+        warnings = []
+        seen = set()
+        for (dashboard_name, sheet, kind, item, foreground, background, large), ratio in zip(texts, ratios):
+            minimum = CONTRAST_LARGE_TEXT if large else CONTRAST_NORMAL_TEXT
+            if ratio >= minimum:
+                continue
+            dashboard_names = [dashboard_name] if sheet is None else context.sheet_zones.get(sheet, [])
+            for name in dashboard_names:
+                key = (name, item, foreground, background)
+                if key not in seen:
+                    seen.add(key)
+                    warnings.append(contrast_warning(name, kind, item, foreground, background, ratio, minimum))
+        return warnings
+
+
+@register_rule
+class ColourBlindRule(Rule):
+    """
+    Collects the colours that mark colour encodings use, either mapped one by one or from a
+    custom palette, and checks every pair at once for colours that are distinct but look the
+    same with protanopia, deuteranopia or tritanopia.
+    """
+    codes = ('B5',)
+    tags = ('color-palette', 'color', 'encoding', 'map')
+    by_worksheet = True
+
+    def __init__(self):
+        self.palettes = {}
+        self.palette = None
+        self.encodings = []
+        self.encoding = None
+
+    def start(self, element, context):
+        tag = element.tag
+        if tag == 'color-palette':
+            self.palette = []
+            self.palettes.setdefault(element.get('name'), self.palette)
+        elif tag == 'encoding' and element.get('attr') == 'color' and context.worksheet is not None:
+            self.encoding = (context.worksheet, element.get('palette'), [])
+        elif tag == 'map' and self.encoding is not None:
+            colour = parse_colour(element.get('to'))
+            if colour is not None:
+                self.encoding[2].append(colour)
+
+    def end(self, element, context):
+        tag = element.tag
+        if tag == 'color-palette':
+            self.palette = None
+        elif tag == 'color' and self.palette is not None:
+            colour = parse_colour(element.text)
+            if colour is not None:
+                self.palette.append(colour)
+        elif tag == 'encoding' and self.encoding is not None:
+            self.encodings.append(self.encoding)
+            self.encoding = None
+
+    def finish(self, context):
+        # Every pair of colours of every encoding goes into one batch
+        pairs = []
+        for position, (sheet, palette, mapped) in enumerate(self.encodings):
+            colours = []
+            for colour in mapped or self.palettes.get(palette, []):
+                if colour not in colours:
+                    colours.append(colour)
+            pairs.extend((position, first, second) for first, second in itertools.combinations(colours, 2))
+        firsts = [pair[1] for pair in pairs]
+        seconds = [pair[2] for pair in pairs]
+        normal = get_colour_distances(firsts, seconds)
+        simulated = [get_colour_distances(firsts, seconds, deficiency) for deficiency in COLOUR_DEFICIENCIES]
+
+        warnings = []
+        reported = set()
+        for i, (position, first, second) in enumerate(pairs):
+            sheet = self.encodings[position][0]
+            if sheet in reported or normal[i] < COLOUR_DISTANCE:
+                continue
+            deficiencies = [deficiency for deficiency, distances in zip(COLOUR_DEFICIENCIES, simulated)
+                            if distances[i] < COLOUR_DISTANCE]
+            if deficiencies:
+                # Only the first pair that can't be told apart is reported for each view
+                reported.add(sheet)
+                warnings.extend(colour_blind_warning(dashboard_name, sheet, first, second, deficiencies)
+                                for dashboard_name in context.sheet_zones.get(sheet, []))
+        return warnings
+
+
+# Parameter and set actions have tags of their own; other actions say what they do in their command
+ACTION_TAGS = {'action': 'action', 'edit-parameter-action': 'parameter', 'edit-group-action': 'set'}
+ACTION_COMMANDS = [('filter', 'filter'), ('brush', 'highlight'), ('goto-sheet', 'navigation'),
+                   ('parameter', 'parameter'), ('set', 'set')]
+
+
+def get_action_kind(command):
+    for term, kind in ACTION_COMMANDS:
+        if term in command:
+            return kind
+    return 'action'
+
+
+def split_names(value):
+    return tuple(value.split(',')) if value else ()
+
+
+class ActionIndex(object):
+    """
+    The actions of a workbook as a graph from the views that start them to the views they
+    act on, with the tooltip settings of each worksheet. It is filled in during a single
+    walk of the workbook and resolved at the end, after which each view on a dashboard can
+    be looked up in constant time.
+    """
+    tags = ('zone', 'tooltip-style', 'customized-tooltip', 'activation', 'source', 'command', 'param',
+            'link') + tuple(ACTION_TAGS)
+
+    def __init__(self):
+        self.actions = []
+        self.views = OrderedDict()
+        self.sheet_dashboards = {}
+        self.captions = set()
+        self.texts = set()
+        self.hidden_commands = {}
+        self.sources = {}
+        self.targets = {}
+        self.action = None
+
+    def start(self, element, dashboard_name, worksheet):
+        tag = element.tag
+        if tag == 'zone':
+            self.add_zone(dashboard_name, element)
+        elif tag in ACTION_TAGS:
+            self.action = {"name": element.get('name'), "caption": element.get('caption'), "kind": ACTION_TAGS[tag],
+                           "activation": None, "dashboard": None, "worksheet": None, "exclude": (),
+                           "targets": [], "target_exclude": ()}
+        elif tag in ['tooltip-style', 'customized-tooltip']:
+            if worksheet is not None:
+                self.add_tooltip_setting(worksheet, element)
+        elif self.action is None:
+            return
+        elif tag == 'activation':
+            self.action["activation"] = element.get('type')
+        elif tag == 'source':
+            self.action["dashboard"] = element.get('dashboard')
+            self.action["worksheet"] = element.get('worksheet')
+            self.action["exclude"] = split_names(element.get('exclude'))
+        elif tag == 'command':
+            self.action["kind"] = get_action_kind(element.get('command') or '')
+        elif tag == 'link':
+            self.action["kind"] = 'url'
+        elif tag == 'param' and element.get('name') == 'target':
+            self.action["targets"].append(element.get('value'))
+        elif tag == 'param' and element.get('name') == 'exclude':
+            self.action["target_exclude"] = split_names(element.get('value'))
+
+    def end(self, element):
+        if element.tag in ACTION_TAGS and self.action is not None:
+            self.actions.append(self.action)
+            self.action = None
+
+    def add_zone(self, dashboard_name, zone):
+        if dashboard_name is None:
+            return
+        views = self.views.setdefault(dashboard_name, OrderedDict())
+        if is_text_zone(zone):
+            self.texts.add(dashboard_name)
+        elif is_view_zone(zone) and zone.get('name') is not None:
+            name = zone.get('name')
+            if name not in views:
+                views[name] = True
+                self.sheet_dashboards.setdefault(name, []).append(dashboard_name)
+            if zone.get('show-caption') == 'true':
+                self.captions.add((dashboard_name, name))
+
+    def add_tooltip_setting(self, worksheet, element):
+        if element.tag == 'tooltip-style' and element.get('tooltip-mode') == 'none':
+            self.hidden_commands[worksheet] = 'tooltips are turned off'
+        elif element.tag == 'customized-tooltip' and element.get('show-buttons') == 'false':
+            self.hidden_commands.setdefault(worksheet, 'tooltip command buttons are hidden')
+
+    def get_views(self, dashboard_name, worksheet, exclude=()):
+        # Actions that start from a worksheet rather than a dashboard only run on the worksheet itself
+        if dashboard_name is None:
+            return [(None, worksheet)]
+        views = self.views.get(dashboard_name, {})
+        if worksheet is not None:
+            return [(dashboard_name, worksheet)] if worksheet in views else []
+        return [(dashboard_name, name) for name in views if name not in exclude]
+
+    def resolve(self):
+        self.sources = {}
+        self.targets = {}
+        for action in self.actions:
+            for view in self.get_views(action["dashboard"], action["worksheet"], action["exclude"]):
+                self.sources.setdefault(view, []).append(action)
+            targets = []
+            for target in action["targets"]:
+                if target in self.views:
+                    targets.extend(self.get_views(target, None, action["target_exclude"]))
+                else:
+                    targets.extend(self.get_views(None, target))
+            self.targets[action["name"]] = targets
+        return self
+
+    def get_actions(self, dashboard_name, view):
+        return self.sources.get((dashboard_name, view), [])
+
+    def get_targets(self, action):
+        return self.targets.get(action["name"], [])
+
+    def get_hidden_commands(self, view):
+        return self.hidden_commands.get(view)
+
+    def is_explained(self, dashboard_name, view):
+        return dashboard_name in self.texts or (dashboard_name, view) in self.captions
+
+
+def index_actions(tree):
+    # Builds and resolves the action index of a whole workbook in one walk
+    index = ActionIndex()
+    dashboard_name = None
+    worksheet = None
+    for event, element in walk_workbook(tree, ActionIndex.tags + ('dashboard', 'worksheet')):
+        if element.tag == 'dashboard':
+            dashboard_name = element.get('name') if event == 'start' else None
+        elif element.tag == 'worksheet':
+            worksheet = element.get('name') if event == 'start' else None
+        elif event == 'start':
+            index.start(element, dashboard_name, worksheet)
+        else:
+            index.end(element)
+    return index.resolve()
+
+
+def view_data_warning(dashboard_name, sheet, reason):
+    return WarningRecord("A7", dashboard_name, sheet, (reason,))
+
+
+def interaction_warning(dashboard_name, sheet, kinds):
+    return WarningRecord("B6", dashboard_name, sheet, tuple(kinds))
+
+
+def view_data_message(warning):
+    return "A7 View Data can't be reached from view '" + warning.item + "' in dashboard '" + warning.dashboard + \
+           "' as " + warning.details[0]
+
+
+def interaction_message(warning):
+    kinds = list(warning.details)
+    if kinds.__len__() > 1:
+        kinds = [', '.join(kinds[:-1]) + ' and ' + kinds[-1]]
+    return "B6 " + kinds[0] + " actions of view '" + warning.item + "' in dashboard '" + warning.dashboard + \
+           "' are not explained in text"
+
+
+@register_rule
+class InteractivityRule(Rule):
+    """
+    Fills in an ActionIndex as the workbook is walked and then checks every view on every
+    dashboard: A7 if View Data can't be reached from its tooltips, and B6 if it starts
+    actions and the dashboard has no text, or the view no caption, to explain them.
+    """
+    codes = ('A7', 'B6')
+    tags = ActionIndex.tags
+
+    def __init__(self):
+        self.index = ActionIndex()
+
+    def start(self, element, context):
+        self.index.start(element, context.dashboard, context.worksheet)
+
+    def end(self, element, context):
+        self.index.end(element)
+
+    def finish(self, context):
+        index = self.index.resolve()
+        warnings = []
+        for dashboard_name, views in index.views.items():
+            for view in views:
+                reason = index.get_hidden_commands(view)
+                if reason is not None:
+                    warnings.append(view_data_warning(dashboard_name, view, reason))
+                kinds = []
+                for action in index.get_actions(dashboard_name, view):
+                    if action["kind"] not in kinds:
+                        kinds.append(action["kind"])
+                if kinds and not index.is_explained(dashboard_name, view):
+                    warnings.append(interaction_warning(dashboard_name, view, kinds))
+        return warnings
+
+
+WARNING_MESSAGES = {
+    "A2": contrast_message,
+    "A4": alt_text_message,
+    "A5": title_message,
+    "A6": caption_message,
+    "A7": view_data_message,
+    "B1": vertical_text_message,
+    "B3": mark_labels_message,
+    "B5": colour_blind_message,
+    "B6": interaction_message
+}
+# Codes whose item is the name of a view
+SHEET_CODES = {"A5", "A6", "A7", "B1", "B3", "B5", "B6"}
+
+
+def count_warnings(warnings, by='code'):
+    # Counts warnings by code, dashboard or worksheet as they are produced, without keeping them
+    counts = OrderedDict()
+    for warning in warnings:
+        warning = as_warning_record(warning)
+        key = getattr(warning, by)
+        if key is not None:
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def check_mark_labels(tree):
+    return check_accessibility_in_tree(tree, ['B3'])
+
+
 def check_vertical_text(tree):
-    formats = tree.xpath("//format[@attr='text-orientation' and (@value='-90' or @value='90')]")
-    warnings = []
-    for format in formats:
-        sheet = get_parent_tag(format, 'worksheet').get("name")
-        zones = tree.xpath("//zone[@name='"+sheet+"']")
-        for zone in zones:
-            if zone.get('_.fcp.SetMembershipControl.false...type') is None and zone.get("type") is None:
-                dashboard_name = get_parent_dashboard_name(zone)
-                warnings.append(
-                    {
-                        "code": "B1",
-                        "dashboard": dashboard_name,
-                        "item": sheet,
-                        "message": "B3 text is rotated for view '"+sheet+"' in dashboard '"+dashboard_name+"'"
-                    })
-    return warnings
+    return check_accessibility_in_tree(tree, ['B1'])
 
 
 def check_alt_text(tree):
-    warnings = []
-    images = tree.xpath("//zone[@_.fcp.SetMembershipControl.false...type='bitmap' or @type='bitmap']")
-    for image in images:
-        if not image.get("alt-text") or image.get("alt-text") == '':
-            dashboard_name = get_parent_dashboard_name(image)
-            short_name = image.get("param").split("/")[-1]
-            warnings.append(
-                {
-                    "code": "A4",
-                    "dashboard": dashboard_name,
-                    "item": image.get("param"),
-                    "message": "A4 image '"+short_name+"' with missing alternative text in dashboard '" + dashboard_name + "'"
-                })
-    return warnings
+    return check_accessibility_in_tree(tree, ['A4'])
 
 
 def check_titles_and_captions(tree):
+    return check_accessibility_in_tree(tree, ['A5', 'A6'])
+
+
+def check_colour_contrast(tree):
+    return check_accessibility_in_tree(tree, ['A2'])
+
+
+def check_colour_blindness(tree):
+    return check_accessibility_in_tree(tree, ['B5'])
+
+
+def check_view_data(tree):
+    return check_accessibility_in_tree(tree, ['A7'])
+
+
+def check_interactions(tree):
+    return check_accessibility_in_tree(tree, ['B6'])
+
+
+CACHE_VERSION = '2'
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+
+def get_default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tabfix')
+
+
+class ResultCache(object):
+    """
+    An on-disk cache of the warnings for each dashboard, stored as one JSON file per key.
+    Files are touched when they are read. The size of the cache is counted once and then
+    kept up to date as files are written, and evict removes the least recently used files
+    once it has grown beyond max_size bytes, so a batch of puts only scans the folder when
+    something has to go.
+    """
+
+    def __init__(self, path=None, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path or get_default_cache_dir()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_filename(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        filename = self.get_filename(key)
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                warnings = json.load(f)
+            os.utime(filename)
+        except (OSError, ValueError):
+            self.misses += 1
+            profile.count('cache.misses')
+            return None
+        self.hits += 1
+        profile.count('cache.hits')
+        return warnings
+
+    def put(self, key, warnings):
+        filename = self.get_filename(key)
+        size = self.get_size()
+        try:
+            size -= os.path.getsize(filename)
+        except OSError:
+            pass
+        # The details are kept as well as the message, as the worksheet of an A2 warning depends on them
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump([dict(warning.as_dict(), details=warning.details) if isinstance(warning, WarningRecord)
+                       else warning for warning in warnings], f)
+        self.size = size + os.path.getsize(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    def put_all(self, entries):
+        # Writes each (key, warnings) pair and then evicts once for the whole batch
+        for key, warnings in entries:
+            self.put(key, warnings)
+        self.evict()
+
+    def get_size(self):
+        if self.size is None:
+            self.size = sum(entry[1] for entry in self.get_entries())
+        return self.size
+
+    def get_entries(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        if self.get_size() <= self.max_size:
+            return
+        entries = self.get_entries()
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, filename in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            size -= entry_size
+        self.size = size
+
+    def clear(self):
+        for mtime, size, filename in self.get_entries():
+            os.remove(filename)
+        self.size = 0
+
+
+def get_dashboard_key(dashboard, worksheets, columns, codes=None, shared=()):
+    # A hash of everything that the rules can look at for this dashboard: its own subtree, the
+    # worksheets it shows, the datasource columns they depend on and any shared elements such as
+    # the workbook preferences and the actions the dashboard starts
+    digest = hashlib.sha256()
+    digest.update((CACHE_VERSION + '|' + ','.join(get_rule_codes()) + '|' + ','.join(sorted(codes or []))).encode())
+    elements = [dashboard] + list(shared)
+    for zone in dashboard.iter('zone'):
+        if is_view_zone(zone) and zone.get('name') in worksheets:
+            elements.append(worksheets[zone.get('name')])
+    for element in list(elements):
+        for dependencies in element.iter('datasource-dependencies'):
+            for column in dependencies.iter('column'):
+                reference = columns.get((dependencies.get('datasource'), column.get('name')))
+                if reference is not None:
+                    elements.append(reference)
+    for element in elements:
+        digest.update(tostring(element, method='c14n'))
+    return digest.hexdigest()
+
+
+def check_accessibility_cached(tree, cache, codes=None, max_warnings=None, workers=None):
+    # Only dashboards whose content has changed since they were last checked are checked again
+    return check_dashboards(tree, codes, max_warnings, cache, workers)
+
+
+def check_accessibility_parallel(tree, codes=None, max_warnings=None, workers=None, cache=None):
+    # Checks the dashboards of one workbook on a pool of worker processes
+    with profile.timer('check_parallel'):
+        return check_dashboards(tree, codes, max_warnings, cache, workers or os.cpu_count())
+
+
+def check_dashboards(tree, codes=None, max_warnings=None, cache=None, workers=None):
+    # Checks each dashboard with the worksheets it shows on its own. Warnings come in the same
+    # order as from check_accessibility_in_tree, but max_warnings only cuts the list once every
+    # dashboard has been checked.
+    root = tree.getroot() if hasattr(tree, 'getroot') else tree
+    worksheets = {}
+    for worksheet in root.iter('worksheet'):
+        worksheets.setdefault(worksheet.get('name'), worksheet)
+    positions = dict((worksheet, i) for i, worksheet in enumerate(worksheets.values()))
+    columns = {}
+    datasources = root.find('datasources')
+    if datasources is not None:
+        for datasource in datasources.iterfind('datasource'):
+            for column in datasource.iterfind('column'):
+                columns.setdefault((datasource.get('name'), column.get('name')), column)
+
+    # Custom colour palettes are kept in the preferences and can be used by any worksheet
+    shared = [preferences for preferences in [root.find('preferences')] if preferences is not None]
+    # Actions are kept together outside the dashboards, so each dashboard takes the ones its views start
+    source_actions = {}
+    for actions in root.iterfind('actions'):
+        for action in actions:
+            source = action.find('source')
+            if source is not None and source.get('dashboard') is not None:
+                source_actions.setdefault(source.get('dashboard'), []).append(action)
+
+    results = []
+    pending = []
+    # How many zones show each view on each dashboard, as a rule reports a view once for each
+    view_counts = []
+    for dashboard in root.iter('dashboard'):
+        counts = {}
+        for zone in dashboard.iter('zone'):
+            if is_view_zone(zone) and zone.get('name') is not None:
+                counts[zone.get('name')] = counts.get(zone.get('name'), 0) + 1
+        view_counts.append(counts)
+        key = None
+        elements = shared + source_actions.get(dashboard.get('name'), [])
+        if cache is not None:
+            key = get_dashboard_key(dashboard, worksheets, columns, codes, elements)
+            warnings = cache.get(key)
+            if warnings is not None:
+                results.append([as_warning_record(warning) for warning in warnings])
+                continue
+        sheets = [worksheets[name] for name in counts if name in worksheets]
+        # Walk the preferences and actions, the worksheets in document order, then the dashboard itself
+        sheets.sort(key=lambda sheet: positions[sheet])
+        pending.append((results.__len__(), key, elements + sheets + [dashboard]))
+        results.append(None)
+
+    if workers is None or workers < 2 or pending.__len__() < 2:
+        tags = get_rule_tags()
+        for position, key, elements in pending:
+            results[position] = check_rules(itertools.chain(*[walk_workbook(element, tags) for element in elements]),
+                                            codes)
+    else:
+        units = [serialize_unit(elements) for position, key, elements in pending]
+        chunk_size = max(1, units.__len__() // (workers * 4))
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as executor:
+            for (position, key, elements), warnings in zip(pending, executor.map(
+                    check_unit, units, itertools.repeat(codes), chunksize=chunk_size)):
+                results[position] = warnings
+    if cache is not None:
+        cache.put_all((key, results[position]) for position, key, elements in pending)
+
+    sheet_positions = dict((name, i) for i, name in enumerate(worksheets))
     warnings = []
-    zones = tree.xpath("//zone[@name]")
-    for zone in zones:
-        if zone.get('_.fcp.SetMembershipControl.false...type') is None and zone.get("type") is None:
-            dashboard_name = get_parent_dashboard_name(zone)
-            item = zone.get('name')
-            if zone.get('show-title') and zone.get('show-title') == 'false':
-                warnings.append(
-                    {
-                        "code": "A5",
-                        "dashboard": dashboard_name,
-                        "item": item,
-                        "message": "A5 Object '" + item + "' in dashboard '" + dashboard_name + "' has no title"
-                    })
-            if not zone.get('show-caption') or zone.get('show-caption') == 'false':
-                warnings.append(
-                    {
-                        "code": "A6",
-                        "dashboard": dashboard_name,
-                        "item": item,
-                        "message": "A6 Object '" + item + "' in dashboard '" + dashboard_name + "' has no caption"
-                    })
+    for rule in RULES:
+        found = []
+        for position, dashboard_warnings in enumerate(results):
+            occurrences = {}
+            for i, warning in enumerate([warning for warning in dashboard_warnings if warning.code in rule.codes]):
+                sheet = warning.worksheet if rule.by_worksheet else None
+                if sheet is None:
+                    found.append(((1, position, i), warning))
+                else:
+                    # Views come before dashboards, and each warning about a view is given for
+                    # every zone showing it, dashboard by dashboard, before the next one
+                    occurrence = occurrences.get(sheet, 0)
+                    occurrences[sheet] = occurrence + 1
+                    occurrence = occurrence // max(1, view_counts[position].get(sheet, 1))
+                    found.append(((0, sheet_positions.get(sheet, -1), occurrence, position), warning))
+        found.sort(key=lambda pair: pair[0])
+        warnings.extend(warning for order, warning in found)
+    if max_warnings is not None:
+        warnings = warnings[:max_warnings]
     return warnings
 
 
+def serialize_unit(elements):
+    # The smallest workbook that worker processes need for a piece of work
+    return b'<workbook>' + b''.join(tostring(element, with_tail=False) for element in elements) + b'</workbook>'
+
+
+def parse_unit(data):
+    # Each unit gets a parser of its own rather than sharing the module parser
+    return fromstring(data, XMLParser(huge_tree=True))
+
+
+def check_unit(data, codes=None):
+    return check_rules(walk_workbook(parse_unit(data), get_rule_tags()), codes)
+
+
+WARNING_FIELDS = ['code', 'dashboard', 'item', 'message']
+SARIF_SCHEMA = 'https://json.schemastore.org/sarif-2.1.0.json'
+REPORT_FORMATS = ['csv', 'jsonl', 'sarif']
+
+
+class WarningWriter(object):
+    """
+    Writes warnings to a report one at a time, flushing after each so that the report can
+    be read while checking carries on.
+    """
+
+    def __init__(self, path, workbook=None):
+        self.path = path
+        self.workbook = workbook
+        self.count = 0
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.begin()
+        self.file.flush()
+
+    def begin(self):
+        pass
+
+    def write_warning(self, warning):
+        pass
+
+    def end(self):
+        pass
+
+    def write(self, warning):
+        self.write_warning(warning)
+        self.count += 1
+        self.file.flush()
+
+    def write_all(self, warnings):
+        # Passes the warnings on, so a report can be written while they are being printed
+        for warning in warnings:
+            self.write(warning)
+            yield warning
+
+    def close(self):
+        if not self.file.closed:
+            self.end()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CsvWarningWriter(WarningWriter):
+
+    def begin(self):
+        import csv
+        self.writer = csv.DictWriter(self.file, fieldnames=WARNING_FIELDS, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write_warning(self, warning):
+        self.writer.writerow(warning)
+
+
+class JsonLinesWarningWriter(WarningWriter):
+
+    def write_warning(self, warning):
+        self.file.write(json.dumps(dict(warning)) + '\n')
+
+
+class SarifWarningWriter(WarningWriter):
+
+    def begin(self):
+        # The results array is left open and closed by end, so each result can be written as it is found
+        self.file.write('{"$schema": ' + json.dumps(SARIF_SCHEMA) + ', "version": "2.1.0", "runs": [{"tool": ' +
+                        json.dumps({"driver": {
+                            "name": "tabfix",
+                            "informationUri": "https://github.com/JiscDACT/tableau-accessibility",
+                            "rules": [{"id": code} for code in get_rule_codes()]}}) +
+                        ', "results": [\n')
+
+    def write_warning(self, warning):
+        location = {
+            "logicalLocations": [{
+                "name": warning.get("item"),
+                "fullyQualifiedName": warning.get("dashboard") + "/" + warning.get("item"),
+                "kind": "object"
+            }]
+        }
+        if self.workbook is not None:
+            location["physicalLocation"] = {"artifactLocation": {"uri": self.workbook.replace(os.sep, '/')}}
+        result = {
+            "ruleId": warning.get("code"),
+            "level": "warning",
+            "message": {"text": warning.get("message")},
+            "locations": [location]
+        }
+        self.file.write((',\n' if self.count > 0 else '') + json.dumps(result))
+
+    def end(self):
+        self.file.write('\n]}]}\n')
+
+
+WARNING_WRITERS = {
+    'csv': CsvWarningWriter,
+    'jsonl': JsonLinesWarningWriter,
+    'sarif': SarifWarningWriter
+}
+
+
+def get_report_format(report_path):
+    if report_path.endswith('.jsonl'):
+        return 'jsonl'
+    if report_path.endswith('.sarif') or report_path.endswith('.sarif.json'):
+        return 'sarif'
+    return 'csv'
+
+
+def open_report(report_path, report_format=None, workbook=None):
+    if report_format is None:
+        report_format = get_report_format(report_path)
+    return WARNING_WRITERS[report_format](report_path, workbook)
+
+
 def load_manifest(manifest_path):
+    from yaml import load, loader
     with open(manifest_path, 'r') as file:
         configuration = load(file, Loader=loader.SafeLoader)
     return configuration
 
 
-def fix_tabs(input_filename, output_filename, configuration):
-    with open(input_filename, 'r', encoding='utf-8') as f:  # open in readonly mode
-        tree = parse(f, parser=p)
-        tree = fix_tabs_in_tree(tree, configuration)
-        tree.write(output_filename, encoding='utf-8')
+def fix_tabs(input_filename, output_filename, configuration, splice=False, workers=None):
+    tree = load_workbook(input_filename)
+    original = WorkbookSplice(tree) if splice else None
+    tree = fix_tabs_in_tree(tree, configuration, workers=workers)
+    save_workbook(tree, output_filename, input_filename, original)
+    return tree
+
 
+def fix_tabs_in_tree(tree, configuration, errors=None, workers=None, log=print):
+    with profile.timer('fix'):
+        if workers is not None and workers > 1:
+            return renumber_zones_parallel(tree, configuration, errors, workers, log)
+        return renumber_zones(tree, configuration, errors, log)
 
-def fix_tabs_in_tree(tree, configuration):
+
+def renumber_zones(tree, configuration, errors=None, log=print):
+    index = WorkbookIndex(tree)
+    reserved = get_reserved_zone_ids(tree, configuration)
+    # Each dashboard starts 100 ids after the last one used by the one before it, or later if
+    # ids of dashboards that aren't in the manifest fall where its named items would go
     zone_id = 0
     for dashboard_name in configuration:
-        tab_order = configuration[dashboard_name]
-        zone_id += 100
+        zone_id = renumber_dashboard(tree, index, dashboard_name, configuration[dashboard_name], zone_id + 100,
+                                     errors, log, reserved=reserved)
+    report_zone_id_problems(tree, list(configuration), errors, log)
+    return tree
+
 
-        # Start providing IDs for the named items
-        for item in tab_order:
-            zone = get_item(tree, dashboard_name, item)
-            if zone is not None:
-                zone.set("id", zone_id.__str__())
-                zone.set("is-modified", '1')
-                zone_id += 1
+def get_reserved_zone_ids(tree, dashboard_names):
+    # The ids of every zone in the dashboards that are not being renumbered, which the new ids
+    # of the other dashboards must not clash with
+    root = tree.getroot() if hasattr(tree, 'getroot') else tree
+    reserved = set()
+    for dashboard in root.iter('dashboard'):
+        if dashboard.get('name') in dashboard_names:
+            continue
+        for zone in dashboard.iter('zone'):
+            try:
+                reserved.add(int(zone.get('id')))
+            except (TypeError, ValueError):
+                pass
+    return reserved
+
+
+def get_free_zone_id(zone_id, reserved, count=1):
+    # The first id from zone_id on that starts a run of count ids, none of them reserved
+    while any(candidate in reserved for candidate in range(zone_id, zone_id + count)):
+        zone_id += 1
+    return zone_id
+
+
+def verify_zone_ids(tree, dashboard_names=None):
+    # Returns a description of each zone id that Tableau would find ambiguous: an id given to
+    # more than one desktop zone anywhere in the workbook, an id used twice in one device layout,
+    # or a device layout zone whose id belongs to a desktop zone of another dashboard. Only
+    # problems involving the named dashboards are reported, if names are given.
+    def checked(*names):
+        return dashboard_names is None or any(name in dashboard_names for name in names)
+
+    root = tree.getroot() if hasattr(tree, 'getroot') else tree
+    desktop = {}
+    layouts = []
+    problems = []
+    for dashboard in root.iter('dashboard'):
+        dashboard_name = dashboard.get('name')
+        for element in dashboard:
+            if element.tag == 'devicelayouts':
+                for layout in element.iter('devicelayout'):
+                    layouts.append((dashboard_name, layout))
             else:
-                print("ERROR in manifest: object '"+item+"' does not exist in dashboard '"+dashboard_name+"'")
-
-        # Add IDs to everything else in document order
-        zones = tree.xpath('//dashboard[@name="' + dashboard_name + '"]//zone')
-        for zone in zones:
-            if not zone.get("is-modified"):
-                zone.set("id", zone_id.__str__())
-                zone_id += 1
-
-        dashboard = tree.find("//dashboard[@name='"+dashboard_name+"']")
-
-        # TODO handle device layouts properly
-        # Duplicate IDs in device layouts cause problems so get rid of them...
-        layouts = dashboard.find("devicelayouts")
-        if layouts is not None:
-            dashboard.remove(layouts)
+                for zone in element.iter('zone'):
+                    zone_id = zone.get('id')
+                    if zone_id in desktop and checked(dashboard_name, desktop[zone_id]):
+                        problems.append("zone id " + zone_id.__str__() + " in dashboard '" + dashboard_name +
+                                        "' is also used in dashboard '" + desktop[zone_id] + "'")
+                    else:
+                        desktop.setdefault(zone_id, dashboard_name)
+    for dashboard_name, layout in layouts:
+        if not checked(dashboard_name):
+            continue
+        seen = set()
+        for zone in layout.iter('zone'):
+            zone_id = zone.get('id')
+            if zone_id in seen:
+                problems.append("zone id " + zone_id.__str__() + " is used twice in the " + layout.get('name', '') +
+                                " layout of dashboard '" + dashboard_name + "'")
+            elif zone_id in desktop and desktop[zone_id] != dashboard_name:
+                problems.append("zone id " + zone_id.__str__() + " in the " + layout.get('name', '') +
+                                " layout of dashboard '" + dashboard_name + "' belongs to dashboard '" +
+                                desktop[zone_id] + "'")
+            seen.add(zone_id)
+    return problems
+
+
+def report_zone_id_problems(tree, dashboard_names, errors=None, log=print):
+    with profile.timer('verify'):
+        problems = verify_zone_ids(tree, dashboard_names)
+    for problem in problems:
+        message = "ERROR in zone ids: " + problem
+        if log is not None:
+            log(message)
+        if errors is not None:
+            errors.append(message)
+
+
+def renumber_dashboard(tree, index, dashboard_name, tab_order, zone_id, errors=None, log=print, numbered=None,
+                       reserved=()):
+    # Numbers the zones of a dashboard from zone_id, skipping reserved ids, and returns the next
+    # id to try. Each zone given an id is added to numbered, if it is a list.
+    old_ids = [zone.get("id") for zone in index.zones.get(dashboard_name, [])]
+
+    named = []
+    for item in tab_order:
+        zone = get_item(tree, dashboard_name, item, index)
+        if zone is not None:
+            named.append(zone)
+        else:
+            message = "ERROR in manifest: object '"+item+"' does not exist in dashboard '"+dashboard_name+"'"
+            if log is not None:
+                log(message)
+            if errors is not None:
+                errors.append(message)
+
+    # Start providing IDs for the named items, which need consecutive ids to keep their tab
+    # order, so they start after any reserved ids that would fall among them
+    zone_id = get_free_zone_id(zone_id, reserved, named.__len__())
+    for zone in named:
+        zone.set("id", zone_id.__str__())
+        zone.set("is-modified", '1')
+        zone_id += 1
+        if numbered is not None:
+            numbered.append(zone)
+
+    # Add IDs to everything else in document order
+    for zone in index.zones.get(dashboard_name, []):
+        if not zone.get("is-modified"):
+            zone_id = get_free_zone_id(zone_id, reserved)
+            zone.set("id", zone_id.__str__())
+            zone_id += 1
+            if numbered is not None:
+                numbered.append(zone)
+
+    # Device layout zones share the id of the desktop zone they mirror, so they have to follow
+    # it to its new id; zones that only exist in a device layout get ids of their own
+    remap = {}
+    for zone, old_id in zip(index.zones.get(dashboard_name, []), old_ids):
+        if old_id is not None:
+            remap.setdefault(old_id, zone.get("id"))
+    for zone in index.layout_zones.get(dashboard_name, []):
+        new_id = remap.get(zone.get("id"))
+        if new_id is None:
+            zone_id = get_free_zone_id(zone_id, reserved)
+            new_id = zone_id.__str__()
+            zone_id += 1
+        zone.set("id", new_id)
+        if numbered is not None:
+            numbered.append(zone)
+    return zone_id
+
+
+def renumber_zones_parallel(tree, configuration, errors=None, workers=None, log=print):
+    # Numbers each dashboard in a worker process, counting ids from zero, then gives each offset
+    # the id that renumber_zones would give it
+    root = tree.getroot() if hasattr(tree, 'getroot') else tree
+    dashboards = {}
+    for dashboard in root.iter('dashboard'):
+        dashboards.setdefault(dashboard.get('name'), []).append(dashboard)
+    # Parameters and filters are found by column caption, so every worker needs the columns
+    columns = Element('datasources')
+    for column in root.iter('column'):
+        if column.get('caption') is not None and column.get('name') is not None:
+            SubElement(columns, 'column', {'caption': column.get('caption'), 'name': column.get('name')})
+
+    names = list(configuration)
+    units = [serialize_unit([columns] + dashboards.get(name, [])) for name in names]
+    tab_orders = [configuration[name] for name in names]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as executor:
+        results = list(executor.map(renumber_unit, units, names, tab_orders))
+
+    reserved = get_reserved_zone_ids(tree, configuration)
+    zone_id = 0
+    for name, (changes, count, messages) in zip(names, results):
+        zone_id += 100
+        for message in messages:
+            if log is not None:
+                log(message)
+            if errors is not None:
+                errors.append(message)
+        # Every item in the manifest that was found has an error otherwise, and they take the
+        # first ids as one block
+        named = configuration[name].__len__() - messages.__len__()
+        zone_id = get_free_zone_id(zone_id, reserved, named)
+        ids = list(range(zone_id, zone_id + named))
+        zone_id += named
+        for offset in range(named, count):
+            zone_id = get_free_zone_id(zone_id, reserved)
+            ids.append(zone_id)
+            zone_id += 1
+        zones = [zone for dashboard in dashboards.get(name, []) for zone in dashboard.iter('zone')]
+        for position, offset, modified in changes:
+            zones[position].set("id", ids[offset].__str__())
+            if modified is not None:
+                zones[position].set("is-modified", modified)
+    report_zone_id_problems(tree, names, errors, log)
     return tree
 
 
-if __name__ == "__main__":
+def renumber_unit(data, dashboard_name, tab_order):
+    # Returns (position, id offset, is-modified) for each zone that was numbered, the number of
+    # ids used and any errors in the manifest
+    root = parse_unit(data)
+    zones = list(root.iter('zone'))
+    positions = dict((zone, position) for position, zone in enumerate(zones))
+    errors = []
+    numbered = []
+    count = renumber_dashboard(root, WorkbookIndex(root), dashboard_name, tab_order, 0, errors, None, numbered)
+    changes = [(positions[zone], int(zone.get("id")), zone.get("is-modified")) for zone in numbered]
+    return changes, count, errors
+
+
+def iter_addressable_items(index):
+    # The names that get_item can find in each dashboard, as (dashboard, kind, name, zone). Images
+    # are given by their full path, as any ending of it will find them.
+    for (dashboard_name, name), zone in index.views.items():
+        yield dashboard_name, 'view', name, zone
+    for (dashboard_name, caption), zone in index.buttons.items():
+        yield dashboard_name, 'button', caption, zone
+
+    parameter_captions = {}
+    for caption, name in index.parameter_columns.items():
+        parameter_captions.setdefault(PARAMETER_PREFIX + name, []).append(caption)
+    for (dashboard_name, param), zone in index.parameters.items():
+        if param.startswith(PARAMETER_PREFIX + '[') and param.endswith(']'):
+            yield dashboard_name, 'parameter', param[PARAMETER_PREFIX.__len__() + 1:-1], zone
+        for caption in parameter_captions.get(param, []):
+            yield dashboard_name, 'parameter', caption, zone
+    for titles in [index.parameter_titles, index.parameter_titles_v2]:
+        for (dashboard_name, title), zone in titles.items():
+            yield dashboard_name, 'parameter', title, zone
+
+    filter_captions = {}
+    for caption in index.columns:
+        name = get_filter_by_alias(None, caption, index)
+        if name is not None:
+            filter_captions.setdefault(name, []).append(caption)
+    for (dashboard_name, term), zone in index.filters.items():
+        yield dashboard_name, 'filter', term, zone
+        for caption in filter_captions.get(term, []):
+            yield dashboard_name, 'filter', caption, zone
+
+    for (dashboard_name, text), zone in index.texts.items():
+        # Text outside any zone can't be numbered, so get_item goes on to the next resolver
+        if zone is not None:
+            yield dashboard_name, 'text', text, zone
+    for dashboard_name in index.dashboards:
+        # Images in phone and tablet layouts mirror desktop zones and are numbered with them
+        for zone in index.zones.get(dashboard_name, []):
+            if is_image_zone(zone) and zone.get('param') is not None:
+                yield dashboard_name, 'image', zone.get('param'), zone
+    for highlighters in [index.highlighters, index.highlighters_v2]:
+        for (dashboard_name, term), zone in highlighters.items():
+            yield dashboard_name, 'highlighter', 'Highlight ' + term, zone
+
+
+# The kinds of item get_item finds, in the order its resolvers are tried
+ITEM_KINDS = ['view', 'button', 'parameter', 'filter', 'text', 'image', 'highlighter']
+SUGGESTION_SCORE = 0.5
+SUGGESTION_COUNT = 3
+
+
+def get_trigrams(name):
+    padded = '  ' + name.lower() + ' '
+    return set(padded[i:i + 3] for i in range(padded.__len__() - 2))
+
+
+class NameIndex(object):
+    """
+    Names to look up by similarity, indexed by the three letter sequences they contain so
+    that only names sharing some of them with the query are ever compared.
+    """
+
+    def __init__(self, names=()):
+        self.trigrams = {}
+        self.sizes = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if name in self.sizes:
+            return
+        trigrams = get_trigrams(name)
+        self.sizes[name] = trigrams.__len__()
+        for trigram in trigrams:
+            self.trigrams.setdefault(trigram, []).append(name)
+
+    def get_matches(self, query, count=SUGGESTION_COUNT, minimum=SUGGESTION_SCORE):
+        # Names with the highest Dice similarity of trigrams to the query, best first
+        trigrams = get_trigrams(query)
+        shared = {}
+        for trigram in trigrams:
+            for name in self.trigrams.get(trigram, []):
+                shared[name] = shared.get(name, 0) + 1
+        scored = []
+        for name, common in shared.items():
+            score = 2.0 * common / (trigrams.__len__() + self.sizes[name])
+            if score >= minimum and name != query:
+                scored.append((-score, name))
+        return [name for score, name in sorted(scored)[:count]]
+
+
+class ManifestDictionary(object):
+    """
+    Every name a manifest can use in each dashboard, with the kinds of item it names, collected
+    from a WorkbookIndex in one pass. Manifests are checked against it without running the
+    resolvers for each item, and names that can't be found get suggestions from a NameIndex.
+    """
+
+    def __init__(self, index):
+        self.names = OrderedDict()
+        self.images = {}
+        self.name_indexes = {}
+        for dashboard_name in index.dashboards:
+            self.names.setdefault(dashboard_name, OrderedDict())
+        for dashboard_name, kind, name, zone in iter_addressable_items(index):
+            self.add(dashboard_name, kind, name, zone)
+        self.dashboard_index = NameIndex(self.names)
+
+    def add(self, dashboard_name, kind, name, zone):
+        if kind == 'image':
+            # Images can be named by any ending of their path, but their file name is what is suggested
+            self.images.setdefault(dashboard_name, []).append((name, zone))
+            name = name.replace('\\', '/').split('/')[-1]
+        entries = self.names.setdefault(dashboard_name, OrderedDict()).setdefault(name, [])
+        if (kind, zone) not in entries:
+            entries.append((kind, zone))
+        self.name_indexes.setdefault(dashboard_name, NameIndex()).add(name)
+
+    def get_entries(self, dashboard_name, name):
+        # The (kind, zone) pairs a name could mean, in the order get_item would choose them
+        entries = list(self.names.get(dashboard_name, {}).get(name, []))
+        for path, zone in self.images.get(dashboard_name, []):
+            if name and path.endswith(name) and ('image', zone) not in entries:
+                entries.append(('image', zone))
+        entries.sort(key=lambda entry: ITEM_KINDS.index(entry[0]))
+        return entries
+
+    def get_suggestions(self, dashboard_name, name):
+        names = self.names.get(dashboard_name, {})
+        matches = self.name_indexes.get(dashboard_name, NameIndex()).get_matches(name)
+        return [(match, names[match][0][0]) for match in matches]
+
+    def validate(self, configuration):
+        # Returns a message for each item that can't be found, could mean more than one object,
+        # or names an object that an earlier item already named
+        messages = []
+        for dashboard_name in configuration:
+            if dashboard_name not in self.names:
+                message = "ERROR in manifest: dashboard '" + dashboard_name + "' does not exist"
+                matches = self.dashboard_index.get_matches(dashboard_name)
+                if matches:
+                    message += "; did you mean '" + "', '".join(matches) + "'?"
+                messages.append(message)
+                continue
+            named = {}
+            for item in configuration[dashboard_name]:
+                item = item.__str__()
+                entries = self.get_entries(dashboard_name, item)
+                if not entries:
+                    message = "ERROR in manifest: object '" + item + "' does not exist in dashboard '" + \
+                              dashboard_name + "'"
+                    suggestions = self.get_suggestions(dashboard_name, item)
+                    if suggestions:
+                        message += "; did you mean " + ", ".join("'" + match + "' (" + kind + ")"
+                                                                 for match, kind in suggestions) + "?"
+                    messages.append(message)
+                    continue
+                zones = []
+                for kind, zone in entries:
+                    if all(zone is not other for other in zones):
+                        zones.append(zone)
+                if zones.__len__() > 1:
+                    messages.append("WARNING in manifest: '" + item + "' in dashboard '" + dashboard_name +
+                                    "' could be " + describe_kinds(entries) + "; tabfix will use the first " +
+                                    entries[0][0])
+                if zones[0] in named:
+                    messages.append("WARNING in manifest: '" + item + "' in dashboard '" + dashboard_name +
+                                    "' is the same object as '" + named[zones[0]] + "'")
+                else:
+                    named[zones[0]] = item
+        return messages
+
+
+def describe_kinds(entries):
+    # e.g. "a parameter or a filter", or "2 images"
+    counts = OrderedDict()
+    for kind, zone in entries:
+        counts[kind] = counts.get(kind, 0) + 1
+    return " or ".join((('an ' if kind[0] in 'aeiou' else 'a ') + kind) if count == 1 else
+                       (count.__str__() + " " + kind + "s") for kind, count in counts.items())
+
+
+def validate_manifest(tree, configuration, index=None):
+    if index is None:
+        index = WorkbookIndex(tree)
+    return ManifestDictionary(index).validate(configuration)
+
+
+def validate_main(arguments):
+    import argparse
+    argparser = argparse.ArgumentParser(prog='tabfix validate',
+                                        description='Check every item of a manifest against a workbook and '
+                                                    'suggest names for the ones that are not found.')
+    argparser.add_argument('input_path', metavar='<input>', type=str, help='The workbook')
+    argparser.add_argument('manifest_path', metavar='<manifest>', type=str, nargs='?', default=None,
+                           help='The manifest, otherwise the one found next to the workbook')
+    args = argparser.parse_args(arguments)
+
+    manifest_path = args.manifest_path or find_manifest(args.input_path)
+    if manifest_path is None or not os.path.exists(manifest_path):
+        print('Manifest does not exist')
+        return 1
+    messages = validate_manifest(load_workbook(args.input_path), load_manifest(manifest_path) or {})
+    for message in messages:
+        print(message)
+    if any(message.startswith("ERROR") for message in messages):
+        return 1
+    print("Every item in " + manifest_path + " was found")
+    return 0
+
+
+# Attributes that renumbering is expected to change
+FIX_ATTRIBUTES = {'zone': ('id', 'is-modified')}
+
+
+def verify_fix(input_filename, output_filename, configuration=None, max_problems=100):
+    # Checks that the output of fix_tabs differs from its input only where it should, reading both
+    # workbooks side by side rather than loading them
+    problems = []
+    with profile.timer('verify_fix'), open_workbook(input_filename) as before, \
+            open_workbook(output_filename) as after:
+        differences = iter_fix_differences(iterparse(before, events=('start', 'end'), huge_tree=True),
+                                           iterparse(after, events=('start', 'end'), huge_tree=True), configuration)
+        for problem in differences:
+            problems.append(problem)
+            if max_problems is not None and problems.__len__() >= max_problems:
+                break
+    return problems
+
+
+def normalize_text(text):
+    # Whitespace between elements doesn't mean anything to Tableau
+    return '' if text is None or not text.strip() else text
+
+
+def describe_element(element):
+    return "<" + element.tag.__str__() + "> at line " + element.sourceline.__str__()
+
+
+def compare_attributes(before, after):
+    old = dict(before.items())
+    new = dict(after.items())
+    for name in FIX_ATTRIBUTES.get(before.tag, ()):
+        old.pop(name, None)
+        new.pop(name, None)
+    if old == new:
+        return []
+    problems = []
+    for name in sorted(set(old) | set(new)):
+        if old.get(name) == new.get(name):
+            continue
+        if name not in old:
+            problems.append("attribute '" + name + "' was added to " + describe_element(before))
+        elif name not in new:
+            problems.append("attribute '" + name + "' was removed from " + describe_element(before))
+        else:
+            problems.append("attribute '" + name + "' of " + describe_element(before) + " changed from '" +
+                            old[name] + "' to '" + new[name] + "'")
+    return problems
+
+
+def iter_fix_differences(input_events, output_events, configuration=None):
+    # Walks the input and output of a fix in lockstep and yields each difference other than the
+    # zone ids and is-modified flags that renumbering sets. Elements are emptied once they and
+    # their children have been compared, except that dashboards in the manifest are kept until
+    # their ids have been checked against it.
+    configuration = configuration or {}
+    columns = Element('datasources')
+    captions = set()
+    kept = None
+    inputs = iter(input_events)
+    for (event, old), (other_event, new) in itertools.zip_longest(inputs, output_events, fillvalue=(None, None)):
+        if event == 'start' and old.tag == 'devicelayouts' and (other_event != 'start' or new.tag != 'devicelayouts'):
+            # Earlier versions of tabfix removed device layouts rather than renumbering them
+            for skipped_event, element in inputs:
+                if skipped_event == 'end' and element is old:
+                    break
+            old.getparent().remove(old)
+            event, old = next(inputs, (None, None))
+        if old is None or new is None:
+            if old is not None:
+                yield "the output ends before " + describe_element(old) + " of the input"
+            elif new is not None:
+                yield "the output has " + describe_element(new) + " after the end of the input"
+            return
+        if event != other_event or old.tag != new.tag:
+            yield describe_element(old) + " in the input is " + describe_element(new) + " in the output"
+            return
+
+        if event == 'start':
+            if old.items() != new.items():
+                for problem in compare_attributes(old, new):
+                    yield problem
+            tag = new.tag
+            if tag == 'column' and new.get('caption') is not None and new.get('name') is not None:
+                # Parameters and filters are found by column caption when checking the manifest order
+                if new.get('caption') not in captions:
+                    captions.add(new.get('caption'))
+                    SubElement(columns, 'column', {'caption': new.get('caption'), 'name': new.get('name')})
+            elif tag == 'dashboard' and kept is None and new.get('name') in configuration:
+                kept = new
+            continue
+
+        if old.text != new.text and normalize_text(old.text) != normalize_text(new.text):
+            yield "text of " + describe_element(old) + " changed"
+        for before, after in zip(old, new):
+            if before.tail != after.tail and normalize_text(before.tail) != normalize_text(after.tail):
+                yield "text after " + describe_element(before) + " changed"
+        if new is kept:
+            for problem in verify_manifest_order(new, columns, configuration[new.get('name')]):
+                yield problem
+            kept = None
+        old.clear(keep_tail=True)
+        if kept is None:
+            new.clear(keep_tail=True)
+
+
+def verify_manifest_order(dashboard, columns, tab_order):
+    # The zones named in the manifest should have consecutive ids in manifest order
+    index = WorkbookIndex(Element('workbook'))
+    index.add_columns(columns)
+    index.add_dashboard(dashboard)
+    dashboard_name = dashboard.get('name')
+    problems = []
+    previous = None
+    for item in tab_order:
+        zone = get_item(None, dashboard_name, item, index)
+        if zone is None:
+            continue
+        zone_id = int(zone.get('id'))
+        if previous is not None and zone_id != previous + 1:
+            problems.append("'" + item + "' in dashboard '" + dashboard_name + "' has id " + zone_id.__str__() +
+                            " but follows id " + previous.__str__() + " in the manifest")
+        if zone.get('is-modified') != '1':
+            problems.append("'" + item + "' in dashboard '" + dashboard_name + "' is not marked as modified")
+        previous = zone_id
+    return problems
+
+
+def verify_main(arguments):
+    import argparse
+    argparser = argparse.ArgumentParser(prog='tabfix verify',
+                                        description='Check that a fixed workbook only differs from the original in '
+                                                    'its zone ids, and that they follow the manifest.')
+    argparser.add_argument('input_path', metavar='<input>', type=str, help='The original workbook')
+    argparser.add_argument('output_path', metavar='<output>', type=str, help='The fixed workbook')
+    argparser.add_argument('manifest_path', metavar='<manifest>', type=str, nargs='?', default=None,
+                           help='The manifest the workbook was fixed with')
+    argparser.add_argument('--max-problems', metavar='<count>', type=int, default=100,
+                           help='Stop once this many problems have been found')
+    args = argparser.parse_args(arguments)
+
+    configuration = None if args.manifest_path is None else load_manifest(args.manifest_path)
+    problems = verify_fix(args.input_path, args.output_path, configuration, args.max_problems)
+    for problem in problems:
+        print("ERROR in output: " + problem)
+    if problems:
+        return 1
+    print("Output workbook only differs from the input in its zone ids")
+    return 0
+
+
+WORKBOOK_EXTENSIONS = ('.twb', '.twbx')
+
+
+def find_workbooks(paths):
+    # Expand directories (recursively) and glob patterns into a sorted list of workbooks
+    workbooks = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, filenames in os.walk(path):
+                for filename in filenames:
+                    if filename.lower().endswith(WORKBOOK_EXTENSIONS):
+                        workbooks.add(os.path.join(directory, filename))
+        else:
+            for filename in glob.glob(path, recursive=True):
+                if os.path.isfile(filename) and filename.lower().endswith(WORKBOOK_EXTENSIONS):
+                    workbooks.add(filename)
+    return sorted(workbooks)
+
+
+def find_manifest(workbook_path):
+    # Prefer a manifest named after the workbook, then a shared manifest.yaml in the same folder
+    directory = os.path.dirname(workbook_path)
+    name = os.path.splitext(os.path.basename(workbook_path))[0]
+    for candidate in [name + '.yaml', name + '.yml', 'manifest.yaml', 'manifest.yml']:
+        manifest_path = os.path.join(directory, candidate)
+        if os.path.exists(manifest_path):
+            return manifest_path
+    return None
+
+
+def get_batch_output_path(workbook_path, output_dir, root):
+    return os.path.join(output_dir, os.path.relpath(workbook_path, root))
+
+
+def process_workbook(input_path, output_path=None, manifest_path=None, streaming=False):
+    # Runs in a worker process, so any failure is reported in the result rather than raised. A
+    # workbook that should be fixed but has no manifest is only checked, with the status "no manifest".
+    result = {
+        "workbook": input_path,
+        "manifest": manifest_path,
+        "output": None,
+        "status": "ok",
+        "error": None,
+        "seconds": 0,
+        "warnings": [],
+        "errors": []
+    }
+    start = time.perf_counter()
+    try:
+        if output_path is not None and manifest_path is not None:
+            tree = load_workbook(input_path)
+            result["warnings"] = check_accessibility_in_tree(tree)
+            tree = fix_tabs_in_tree(tree, load_manifest(manifest_path), result["errors"], log=None)
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+            save_workbook(tree, output_path, input_path)
+            result["output"] = output_path
+        else:
+            if output_path is not None:
+                result["status"] = "no manifest"
+            result["warnings"] = check_accessibility(input_path, streaming)
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = type(e).__name__ + ": " + str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def batch(paths, output_dir=None, check_only=False, workers=None, streaming=False):
+    workbooks = find_workbooks(paths)
+    if workbooks.__len__() == 0:
+        return []
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(workbook)) for workbook in workbooks])
+
+    # Start the largest workbooks first so one giant file doesn't leave the other workers idle at the end
+    scheduled = sorted(workbooks, key=lambda workbook: os.path.getsize(workbook), reverse=True)
+    results = {}
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for workbook in scheduled:
+            manifest_path = None
+            output_path = None
+            if not check_only and output_dir is not None:
+                manifest_path = find_manifest(workbook)
+                output_path = get_batch_output_path(os.path.abspath(workbook), output_dir, root)
+            futures[workbook] = executor.submit(process_workbook, workbook, output_path, manifest_path, streaming)
+        for workbook in scheduled:
+            try:
+                results[workbook] = futures[workbook].result()
+            except Exception as e:
+                # The worker itself died, e.g. it ran out of memory
+                results[workbook] = {
+                    "workbook": workbook, "manifest": None, "output": None, "status": "error",
+                    "error": type(e).__name__ + ": " + str(e), "seconds": 0, "warnings": [], "errors": []
+                }
+    return [results[workbook] for workbook in workbooks]
+
+
+def write_batch_report(results, report_path):
+    report = {
+        "workbooks": results.__len__(),
+        "errors": [result["status"] for result in results].count("error"),
+        "missing_manifests": [result["status"] for result in results].count("no manifest"),
+        "manifest_errors": sum(result["errors"].__len__() for result in results),
+        "warnings": sum(result["warnings"].__len__() for result in results),
+        "results": [dict(result, warnings=as_dicts(result["warnings"])) for result in results]
+    }
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def batch_main(arguments):
+    import argparse
+    argparser = argparse.ArgumentParser(prog='tabfix batch',
+                                        description='Check and fix many Tableau workbooks in parallel.')
+    argparser.add_argument('paths', metavar='<path>', type=str, nargs='+',
+                           help='Workbooks, directories or glob patterns to process')
+    argparser.add_argument('-o', metavar='<output directory>', type=str, default=None,
+                           help='Write fixed workbooks to this directory, using the manifest found next to '
+                                'each workbook')
+    argparser.add_argument('-t', action='store_true',
+                           help='Just check for issues without modifying focus order')
+    argparser.add_argument('-j', metavar='<workers>', type=int, default=None,
+                           help='The number of worker processes (defaults to the number of CPUs)')
+    argparser.add_argument('-r', metavar='<report>', type=str, default='batch_report.json',
+                           help='The report file name')
+    argparser.add_argument('-s', action='store_true',
+                           help='Check for issues using a streaming parser that uses less memory')
+    args = argparser.parse_args(arguments)
+
+    results = batch(args.paths, args.o, args.t, args.j, args.s)
+    for result in results:
+        if result["status"] == "error":
+            print(result["workbook"] + ": ERROR " + result["error"])
+            continue
+        print(result["workbook"] + ": " + result["warnings"].__len__().__str__() + " issues in " +
+              result["seconds"].__str__() + "s" + ("" if result["status"] == "ok" else ", " + result["status"]))
+        for error in result["errors"]:
+            print(result["workbook"] + ": " + error)
+    report = write_batch_report(results, args.r)
+    print("Processed " + report["workbooks"].__str__() + " workbooks with " + report["errors"].__str__() +
+          " errors, " + report["missing_manifests"].__str__() + " missing manifests and " +
+          report["manifest_errors"].__str__() + " manifest errors; report saved in " + args.r)
+    if report["errors"] or report["missing_manifests"] or report["manifest_errors"]:
+        return 1
+    return 0
+
+
+CATALOG_VERSION = '1'
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS workbooks (id INTEGER PRIMARY KEY, path TEXT UNIQUE, folder TEXT, hash TEXT,
+                                      size INTEGER, mtime_ns INTEGER, error TEXT);
+CREATE TABLE IF NOT EXISTS dashboards (id INTEGER PRIMARY KEY,
+                                       workbook_id INTEGER REFERENCES workbooks (id) ON DELETE CASCADE, name TEXT);
+CREATE TABLE IF NOT EXISTS items (dashboard_id INTEGER REFERENCES dashboards (id) ON DELETE CASCADE, kind TEXT,
+                                  name TEXT, zone_id TEXT);
+CREATE TABLE IF NOT EXISTS warnings (workbook_id INTEGER REFERENCES workbooks (id) ON DELETE CASCADE, code TEXT,
+                                     dashboard TEXT, item TEXT, message TEXT);
+CREATE INDEX IF NOT EXISTS dashboards_by_workbook ON dashboards (workbook_id, name);
+CREATE INDEX IF NOT EXISTS items_by_name ON items (name, kind);
+CREATE INDEX IF NOT EXISTS items_by_dashboard ON items (dashboard_id, name);
+CREATE INDEX IF NOT EXISTS warnings_by_workbook ON warnings (workbook_id, code);
+CREATE INDEX IF NOT EXISTS warnings_by_code ON warnings (code);
+"""
+CATALOG_COUNTS = {
+    'code': "warnings.code",
+    'folder': "workbooks.folder",
+    'workbook': "workbooks.path",
+    'dashboard': "workbooks.path || ': ' || warnings.dashboard"
+}
+
+
+def get_file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def catalog_workbook(input_path):
+    # Runs in a worker process, so any failure is reported in the result rather than raised
+    result = {"dashboards": [], "items": [], "warnings": [], "error": None}
+    try:
+        tree = load_workbook(input_path)
+        index = WorkbookIndex(tree)
+        result["dashboards"] = list(index.dashboards)
+        seen = set()
+        for dashboard_name, kind, name, zone in iter_addressable_items(index):
+            zone_id = None if zone is None else zone.get('id')
+            if (dashboard_name, kind, name, zone_id) not in seen:
+                seen.add((dashboard_name, kind, name, zone_id))
+                result["items"].append((dashboard_name, kind, name, zone_id))
+        result["warnings"] = [(warning.code, warning.dashboard, warning.item, warning.message)
+                              for warning in check_accessibility_in_tree(tree)]
+    except Exception as e:
+        result["error"] = type(e).__name__ + ": " + str(e)
+    return result
+
+
+class WorkbookCatalog(object):
+    """
+    A SQLite database of the dashboards, the items that a manifest can name and the warnings of
+    many workbooks. Workbooks are only read again when their content has changed, and questions
+    about the whole collection, including whether manifests still match, are answered from the
+    database alone.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        with self.connection:
+            self.connection.executescript(CATALOG_SCHEMA)
+            # Results from another version of tabfix, or another set of rules, can't be reused
+            signature = CATALOG_VERSION + '|' + ','.join(get_rule_codes())
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+            if row is None or row[0] != signature:
+                self.connection.execute("DELETE FROM workbooks")
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def update(self, paths, workers=None):
+        # Adds new and changed workbooks found in paths, and forgets workbooks that no longer exist
+        counts = OrderedDict([("added", 0), ("updated", 0), ("unchanged", 0), ("removed", 0)])
+        known = dict((row[0], row[1:]) for row in self.connection.execute(
+            "SELECT path, id, hash, size, mtime_ns FROM workbooks"))
+        workbooks = [os.path.abspath(workbook) for workbook in find_workbooks(paths)]
+        changed = []
+        for workbook in workbooks:
+            stat = os.stat(workbook)
+            entry = known.get(workbook)
+            if entry is not None and entry[2] == stat.st_size and entry[3] == stat.st_mtime_ns:
+                counts["unchanged"] += 1
+                continue
+            digest = get_file_hash(workbook)
+            if entry is not None and entry[1] == digest:
+                with self.connection:
+                    self.connection.execute("UPDATE workbooks SET size = ?, mtime_ns = ? WHERE id = ?",
+                                            (stat.st_size, stat.st_mtime_ns, entry[0]))
+                counts["unchanged"] += 1
+                continue
+            changed.append((workbook, digest, stat))
+            counts["updated" if entry is not None else "added"] += 1
+
+        if workers is not None and workers > 1 and changed.__len__() > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(workers) as executor:
+                for (workbook, digest, stat), result in zip(changed, executor.map(
+                        catalog_workbook, [entry[0] for entry in changed])):
+                    self.put(workbook, digest, stat, result)
+        else:
+            for workbook, digest, stat in changed:
+                self.put(workbook, digest, stat, catalog_workbook(workbook))
+
+        for workbook in known:
+            if not os.path.exists(workbook):
+                with self.connection:
+                    self.connection.execute("DELETE FROM workbooks WHERE path = ?", (workbook,))
+                counts["removed"] += 1
+        return counts
+
+    def put(self, workbook, digest, stat, result):
+        # Each workbook is committed on its own so an interrupted update keeps what it has done
+        with self.connection:
+            self.connection.execute("DELETE FROM workbooks WHERE path = ?", (workbook,))
+            workbook_id = self.connection.execute(
+                "INSERT INTO workbooks (path, folder, hash, size, mtime_ns, error) VALUES (?, ?, ?, ?, ?, ?)",
+                (workbook, os.path.dirname(workbook), digest, stat.st_size, stat.st_mtime_ns,
+                 result["error"])).lastrowid
+            dashboard_ids = {}
+            for dashboard_name in result["dashboards"]:
+                dashboard_ids[dashboard_name] = self.connection.execute(
+                    "INSERT INTO dashboards (workbook_id, name) VALUES (?, ?)",
+                    (workbook_id, dashboard_name)).lastrowid
+            self.connection.executemany(
+                "INSERT INTO items (dashboard_id, kind, name, zone_id) VALUES (?, ?, ?, ?)",
+                [(dashboard_ids[dashboard_name], kind, name, zone_id)
+                 for dashboard_name, kind, name, zone_id in result["items"]])
+            self.connection.executemany(
+                "INSERT INTO warnings (workbook_id, code, dashboard, item, message) VALUES (?, ?, ?, ?, ?)",
+                [(workbook_id,) + tuple(warning) for warning in result["warnings"]])
+
+    def get_workbooks(self):
+        return [row[0] for row in self.connection.execute("SELECT path FROM workbooks ORDER BY path")]
+
+    def find_items(self, name, kind=None):
+        query = "SELECT workbooks.path, dashboards.name, items.kind, items.name, items.zone_id FROM items " \
+                "JOIN dashboards ON dashboards.id = items.dashboard_id " \
+                "JOIN workbooks ON workbooks.id = dashboards.workbook_id WHERE items.name = ?"
+        parameters = [name]
+        if kind is not None:
+            query += " AND items.kind = ?"
+            parameters.append(kind)
+        query += " ORDER BY workbooks.path, dashboards.id"
+        return [{"workbook": row[0], "dashboard": row[1], "kind": row[2], "name": row[3], "zone_id": row[4]}
+                for row in self.connection.execute(query, parameters)]
+
+    def validate_manifest(self, workbook, configuration):
+        # Gives the same errors as fixing the workbook with the manifest would, or None if the
+        # workbook isn't in the catalog
+        row = self.connection.execute("SELECT id FROM workbooks WHERE path = ?",
+                                      (os.path.abspath(workbook),)).fetchone()
+        if row is None:
+            return None
+        errors = []
+        for dashboard_name in configuration:
+            dashboard = self.connection.execute("SELECT id FROM dashboards WHERE workbook_id = ? AND name = ?",
+                                                (row[0], dashboard_name)).fetchone()
+            for item in configuration[dashboard_name]:
+                found = dashboard is not None and self.connection.execute(
+                    "SELECT 1 FROM items WHERE dashboard_id = ? AND (name = ? OR (kind = 'image' AND "
+                    "length(?) > 0 AND substr(name, -length(?)) = ?)) LIMIT 1",
+                    (dashboard[0], item, item, item, item)).fetchone() is not None
+                if not found:
+                    errors.append("ERROR in manifest: object '" + item.__str__() + "' does not exist in dashboard '" +
+                                  dashboard_name + "'")
+        return errors
+
+    def validate_manifests(self):
+        # Checks the manifest found next to each workbook in the catalog, as batch would use
+        results = OrderedDict()
+        for workbook in self.get_workbooks():
+            manifest_path = find_manifest(workbook)
+            if manifest_path is not None:
+                results[workbook] = (manifest_path,
+                                     self.validate_manifest(workbook, load_manifest(manifest_path) or {}))
+        return results
+
+    def count_warnings(self, by='code', code=None):
+        query = "SELECT " + CATALOG_COUNTS[by] + ", count(*) FROM warnings " \
+                "JOIN workbooks ON workbooks.id = warnings.workbook_id"
+        parameters = []
+        if code is not None:
+            query += " WHERE warnings.code = ?"
+            parameters.append(code)
+        query += " GROUP BY 1 ORDER BY 1"
+        return OrderedDict(self.connection.execute(query, parameters).fetchall())
+
+
+def catalog_main(arguments):
+    import argparse
+    argparser = argparse.ArgumentParser(prog='tabfix catalog',
+                                        description='Keep a SQLite catalog of the dashboards, items and issues of '
+                                                    'many workbooks, and answer questions from it.')
+    argparser.add_argument('database', metavar='<database>', type=str, help='The catalog file')
+    argparser.add_argument('paths', metavar='<path>', type=str, nargs='*',
+                           help='Workbooks, directories or glob patterns to add or update')
+    argparser.add_argument('-j', metavar='<workers>', type=int, default=None,
+                           help='Read changed workbooks using this many processes')
+    argparser.add_argument('--find', metavar='<name>', type=str, default=None,
+                           help='List the dashboards with an item of this name, e.g. a parameter')
+    argparser.add_argument('--kind', choices=['view', 'button', 'parameter', 'filter', 'text', 'image',
+                                              'highlighter'], default=None,
+                           help='Only find items of this kind')
+    argparser.add_argument('--validate', action='store_true',
+                           help='Check the manifest next to each workbook against the catalog')
+    argparser.add_argument('--count', choices=list(CATALOG_COUNTS), default=None,
+                           help='Count issues by code, folder, workbook or dashboard')
+    argparser.add_argument('--code', metavar='<code>', type=str, default=None,
+                           help='Only count issues with this code, e.g. A6')
+    args = argparser.parse_args(arguments)
+
+    status = 0
+    with WorkbookCatalog(args.database) as catalog:
+        if args.paths:
+            counts = catalog.update(args.paths, args.j)
+            print("Catalog " + args.database + ": " +
+                  ", ".join(count.__str__() + " " + name for name, count in counts.items()))
+        if args.find is not None:
+            for item in catalog.find_items(args.find, args.kind):
+                print(item["workbook"] + ": " + item["kind"] + " '" + item["name"] + "' in dashboard '" +
+                      item["dashboard"] + "'")
+        if args.validate:
+            for workbook, (manifest_path, errors) in catalog.validate_manifests().items():
+                for error in errors:
+                    print(workbook + " (" + manifest_path + "): " + error)
+                if errors:
+                    status = 1
+        if args.count is not None:
+            code = None if args.code is None else args.code.strip().upper()
+            for key, count in catalog.count_warnings(args.count, code).items():
+                print(key + ": " + count.__str__())
+    return status
+
+
+DEFAULT_SERVER_PORT = 8765
+DEFAULT_SERVER_MEMORY = 1024 * 1024 * 1024
+
+
+def get_workbook_size(input_filename):
+    # The size of the workbook XML, which is roughly proportional to the memory its tree uses
+    if is_packaged_workbook(input_filename):
+        with ZipFile(input_filename) as archive:
+            return get_packaged_workbook_info(archive).file_size
+    return os.path.getsize(input_filename)
+
+
+class WorkbookCache(object):
+    """
+    Parsed workbooks kept in memory, keyed by path, modification time and size so that a
+    saved workbook is parsed again. The least recently used trees are dropped once the
+    workbooks held add up to more than max_size bytes of XML.
+    """
+
+    def __init__(self, max_size=DEFAULT_SERVER_MEMORY):
+        self.max_size = max_size
+        self.trees = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_size(self):
+        return sum(entry[1] for entry in self.trees.values())
+
+    def get(self, input_filename):
+        path = os.path.abspath(input_filename)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        if key in self.trees:
+            self.trees.move_to_end(key)
+            self.hits += 1
+            return self.trees[key][0]
+
+        self.misses += 1
+        for old_key in [old_key for old_key in self.trees if old_key[0] == path]:
+            del self.trees[old_key]
+        tree = load_workbook(path)
+        self.trees[key] = (tree, get_workbook_size(path))
+        while self.trees.__len__() > 1 and self.get_size() > self.max_size:
+            self.trees.popitem(last=False)
+        return tree
+
+    def status(self):
+        return {
+            "workbooks": [key[0] for key in self.trees],
+            "size": self.get_size(),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+def parse_manifest(manifest):
+    # Manifests can be sent as YAML or JSON text, or as an already decoded object
+    if isinstance(manifest, str):
+        from yaml import load, loader
+        return load(manifest, Loader=loader.SafeLoader)
+    return manifest
+
+
+class TabfixRequestHandler(object):
+    """
+    Answers check and fix requests sent as JSON to POST /check and POST /fix, and reports
+    the workbook cache at GET /status. create_server mixes it into BaseHTTPRequestHandler,
+    so http.server is only imported when a server is started.
+
+    Every request must carry the server's token in an X-Tabfix-Token header and POST bodies
+    must be sent as application/json. A web page can only send either of these after a CORS
+    preflight, which the server never answers, so pages open in a browser cannot drive it.
+    """
+
+    def is_authorized(self):
+        import hmac
+        token = self.headers.get('X-Tabfix-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), self.server.token.encode('utf-8')):
+            self.send_json(401, {"error": "Missing or wrong X-Tabfix-Token header"})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.is_authorized():
+            return
+        if self.path == '/status':
+            self.send_json(200, self.server.workbooks.status())
+        else:
+            self.send_json(404, {"error": "Unknown path " + self.path})
+
+    def do_POST(self):
+        if not self.is_authorized():
+            return
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self.send_json(415, {"error": "Requests must be sent as application/json"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            start = time.perf_counter()
+            if self.path == '/check':
+                response = self.check(request)
+            elif self.path == '/fix':
+                response = self.fix(request)
+            else:
+                self.send_json(404, {"error": "Unknown path " + self.path})
+                return
+            response["seconds"] = round(time.perf_counter() - start, 4)
+            self.send_json(200, response)
+        except Exception as e:
+            self.send_json(400, {"error": type(e).__name__ + ": " + str(e)})
+
+    def check(self, request):
+        tree = self.server.workbooks.get(request["workbook"])
+        return {"warnings": as_dicts(check_accessibility_in_tree(tree, request.get("rules"),
+                                                                 request.get("max_warnings")))}
+
+    def fix(self, request):
+        manifest = request.get("manifest")
+        if manifest is None:
+            configuration = load_manifest(request["manifest_path"])
+        else:
+            configuration = parse_manifest(manifest)
+        output = self.get_output_path(request["output"])
+        # Fix a copy so the cached tree stays as it was read from disk
+        tree = copy.deepcopy(self.server.workbooks.get(request["workbook"]))
+        errors = []
+        tree = fix_tabs_in_tree(tree, configuration, errors)
+        save_workbook(tree, output, request["workbook"])
+        response = {"output": output, "errors": errors}
+        if request.get("check"):
+            response["warnings"] = as_dicts(check_accessibility_in_tree(tree, request.get("rules"),
+                                                                        request.get("max_warnings")))
+        return response
+
+    def get_output_path(self, output):
+        # Fixed workbooks can only be written inside the server's output folder
+        output_dir = self.server.output_dir
+        path = os.path.realpath(os.path.join(output_dir, output))
+        if os.path.commonpath([path, output_dir]) != output_dir:
+            raise ValueError("Output " + output + " is not inside " + output_dir)
+        return path
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', data.__len__().__str__())
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(TabfixRequestHandler, self).log_message(format, *args)
+
+
+def create_server(port=DEFAULT_SERVER_PORT, max_size=DEFAULT_SERVER_MEMORY, host='127.0.0.1', verbose=False,
+                  token=None, output_dir=None):
+    # Requests are handled one at a time, so cached trees are never used by two requests at once.
+    # Without a token a new one is made for each run; output_dir defaults to the current folder
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import secrets
+    handler = type('TabfixHTTPRequestHandler', (TabfixRequestHandler, BaseHTTPRequestHandler), {})
+    server = HTTPServer((host, port), handler)
+    server.workbooks = WorkbookCache(max_size)
+    server.verbose = verbose
+    server.token = token if token else secrets.token_urlsafe(24)
+    server.output_dir = os.path.realpath(output_dir if output_dir is not None else os.getcwd())
+    return server
+
+
+def request_server(command, request=None, port=DEFAULT_SERVER_PORT, host='127.0.0.1', token=None):
+    # A minimal client for the server; command is 'check', 'fix' or 'status'
+    url = 'http://' + host + ':' + port.__str__() + '/' + command
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+    data = None if request is None else json.dumps(request).encode('utf-8')
+    headers = {'Content-Type': 'application/json', 'X-Tabfix-Token': token or ''}
+    try:
+        with urlopen(Request(url, data=data, headers=headers)) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except HTTPError as e:
+        return json.loads(e.read().decode('utf-8'))
+
+
+def serve_main(arguments):
+    import argparse
+    argparser = argparse.ArgumentParser(prog='tabfix serve',
+                                        description='Check and fix workbooks from a local server that keeps them '
+                                                    'parsed between requests.')
+    argparser.add_argument('-p', metavar='<port>', type=int, default=DEFAULT_SERVER_PORT,
+                           help='The port to listen on')
+    argparser.add_argument('-m', metavar='<megabytes>', type=int, default=DEFAULT_SERVER_MEMORY // (1024 * 1024),
+                           help='The total size of workbooks to keep parsed')
+    argparser.add_argument('-o', metavar='<directory>', type=str, default=None,
+                           help='The folder fixed workbooks may be written to, by default the current folder')
+    argparser.add_argument('--token', metavar='<token>', type=str, default=None,
+                           help='The token requests must send, otherwise a new one is made and shown')
+    argparser.add_argument('-v', action='store_true',
+                           help='Log every request')
+    args = argparser.parse_args(arguments)
+
+    server = create_server(args.p, args.m * 1024 * 1024, verbose=args.v, token=args.token, output_dir=args.o)
+    print("Listening on http://127.0.0.1:" + args.p.__str__())
+    print("Fixed workbooks will be written in " + server.output_dir)
+    if args.token is None:
+        print("Send this token in the X-Tabfix-Token header of every request: " + server.token)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class DashboardResults(object):
+    """
+    The warnings for each dashboard of one workbook, keyed as in ResultCache. Used in place of a
+    ResultCache by check_accessibility_cached, it only keeps the dashboards seen in the latest
+    check, so the results held for a workbook never grow beyond its current dashboards.
+    """
+
+    def __init__(self):
+        self.previous = {}
+        self.current = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        warnings = self.previous.get(key)
+        if warnings is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.current[key] = warnings
+        return warnings
+
+    def put(self, key, warnings):
+        self.current[key] = warnings
+
+    def put_all(self, entries):
+        for key, warnings in entries:
+            self.put(key, warnings)
+
+    def start(self):
+        self.hits = 0
+        self.misses = 0
+        self.current = {}
+
+    def finish(self):
+        self.previous = self.current
+        self.current = {}
+
+
+def get_warning_key(warning):
+    return warning["code"], warning["dashboard"], warning["item"], warning["message"]
+
+
+def get_warning_delta(previous, current):
+    # Returns the warnings that are new and the warnings that have been resolved
+    previous_keys = set(get_warning_key(warning) for warning in previous)
+    current_keys = set(get_warning_key(warning) for warning in current)
+    new = [warning for warning in current if get_warning_key(warning) not in previous_keys]
+    resolved = [warning for warning in previous if get_warning_key(warning) not in current_keys]
+    return new, resolved
+
+
+class WatchedWorkbook(object):
+    """
+    What the watcher remembers about a workbook between saves. Parsed trees are not kept, as a
+    saved workbook has to be parsed again anyway; only the per-dashboard results are.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stat = None
+        self.pending = None
+        self.changed_at = None
+        self.warnings = []
+        self.results = DashboardResults()
+
+
+class WorkbookWatcher(object):
+    """
+    Polls workbooks for changes and checks them again once they have stopped changing for
+    debounce seconds, only checking the dashboards that changed. poll returns a dict for each
+    workbook checked with the warnings that are new and that have been resolved.
+    """
+
+    def __init__(self, paths, codes=None, debounce=0.5):
+        self.paths = paths
+        self.codes = codes
+        self.debounce = debounce
+        self.workbooks = {}
+
+    def poll(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        changes = []
+        found = find_workbooks(self.paths)
+        for path in [path for path in self.workbooks if path not in found]:
+            changes.append({"workbook": path, "status": "removed", "error": None, "changed": 0,
+                            "new": [], "resolved": self.workbooks.pop(path).warnings})
+        for path in found:
+            workbook = self.workbooks.setdefault(path, WatchedWorkbook(path))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature == workbook.stat:
+                workbook.pending = None
+                continue
+            if signature != workbook.pending:
+                # Wait for the file to stop changing before reading it
+                workbook.pending = signature
+                workbook.changed_at = now
+            if now - workbook.changed_at < self.debounce:
+                continue
+            changes.append(self.check(workbook, signature))
+        return changes
+
+    def check(self, workbook, signature):
+        workbook.stat = signature
+        workbook.pending = None
+        workbook.results.start()
+        try:
+            tree = load_workbook(workbook.path)
+            warnings = check_accessibility_cached(tree, workbook.results, self.codes)
+        except Exception as e:
+            # Usually a workbook that is still being saved; it is checked again when it next changes
+            return {"workbook": workbook.path, "status": "error", "error": type(e).__name__ + ": " + str(e),
+                    "changed": 0, "new": [], "resolved": []}
+        workbook.results.finish()
+        new, resolved = get_warning_delta(workbook.warnings, warnings)
+        workbook.warnings = warnings
+        return {"workbook": workbook.path, "status": "ok", "error": None, "changed": workbook.results.misses,
+                "new": new, "resolved": resolved}
+
+    def watch(self, interval=1.0, report=print):
+        while True:
+            for change in self.poll():
+                report(format_watch_change(change))
+            time.sleep(interval)
+
+
+def format_watch_change(change):
+    if change["status"] == "error":
+        return change["workbook"] + ": ERROR " + change["error"]
+    if change["status"] == "removed":
+        lines = [change["workbook"] + ": removed"]
+    else:
+        lines = [change["workbook"] + ": " + change["changed"].__str__() + " dashboards checked, " +
+                 change["new"].__len__().__str__() + " new, " + change["resolved"].__len__().__str__() +
+                 " resolved"]
+    lines.extend("  + " + warning["message"] for warning in change["new"])
+    lines.extend("  - " + warning["message"] for warning in change["resolved"])
+    return "\n".join(lines)
+
+
+def watch_main(arguments):
+    import argparse
+    argparser = argparse.ArgumentParser(prog='tabfix --watch',
+                                        description='Check workbooks again every time they are saved.')
+    argparser.add_argument('paths', metavar='<path>', type=str, nargs='+',
+                           help='Workbooks, directories or glob patterns to watch')
+    argparser.add_argument('--rules', metavar='<codes>', type=str, default=None,
+                           help='Only check for these issues, e.g. A4,B3')
+    argparser.add_argument('-i', metavar='<seconds>', type=float, default=1.0,
+                           help='How often to look for changes')
+    argparser.add_argument('-d', metavar='<seconds>', type=float, default=0.5,
+                           help='How long a workbook must be unchanged before it is checked')
+    args = argparser.parse_args(arguments)
+
+    codes = None
+    if args.rules is not None:
+        codes = [code.strip().upper() for code in args.rules.split(',') if code.strip()]
+    watcher = WorkbookWatcher(args.paths, codes, args.d)
+    print("Watching " + ', '.join(args.paths) + " for changes, press Ctrl+C to stop")
+    try:
+        watcher.watch(args.i)
+    except KeyboardInterrupt:
+        pass
+
+
+def main(arguments=None):
+    import argparse
+    if arguments is None:
+        arguments = sys.argv[1:]
+    if arguments[:1] == ['batch']:
+        return batch_main(arguments[1:])
+    if arguments[:1] == ['serve']:
+        serve_main(arguments[1:])
+        return
+    if arguments[:1] == ['verify']:
+        return verify_main(arguments[1:])
+    if arguments[:1] == ['catalog']:
+        return catalog_main(arguments[1:])
+    if arguments[:1] == ['validate']:
+        return validate_main(arguments[1:])
+    if '--watch' in arguments:
+        watch_main([argument for argument in arguments if argument != '--watch'])
+        return
 
     argparser = argparse.ArgumentParser(description='Accessibility testing and tab focus order fixer for Tableau.')
     argparser.add_argument('input_path', metavar='<input>', type=str, nargs=1, default='testing.twb',
@@ -313,22 +3459,83 @@ if __name__ == "__main__":
                         help='Just check for issues without modifying focus order')
     argparser.add_argument('-c', action='store_true',
                         help='Output results in CSV format')
-
-    args = argparser.parse_args()
+    argparser.add_argument('-f', action='store_true',
+                        help='Check the fixed output workbook rather than the input workbook')
+    argparser.add_argument('--report', metavar='<report>', type=str, default=None,
+                        help='Save a report of issues found in this file')
+    argparser.add_argument('--report-format', choices=REPORT_FORMATS, default=None,
+                        help='The format of the report, otherwise taken from the file name')
+    argparser.add_argument('-s', action='store_true',
+                        help='Check for issues using a streaming parser that uses less memory')
+    argparser.add_argument('--splice', action='store_true',
+                        help='Write the output by copying the input and only changing the zones that were renumbered')
+    argparser.add_argument('--verify', action='store_true',
+                        help='Check that the output only differs from the input in its zone ids, as tabfix verify does')
+    argparser.add_argument('--rules', metavar='<codes>', type=str, default=None,
+                        help='Only check for these issues, e.g. A4,B3')
+    argparser.add_argument('-j', metavar='<workers>', type=int, default=None,
+                        help='Check and fix dashboards in parallel using this many processes')
+    argparser.add_argument('--summary', choices=['code', 'dashboard', 'worksheet'], default=None,
+                        help='Show the number of issues for each code, dashboard or worksheet instead of every issue')
+    argparser.add_argument('--max-warnings', metavar='<count>', type=int, default=None,
+                        help='Stop checking once this many issues have been found')
+    argparser.add_argument('--profile', metavar='<report>', type=str, nargs='?', const='', default=None,
+                        help='Report where the time was spent, as a table or as JSON if a file name is given')
+    argparser.add_argument('--cache', action='store_true',
+                        help='Reuse the results of dashboards that have not changed since they were last checked')
+    argparser.add_argument('--clear-cache', action='store_true',
+                        help='Remove all cached results before checking')
+    argparser.add_argument('--cache-dir', metavar='<directory>', type=str, default=None,
+                        help='Where to keep cached results, which turns on --cache')
+
+    args = argparser.parse_args(arguments)
 
     # Defaults
     input_path = vars(args)['input_path'][0]
     output_path = vars(args)['output_path']
+    if is_packaged_workbook(input_path) and output_path == 'output.twb':
+        # Keep the extracts and images of a packaged workbook unless asked for a plain .twb
+        output_path = 'output.twbx'
     manifest_path = vars(args)['manifest_path']
     check_only = vars(args)['t']
     csv_output = vars(args)['c']
+    report_path = vars(args)['report']
+    report_format = vars(args)['report_format']
+    if csv_output:
+        report_format = 'csv'
+    if report_path is None and report_format is not None:
+        report_path = 'accessibility_report.' + report_format
+    check_fixed = vars(args)['f']
+    streaming = vars(args)['s']
+    max_warnings = vars(args)['max_warnings']
+    workers = vars(args)['j']
+    summary = vars(args)['summary']
+    codes = None
+    if vars(args)['rules'] is not None:
+        codes = [code.strip().upper() for code in vars(args)['rules'].split(',') if code.strip()]
+        unknown = [code for code in codes if code not in get_rule_codes()]
+        if unknown.__len__() > 0:
+            print('Unknown rules: ' + ', '.join(unknown) + '. Tabfix can check ' + ', '.join(get_rule_codes()))
+            # The same status argparse exits with for other bad arguments
+            return 2
+    profile_path = vars(args)['profile']
+    profile.enabled = profile_path is not None
+    cache = None
+    if vars(args)['cache'] or vars(args)['cache_dir'] is not None:
+        cache = ResultCache(vars(args)['cache_dir'])
+    if vars(args)['clear_cache']:
+        (cache or ResultCache()).clear()
 
     if not os.path.exists(input_path):
         print('Input workbook does not exist')
-        exit()
+        return
     else:
         print("Input workbook: "+input_path)
 
+    tree = None
+    warnings = None
+    problems = []
+
     if check_only:
         print("Only checking for issues, will not create output")
     else:
@@ -337,25 +3544,76 @@ if __name__ == "__main__":
 
         if not os.path.exists(manifest_path) and not check_only:
             print('Manifest does not exist')
-            exit()
+            return
         else:
             print("Manifest: " + manifest_path)
 
+            # Parse the workbook once and share the tree between the checker and the fixer
+            tree = load_workbook(input_path)
+            splice = WorkbookSplice(tree) if vars(args)['splice'] else None
+
+            # Fixing modifies the tree, so check the input first unless asked to check the output
+            if not check_fixed:
+                warnings = check_tree(tree, codes, max_warnings, cache, workers)
+
             # Load the configuration/manifest
             configuration = load_manifest(manifest_path)
-            fix_tabs(input_path, output_path, configuration)
+            tree = fix_tabs_in_tree(tree, configuration, workers=workers)
+            save_workbook(tree, output_path, input_path, splice)
+            if vars(args)['verify']:
+                problems = verify_fix(input_path, output_path, configuration)
+                for problem in problems:
+                    print("ERROR in output: " + problem)
+                if not problems:
+                    print("Output workbook only differs from the input in its zone ids")
+
+    if warnings is None:
+        if tree is None and streaming:
+            warnings = iter_accessibility_streaming(input_path, codes, max_warnings)
+        else:
+            if tree is None:
+                tree = load_workbook(input_path)
+            if cache is None and workers is None:
+                warnings = iter_accessibility_in_tree(tree, codes, max_warnings)
+            else:
+                warnings = check_tree(tree, codes, max_warnings, cache, workers)
+
+    report = None
+    if report_path is not None:
+        print("Saving a report of issues found in " + report_path)
+        report = open_report(report_path, report_format, input_path)
+        warnings = report.write_all(warnings)
+    try:
+        if summary is not None:
+            for key, count in count_warnings(warnings, summary).items():
+                print(key + ": " + count.__str__())
+        else:
+            for warning in warnings:
+                print(warning.get("message"))
+    finally:
+        if report is not None:
+            report.close()
 
-    warnings = check_accessibility(input_path)
-    for warning in warnings:
-        print(warning.get("message"))
+    if cache is not None and not streaming:
+        print("Cached results: " + cache.hits.__str__() + " dashboards reused, " + cache.misses.__str__() +
+              " checked")
 
-    print("Note that this tool cannot check for a number of common accessibility issues (codes A1, A2, A3, A7, B2, "
-          "B4, B5, B6) and you should check these using other methods.")
+    print("Note that this tool cannot check for a number of common accessibility issues (codes A1, A3, B2, "
+          "B4) and you should check these using other methods.")
 
-    if csv_output:
-        print("Saving a report of issues found in accessibility_report.csv")
-        field_names = warnings[0].keys()
-        with open('accessibility_report.csv', 'w', newline='') as csvFile:
-            writer = csv.DictWriter(csvFile, fieldnames=field_names)
-            writer.writeheader()
-            writer.writerows(warnings)
\ No newline at end of file
+    if profile_path == '':
+        print(profile.format_report())
+    elif profile_path is not None:
+        print("Saving a profile of this run in " + profile_path)
+        with open(profile_path, 'w') as f:
+            json.dump(profile.report(), f, indent=2)
+    if problems:
+        return 1
+
+
+if __name__ == "__main__":
+    # The Windows release is frozen with PyInstaller, where worker processes start by running
+    # this file again and have to be handed to multiprocessing before the command line is read
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -1,9 +1,17 @@
 # SPDX-License-Identifier: MIT
 import tabfix
+from benchmarks import workbook_generator
 import lxml
-from lxml.etree import XMLParser, parse
+from lxml.etree import SubElement, XMLParser, parse
 import pytest
+import copy
+import json
 import os
+import shutil
+import subprocess
+import sys
+import threading
+import zipfile
 
 p = XMLParser(huge_tree=True)
 
@@ -161,6 +169,156 @@ def test_check_titles_and_captions(xml_fixture):
         assert (warning.get("code") == 'A6' and warning.get("item") in ["Bar Without Mark Labels", "Sheet 3"]) or warning.get("code") == 'A5'
 
 
+@pytest.fixture
+def colour_fixture():
+    tree = parse(os.path.join(FIXTURE_DIR, 'testing.twb'), parser=p)
+    root = tree.getroot()
+    palette = lxml.etree.SubElement(root.find('preferences'), 'color-palette', {'name': 'Traffic', 'type': 'regular'})
+    for colour in ['#d62728', '#2ca02c', '#1f77b4']:
+        lxml.etree.SubElement(palette, 'color').text = colour
+    pie = [worksheet for worksheet in root.iter('worksheet') if worksheet.get('name') == 'Pie'][0]
+    rule = lxml.etree.SubElement(pie.find('table/style'), 'style-rule', {'element': 'mark'})
+    lxml.etree.SubElement(rule, 'encoding', {'attr': 'color', 'palette': 'Traffic', 'type': 'palette'})
+    rule = lxml.etree.SubElement(pie.find('table/style'), 'style-rule', {'element': 'worksheet'})
+    lxml.etree.SubElement(rule, 'format', {'attr': 'color', 'value': '#aaaaaa'})
+    for zone in root.iter('zone'):
+        run = zone.find('formatted-text/run')
+        if run is not None and run.text == 'Introduction! Read me first!':
+            run.set('fontcolor', '#ffffff')
+            lxml.etree.SubElement(zone.find('zone-style'), 'format', {'attr': 'background-color', 'value': '#eeeeee'})
+    return tree
+
+
+def test_get_contrast_ratios():
+    ratios = tabfix.get_contrast_ratios([(0, 0, 0), (255, 255, 255), (118, 118, 118)], [tabfix.WHITE] * 3)
+    assert [round(ratio, 2) for ratio in ratios] == [21.0, 1.0, 4.54]
+
+
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_check_colour_contrast(colour_fixture, monkeypatch, vectorized):
+    if not vectorized:
+        monkeypatch.setattr(tabfix, 'numpy', None)
+    warnings = tabfix.check_colour_contrast(colour_fixture)
+    assert [(warning["dashboard"], warning["item"]) for warning in warnings] == [
+        ("Dashboard", "Pie"), ("Other Dashboard", "Pie"), ("Dashboard", "Introduction! Read me first!")]
+    assert "1.16:1 (#ffffff on #eeeeee)" in warnings[2]["message"]
+
+
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_check_colour_blindness(colour_fixture, monkeypatch, vectorized):
+    if not vectorized:
+        monkeypatch.setattr(tabfix, 'numpy', None)
+    warnings = tabfix.check_colour_blindness(colour_fixture)
+    assert [warning["dashboard"] for warning in warnings] == ["Dashboard", "Other Dashboard"]
+    assert warnings[0]["message"] == "B5 colours #d62728 and #2ca02c for view 'Pie' in dashboard 'Dashboard' " \
+                                     "are hard to tell apart with deuteranopia"
+
+
+def test_check_colour_cached(colour_fixture, tmp_path):
+    cache = tabfix.ResultCache(str(tmp_path))
+    warnings = tabfix.check_accessibility_cached(colour_fixture, cache, ['A2', 'B5'])
+    assert warnings == tabfix.check_accessibility_in_tree(colour_fixture, ['A2', 'B5'])
+    # Cached results keep the details that say which warnings are about views
+    assert tabfix.check_accessibility_cached(colour_fixture, cache, ['A2', 'B5']) == warnings
+    assert [warning.worksheet for warning in tabfix.check_accessibility_cached(colour_fixture, cache, ['A2'])] == \
+           [warning.worksheet for warning in warnings if warning.code == 'A2']
+
+
+def test_no_colour_issues(xml_fixture):
+    assert tabfix.check_colour_contrast(xml_fixture) == []
+    assert tabfix.check_colour_blindness(xml_fixture) == []
+
+
+@pytest.fixture
+def action_fixture():
+    tree = parse(os.path.join(FIXTURE_DIR, 'testing.twb'), parser=p)
+    root = tree.getroot()
+    actions = lxml.etree.Element('actions')
+    root.find('worksheets').addprevious(actions)
+    action = lxml.etree.SubElement(actions, 'action', {'caption': 'Filter 1', 'name': '[Action1]'})
+    lxml.etree.SubElement(action, 'activation', {'auto-clear': 'true', 'type': 'on-select'})
+    lxml.etree.SubElement(action, 'source', {'dashboard': 'Dashboard', 'type': 'sheet',
+                                             'worksheet': 'Bar With Mark Labels'})
+    command = lxml.etree.SubElement(action, 'command', {'command': 'tsc:tsl-filter'})
+    lxml.etree.SubElement(command, 'param', {'name': 'target', 'value': 'Other Dashboard'})
+    lxml.etree.SubElement(command, 'param', {'name': 'exclude', 'value': 'Pie'})
+    action = lxml.etree.SubElement(actions, 'action', {'caption': 'Highlight 1', 'name': '[Action2]'})
+    lxml.etree.SubElement(action, 'activation', {'type': 'on-hover'})
+    lxml.etree.SubElement(action, 'source', {'dashboard': 'Other Dashboard', 'exclude': 'Pie', 'type': 'sheet'})
+    command = lxml.etree.SubElement(action, 'command', {'command': 'tsc:brush'})
+    lxml.etree.SubElement(command, 'param', {'name': 'target', 'value': 'Other Dashboard'})
+    action = lxml.etree.SubElement(actions, 'action', {'caption': 'Web page', 'name': '[Action3]'})
+    lxml.etree.SubElement(action, 'activation', {'type': 'on-menu'})
+    lxml.etree.SubElement(action, 'source', {'dashboard': 'Other Dashboard', 'type': 'sheet', 'worksheet': 'Sheet 3'})
+    lxml.etree.SubElement(action, 'link', {'expression': 'https://example.com/'})
+    pie = [worksheet for worksheet in root.iter('worksheet') if worksheet.get('name') == 'Pie'][0]
+    lxml.etree.SubElement(pie.find('table'), 'customized-tooltip', {'show-buttons': 'false'})
+    return tree
+
+
+def test_index_actions(action_fixture):
+    index = tabfix.index_actions(action_fixture)
+    assert [action["kind"] for action in index.actions] == ['filter', 'highlight', 'url']
+    assert [action["name"] for action in index.get_actions('Other Dashboard', 'Sheet 3')] == ['[Action2]', '[Action3]']
+    assert index.get_actions('Other Dashboard', 'Pie') == []
+    assert index.get_targets(index.actions[0]) == [('Other Dashboard', 'Bar Without Mark Labels'),
+                                                   ('Other Dashboard', 'Sheet 3')]
+    assert index.get_hidden_commands('Pie') == 'tooltip command buttons are hidden'
+    assert index.is_explained('Dashboard', 'Bar With Mark Labels')
+    assert not index.is_explained('Other Dashboard', 'Sheet 3')
+
+
+def test_check_view_data(action_fixture):
+    warnings = tabfix.check_view_data(action_fixture)
+    assert [(warning["dashboard"], warning["item"]) for warning in warnings] == [
+        ("Dashboard", "Pie"), ("Other Dashboard", "Pie")]
+    assert warnings[0]["message"] == "A7 View Data can't be reached from view 'Pie' in dashboard 'Dashboard' as " \
+                                     "tooltip command buttons are hidden"
+
+
+def test_check_interactions(action_fixture):
+    warnings = tabfix.check_interactions(action_fixture)
+    assert [(warning["dashboard"], warning["item"]) for warning in warnings] == [
+        ("Other Dashboard", "Bar Without Mark Labels"), ("Other Dashboard", "Sheet 3")]
+    assert warnings[1]["message"] == "B6 highlight and url actions of view 'Sheet 3' in dashboard 'Other Dashboard' " \
+                                     "are not explained in text"
+
+
+def test_check_interactions_by_dashboard(action_fixture, tmp_path):
+    expected = tabfix.check_accessibility_in_tree(action_fixture, ['A7', 'B6'])
+    cache = tabfix.ResultCache(str(tmp_path))
+    assert tabfix.check_accessibility_cached(action_fixture, cache, ['A7', 'B6']) == expected
+    assert tabfix.check_accessibility_parallel(action_fixture, ['A7', 'B6'], workers=2) == expected
+    path = str(tmp_path / 'actions.twb')
+    action_fixture.write(path, encoding='utf-8')
+    assert tabfix.check_accessibility(path, streaming=True, codes=['A7', 'B6']) == expected
+
+
+def test_no_interaction_issues(xml_fixture):
+    assert tabfix.check_view_data(xml_fixture) == []
+    assert tabfix.check_interactions(xml_fixture) == []
+
+
+def test_warning_record():
+    warning = tabfix.WarningRecord("B1", "Dashboard", "Pie")
+    assert not hasattr(warning, '__dict__')
+    assert warning == {"code": "B1", "dashboard": "Dashboard", "item": "Pie",
+                       "message": "B1 text is rotated for view 'Pie' in dashboard 'Dashboard'"}
+    assert warning.get("message") == warning.message
+    assert warning.worksheet == "Pie"
+    assert json.loads(json.dumps(warning.as_dict())) == warning
+    assert tabfix.WarningRecord("A4", "Dashboard", "a/b.png").worksheet is None
+    assert tabfix.as_warning_record(warning.as_dict()).text == warning.message
+
+
+def test_count_warnings(xml_fixture_2020):
+    warnings = tabfix.check_accessibility_in_tree(xml_fixture_2020)
+    counts = tabfix.count_warnings(tabfix.iter_accessibility_in_tree(xml_fixture_2020))
+    assert counts == dict((code, [w["code"] for w in warnings].count(code)) for code in set(w["code"] for w in warnings))
+    assert sum(tabfix.count_warnings(warnings, 'dashboard').values()) == warnings.__len__()
+    assert tabfix.count_warnings(warnings, 'worksheet')["Bar Without Mark Labels"] == 3
+
+
 def test_load_manifest():
     assert tabfix.load_manifest(os.path.join(FIXTURE_DIR, 'manifest.yaml')) is not None
 
@@ -198,3 +356,763 @@ def test_fix_tabs_2(xml_fixture_2020):
     assert "101" == p2.get("id")
     assert "100" == p1.get("id")
 
+
+def test_workbook_index(xml_fixture):
+    index = tabfix.WorkbookIndex(xml_fixture)
+    for item in ["Pie", "Region", "Parameter 2", "Parameter 1 Name", "Parameter 1 Title", "1114.jpg",
+                 "navigate to other dashboard", "Introduction! Read me first!"]:
+        assert tabfix.get_item(xml_fixture, "Dashboard", item, index) is tabfix.get_item(xml_fixture, "Dashboard", item)
+    assert tabfix.get_item(xml_fixture, "Dashboard", "Thing that doesnt exist", index) is None
+    assert tabfix.get_item(xml_fixture, "Fake Dashboard", "Pie", index) is None
+    assert tabfix.get_filter(xml_fixture, "Dashboard", "Region", index).get("name") == "Bar With Mark Labels"
+    assert tabfix.get_image(xml_fixture, "Dashboard", "Pictures/1114.jpg", index) is not None
+    assert index.zones["Dashboard"][0].getparent().tag == 'zones'
+
+
+def test_workbook_index_images():
+    # The index finds the same image as the query for any ending of a path, first in document order
+    tree = workbook_generator.generate_workbook(dashboards=1, bitmaps=4)
+    images = [zone for zone in tree.iter('zone') if tabfix.is_image_zone(zone)]
+    for zone, path in zip(images, ['x/aimage1.png', 'Images/image1.png', 'Other/Images/image1.png', 'image2.png']):
+        zone.set('param', path)
+    index = tabfix.WorkbookIndex(tree)
+    queries = tabfix.WorkbookQueries(tree)
+    for path in ['image1.png', 'aimage1.png', '/image1.png', 'Images/image1.png', 'Other/Images/image1.png',
+                 's/image1.png', 'image2.png', '2.png', '', 'image3.png', 'y/image1.png']:
+        assert tabfix.get_image(tree, "Dashboard 1", path, index) is tabfix.get_image(tree, "Dashboard 1", path,
+                                                                                      queries), path
+    assert tabfix.get_image(tree, "Dashboard 1", "Images/image1.png", index) is images[1]
+    assert tabfix.get_image(tree, "Dashboard 2", "image1.png", index) is None
+
+
+def test_check_accessibility():
+    path = os.path.join(FIXTURE_DIR, 'testing.twb')
+    tree = tabfix.load_workbook(path)
+    assert tabfix.check_accessibility(path) == tabfix.check_accessibility_in_tree(tree)
+    assert 10 == tabfix.check_accessibility(path).__len__()
+
+
+def test_fix_tabs_file(tmp_path):
+    output = str(tmp_path / 'output.twb')
+    tree = tabfix.fix_tabs(os.path.join(FIXTURE_DIR, 'testing.twb'), output, {"Dashboard": ["Region", "Pie"]})
+    assert "100" == tabfix.get_item(tree, "Dashboard", "Region").get("id")
+    assert "101" == tabfix.get_item(tabfix.load_workbook(output), "Dashboard", "Pie").get("id")
+
+
+@pytest.mark.parametrize("filename", ['testing.twb', 'testing_2019_4.twb'])
+def test_fix_tabs_spliced(filename, tmp_path):
+    path = os.path.join(FIXTURE_DIR, filename)
+    configuration = tabfix.load_manifest(os.path.join(FIXTURE_DIR, 'manifest.yaml'))
+    serialized = str(tmp_path / 'serialized.twb')
+    spliced = str(tmp_path / 'spliced.twb')
+    tabfix.fix_tabs(path, serialized, configuration)
+    tabfix.fix_tabs(path, spliced, configuration, splice=True)
+    assert lxml.etree.tostring(parse(spliced), method='c14n') == lxml.etree.tostring(parse(serialized), method='c14n')
+    with open(path, 'rb') as f:
+        original = f.read().splitlines()
+    with open(spliced, 'rb') as f:
+        output = f.read().splitlines()
+    # Only zone start tags change
+    changed = [line for line in output if line not in original]
+    assert changed.__len__() > 0
+    assert all(line.lstrip().startswith(b'<zone ') for line in changed)
+
+
+def test_fix_tabs_spliced_packaged(packaged_workbook, tmp_path):
+    output = str(tmp_path / 'output.twbx')
+    tabfix.fix_tabs(packaged_workbook, output, {"Dashboard": ["Region", "Pie"]}, splice=True)
+    with zipfile.ZipFile(output) as target:
+        assert target.testzip() is None
+    assert "101" == tabfix.get_item(tabfix.load_workbook(output), "Dashboard", "Pie").get("id")
+
+
+def test_workbook_splice_mismatch(xml_fixture_2020):
+    splice = tabfix.WorkbookSplice(xml_fixture_2020)
+    with open(os.path.join(FIXTURE_DIR, 'testing_2019_4.twb'), 'rb') as f:
+        assert splice.get_edits(f.read()) is None
+    assert splice.splice_start_tag(b"<zone id='1' is-modified='1'>", ('1', None), ('2', '1')) is None
+    assert splice.splice_start_tag(b'<zone id="1" x="0"/>', ('1', None), ('2', '1')) == \
+        b'<zone id="2" x="0" is-modified="1"/>'
+
+
+@pytest.mark.parametrize("filename", ['testing.twb', 'testing_2019_4.twb'])
+@pytest.mark.parametrize("splice", [False, True])
+def test_verify_fix(filename, splice, tmp_path):
+    path = os.path.join(FIXTURE_DIR, filename)
+    configuration = tabfix.load_manifest(os.path.join(FIXTURE_DIR, 'manifest.yaml'))
+    output = str(tmp_path / 'output.twb')
+    tabfix.fix_tabs(path, output, configuration, splice=splice)
+    assert tabfix.verify_fix(path, output, configuration) == []
+    assert tabfix.verify_fix(path, path) == []
+
+
+def test_verify_fix_problems(xml_fixture_2020, tmp_path):
+    path = os.path.join(FIXTURE_DIR, 'testing.twb')
+    configuration = tabfix.load_manifest(os.path.join(FIXTURE_DIR, 'manifest.yaml'))
+    tree = tabfix.fix_tabs_in_tree(xml_fixture_2020, configuration)
+    zones = list(tree.iter('zone'))
+    zones[0].set('w', '1')
+    zones[1].set('alt-text', 'New')
+    runs = list(tree.iter('run'))
+    runs[0].text = 'Changed'
+    output = str(tmp_path / 'output.twb')
+    tree.write(output, encoding='utf-8')
+    problems = tabfix.verify_fix(path, output, configuration)
+    assert problems == [
+        "text of <run> at line " + runs[0].sourceline.__str__() + " changed",
+        "attribute 'w' of <zone> at line 406 changed from '100000' to '1'",
+        "attribute 'alt-text' was added to <zone> at line 407"]
+
+    # Ids that don't follow the manifest
+    reordered = dict((name, list(reversed(items))) for name, items in configuration.items())
+    problems = tabfix.verify_fix(path, str(tmp_path / 'output.twb'), reordered)
+    assert "'Bar With Mark Labels' in dashboard 'Dashboard' has id 105 but follows id 106 in the manifest" in problems
+
+    zones[2].getparent().remove(zones[2])
+    tree.write(output, encoding='utf-8')
+    problems = tabfix.verify_fix(path, output)
+    assert problems[-1].startswith("<zone> at line 408 in the input is")
+
+
+def test_verify_main(tmp_path, capsys):
+    path = os.path.join(FIXTURE_DIR, 'testing.twb')
+    manifest = os.path.join(FIXTURE_DIR, 'manifest.yaml')
+    output = str(tmp_path / 'output.twb')
+    tabfix.fix_tabs(path, output, tabfix.load_manifest(manifest))
+    assert tabfix.main(['verify', path, output, manifest]) == 0
+    assert tabfix.main(['verify', path, os.path.join(FIXTURE_DIR, 'testing_2019_4.twb')]) == 1
+    assert "ERROR in output" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("filename", ['testing.twb', 'testing_2019_4.twb'])
+def test_check_accessibility_streaming(filename):
+    path = os.path.join(FIXTURE_DIR, filename)
+    assert tabfix.check_accessibility(path, streaming=True) == tabfix.check_accessibility(path)
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_iter_accessibility(streaming):
+    path = os.path.join(FIXTURE_DIR, 'testing.twb')
+    warnings = tabfix.check_accessibility(path)
+    found = tabfix.iter_accessibility(path, streaming)
+    assert next(found) in warnings
+    assert sorted(map(str, tabfix.iter_accessibility(path, streaming))) == sorted(map(str, warnings))
+    assert list(tabfix.iter_accessibility(path, streaming, max_warnings=2)).__len__() == 2
+
+
+@pytest.mark.parametrize("report_format", tabfix.REPORT_FORMATS)
+def test_warning_writers(tmp_path, report_format):
+    path = os.path.join(FIXTURE_DIR, 'testing.twb')
+    warnings = tabfix.check_accessibility(path)
+    report_path = str(tmp_path / ('report.' + report_format))
+    with tabfix.open_report(report_path, workbook=path) as report:
+        found = report.write_all(tabfix.iter_accessibility(path))
+        next(found)
+        # The first warning is in the report before checking has finished
+        with open(report_path) as f:
+            assert warnings[0]["message"] in f.read()
+        assert list(found).__len__() == warnings.__len__() - 1
+    with open(report_path) as f:
+        text = f.read()
+    if report_format == 'csv':
+        assert text.splitlines().__len__() == warnings.__len__() + 1
+    elif report_format == 'jsonl':
+        assert sorted(json.loads(line)["message"] for line in text.splitlines()) == \
+            sorted(warning["message"] for warning in warnings)
+    else:
+        results = json.loads(text)["runs"][0]["results"]
+        assert sorted(result["ruleId"] for result in results) == sorted(warning["code"] for warning in warnings)
+
+
+@pytest.mark.parametrize("report_format", tabfix.REPORT_FORMATS)
+def test_warning_writers_empty(tmp_path, report_format):
+    report_path = str(tmp_path / ('report.' + report_format))
+    with tabfix.open_report(report_path, report_format) as report:
+        assert list(report.write_all([])) == []
+    with open(report_path) as f:
+        text = f.read()
+    if report_format == 'csv':
+        assert text.strip() == 'code,dashboard,item,message'
+    elif report_format == 'jsonl':
+        assert text == ''
+    else:
+        assert json.loads(text)["runs"][0]["results"] == []
+
+
+@pytest.fixture
+def packaged_workbook(tmp_path):
+    path = str(tmp_path / 'testing.twbx')
+    extract = os.path.join(FIXTURE_DIR, 'testing.twb Files', 'Data', 'tableau-temp',
+                           '#TableauTemp_1xbyf5b1hqb7cg1cqs2in187rcvn.hyper')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.write(os.path.join(FIXTURE_DIR, 'testing.twb'), 'testing.twb')
+        archive.write(extract, 'Data/Extracts/extract.hyper')
+        archive.write(extract, 'Data/Extracts/stored.hyper', compress_type=zipfile.ZIP_STORED)
+    return path
+
+
+def test_check_accessibility_packaged(packaged_workbook):
+    expected = tabfix.check_accessibility(os.path.join(FIXTURE_DIR, 'testing.twb'))
+    assert tabfix.check_accessibility(packaged_workbook) == expected
+    assert tabfix.check_accessibility(packaged_workbook, streaming=True) == expected
+
+
+@pytest.mark.parametrize("raw", [True, False])
+def test_fix_tabs_packaged(packaged_workbook, tmp_path, monkeypatch, raw):
+    if not raw:
+        # As if a later Python had changed the parts of ZipFile that raw copies rely on
+        monkeypatch.setattr(tabfix, 'RAW_COPY_ATTRIBUTES', tabfix.RAW_COPY_ATTRIBUTES + ['missing'])
+    output = str(tmp_path / 'output.twbx')
+    tabfix.fix_tabs(packaged_workbook, output, {"Dashboard": ["Region", "Pie"]})
+    with zipfile.ZipFile(packaged_workbook) as source, zipfile.ZipFile(output) as target:
+        assert target.testzip() is None
+        assert [info.filename for info in target.infolist()] == [info.filename for info in source.infolist()]
+        for name in ['Data/Extracts/extract.hyper', 'Data/Extracts/stored.hyper']:
+            assert target.getinfo(name).compress_type == source.getinfo(name).compress_type
+            if raw:
+                assert target.getinfo(name).compress_size == source.getinfo(name).compress_size
+            assert target.read(name) == source.read(name)
+    tree = tabfix.load_workbook(output)
+    assert "100" == tabfix.get_item(tree, "Dashboard", "Region").get("id")
+    assert "101" == tabfix.get_item(tree, "Dashboard", "Pie").get("id")
+
+
+def test_batch(tmp_path):
+    source = tmp_path / 'workbooks'
+    (source / 'team').mkdir(parents=True)
+    shutil.copy(os.path.join(FIXTURE_DIR, 'testing.twb'), str(source / 'testing.twb'))
+    shutil.copy(os.path.join(FIXTURE_DIR, 'manifest.yaml'), str(source / 'testing.yaml'))
+    shutil.copy(os.path.join(FIXTURE_DIR, 'testing_2019_4.twb'), str(source / 'team' / 'testing_2019_4.twb'))
+    (source / 'team' / 'broken.twb').write_text('<workbook><dashboards>')
+
+    assert tabfix.find_manifest(str(source / 'testing.twb')) == str(source / 'testing.yaml')
+    assert tabfix.find_manifest(str(source / 'team' / 'broken.twb')) is None
+
+    output = tmp_path / 'output'
+    results = tabfix.batch([str(source)], str(output), workers=2)
+    assert [os.path.basename(result["workbook"]) for result in results] == \
+        ['broken.twb', 'testing_2019_4.twb', 'testing.twb']
+    assert [result["status"] for result in results] == ['error', 'no manifest', 'ok']
+    assert results[2]["warnings"] == tabfix.check_accessibility(os.path.join(FIXTURE_DIR, 'testing.twb'))
+    errors = []
+    tabfix.fix_tabs_in_tree(tabfix.load_workbook(os.path.join(FIXTURE_DIR, 'testing.twb')),
+                            tabfix.load_manifest(os.path.join(FIXTURE_DIR, 'manifest.yaml')), errors)
+    assert errors.__len__() > 0
+    assert results[2]["errors"] == errors
+    assert (output / 'testing.twb').exists()
+    assert not (output / 'team' / 'testing_2019_4.twb').exists()
+
+    report = tabfix.write_batch_report(results, str(tmp_path / 'report.json'))
+    assert (report["errors"], report["missing_manifests"], report["manifest_errors"]) == (1, 1, errors.__len__())
+    assert tabfix.find_workbooks([str(source / '**' / '*.twb')]).__len__() == 3
+
+    report_path = str(tmp_path / 'report.json')
+    assert tabfix.main(['batch', str(source / 'team' / 'testing_2019_4.twb'), '-t', '-j', '1', '-r', report_path]) == 0
+    assert tabfix.main(['batch', str(source), '-o', str(output), '-j', '1', '-r', report_path]) == 1
+
+
+def test_check_rules_selection(xml_fixture):
+    warnings = tabfix.check_accessibility_in_tree(xml_fixture, ['A5', 'B3'])
+    assert [warning["code"] for warning in warnings] == ['A5', 'A5', 'B3', 'B3', 'B3']
+    assert tabfix.check_accessibility_in_tree(xml_fixture, max_warnings=2).__len__() == 2
+    assert tabfix.check_accessibility_in_tree(xml_fixture, max_warnings=2) == \
+        tabfix.check_accessibility_in_tree(xml_fixture)[:2]
+    # Walk order and rule order differ here: A5 and A6 come before A4 in the workbook
+    tree = workbook_generator.generate_workbook(dashboards=3)
+    warnings = tabfix.check_accessibility_in_tree(tree)
+    assert [warning["code"] for warning in tabfix.iter_accessibility_in_tree(tree, max_warnings=2)] != \
+        [warning["code"] for warning in warnings[:2]]
+    for max_warnings in [1, 2, 5]:
+        assert tabfix.check_accessibility_in_tree(tree, max_warnings=max_warnings) == warnings[:max_warnings]
+        assert tabfix.check_dashboards(tree, max_warnings=max_warnings) == warnings[:max_warnings]
+
+
+def test_register_rule(xml_fixture):
+    class ButtonRule(tabfix.Rule):
+        codes = ('X1',)
+        tags = ('button',)
+
+        def start(self, button, context):
+            return [{"code": "X1", "dashboard": context.dashboard, "item": "button", "message": "X1"}]
+
+    tabfix.register_rule(ButtonRule)
+    try:
+        warnings = tabfix.check_accessibility_in_tree(xml_fixture)
+        assert warnings[-1] == {"code": "X1", "dashboard": "Dashboard", "item": "button", "message": "X1"}
+        assert tabfix.check_accessibility_in_tree(xml_fixture, ['X1']).__len__() == 1
+    finally:
+        tabfix.RULES.remove(ButtonRule)
+
+
+def test_fix_tabs_parallel(xml_fixture):
+    configuration = tabfix.load_manifest(os.path.join(FIXTURE_DIR, 'manifest.yaml'))
+    configuration["Missing"] = ["Pie"]
+    expected = copy.deepcopy(xml_fixture)
+    expected_errors = []
+    tabfix.fix_tabs_in_tree(expected, configuration, expected_errors)
+    errors = []
+    tabfix.fix_tabs_in_tree(xml_fixture, configuration, errors, workers=2)
+    assert lxml.etree.tostring(xml_fixture) == lxml.etree.tostring(expected)
+    assert errors == expected_errors
+
+
+def test_check_accessibility_parallel(xml_fixture, tmp_path):
+    cache = tabfix.ResultCache(str(tmp_path))
+    expected = tabfix.check_accessibility_cached(xml_fixture, tabfix.DashboardResults())
+    assert tabfix.check_accessibility_parallel(xml_fixture, workers=2) == expected
+    assert tabfix.check_accessibility_parallel(xml_fixture, workers=2, cache=cache) == expected
+    assert cache.misses == 2
+    assert tabfix.check_accessibility_parallel(xml_fixture, workers=2, cache=cache) == expected
+    assert cache.hits == 2
+
+
+def test_check_accessibility_cached(xml_fixture, tmp_path):
+    cache = tabfix.ResultCache(str(tmp_path / 'cache'))
+    expected = tabfix.check_accessibility_in_tree(xml_fixture)
+    warnings = tabfix.check_accessibility_cached(xml_fixture, cache)
+    assert warnings == expected
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    assert tabfix.check_accessibility_cached(xml_fixture, cache) == warnings
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # Changing a worksheet shown on one dashboard only invalidates that dashboard
+    sheet = xml_fixture.xpath("//worksheet[@name='Sheet 3']")[0]
+    sheet.set('name-changed', 'true')
+    tabfix.check_accessibility_cached(xml_fixture, cache)
+    assert (cache.hits, cache.misses) == (3, 3)
+
+    cache.clear()
+    assert cache.get_entries() == []
+
+
+def test_result_cache_eviction(tmp_path, monkeypatch):
+    cache = tabfix.ResultCache(str(tmp_path / 'cache'), max_size=100)
+    cache.put('a', [{"code": "A4", "message": "x" * 40}])
+    os.utime(cache.get_filename('a'), (0, 0))
+    size = cache.size
+    # Puts keep a running total rather than scanning the folder, and only evict when asked
+    monkeypatch.setattr(cache, 'get_entries', None)
+    cache.put('b', [{"code": "A4", "message": "y" * 40}])
+    cache.put('b', [{"code": "A4", "message": "y" * 40}])
+    assert cache.size == size * 2
+    monkeypatch.undo()
+    cache.evict()
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.size == size
+    cache.put_all([('c', [{"code": "A4", "message": "z" * 40}])])
+    assert cache.get('b') is None
+    assert tabfix.ResultCache(str(tmp_path / 'cache')).get_size() == size
+
+
+def test_profile(xml_fixture_2020):
+    tabfix.profile.reset()
+    tabfix.profile.enabled = True
+    try:
+        tabfix.fix_tabs_in_tree(xml_fixture_2020, {"Dashboard": ["Pie", "Region", "Thing that doesnt exist"]})
+        tabfix.check_accessibility_in_tree(xml_fixture_2020)
+        report = tabfix.profile.report()
+    finally:
+        tabfix.profile.enabled = False
+        tabfix.profile.reset()
+    assert report["timers"]["fix"]["calls"] == 1
+    assert report["timers"]["rule.A5/A6"]["calls"] > 0
+    assert report["counters"]["resolver.get_view.matched"] == 1
+    assert report["counters"]["resolver.get_filter.matched"] == 1
+    assert report["counters"]["resolver.unmatched"] == 1
+    assert report["counters"]["elements.rules"] > 0
+
+
+def test_profile_disabled(xml_fixture_2020):
+    tabfix.check_accessibility_in_tree(xml_fixture_2020)
+    assert tabfix.profile.report() == {"timers": {}, "counters": {}}
+
+
+def test_get_item_with_quotes():
+    tree = lxml.etree.ElementTree(lxml.etree.fromstring(
+        "<workbook><dashboards><dashboard name=\"Bob's Dashboard\"><zones>"
+        "<zone id='1' name='Sales &quot;Q1&quot; in Bob&apos;s region' />"
+        "<zone id='2' type='filter' param=\"[federated].[none:Bob's Field:nk]\" />"
+        "</zones></dashboard></dashboards></workbook>"))
+    for index in [None, tabfix.WorkbookIndex(tree)]:
+        assert "1" == tabfix.get_item(tree, "Bob's Dashboard", 'Sales "Q1" in Bob\'s region', index).get("id")
+        assert "2" == tabfix.get_item(tree, "Bob's Dashboard", "Bob's Field", index).get("id")
+        assert tabfix.get_item(tree, "Bob's Dashboard", "Bob's", index) is None
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = tabfix.create_server(port=0, token='secret', output_dir=str(tmp_path))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_server(server, tmp_path):
+    port = server.server_address[1]
+    path = str(tmp_path / 'testing.twb')
+    shutil.copy(os.path.join(FIXTURE_DIR, 'testing.twb'), path)
+
+    response = tabfix.request_server('check', {"workbook": path}, port, token='secret')
+    assert response["warnings"] == tabfix.check_accessibility(path)
+    response = tabfix.request_server('check', {"workbook": path, "rules": ["A4"]}, port, token='secret')
+    assert response["warnings"].__len__() == 1
+    assert tabfix.request_server('status', port=port, token='secret')["hits"] == 1
+
+    output = str(tmp_path / 'output.twb')
+    response = tabfix.request_server('fix', {"workbook": path, "output": output,
+                                             "manifest": "Dashboard:\n- Region\n- Pie\n- Nothing"}, port, token='secret')
+    assert response["errors"].__len__() == 1
+    assert "101" == tabfix.get_item(tabfix.load_workbook(output), "Dashboard", "Pie").get("id")
+    response = tabfix.request_server('fix', {"workbook": path, "output": output,
+                                             "manifest": {"Dashboard": ["Pie", "Region"]}, "check": True}, port, token='secret')
+    assert response["warnings"] == tabfix.check_accessibility(output)
+    assert "100" == tabfix.get_item(tabfix.load_workbook(output), "Dashboard", "Pie").get("id")
+    # The cached tree is not changed by fixing
+    assert tabfix.request_server('check', {"workbook": path}, port, token='secret')["warnings"] == tabfix.check_accessibility(path)
+    assert tabfix.request_server('status', port=port, token='secret')["misses"] == 1
+
+    assert "error" in tabfix.request_server('check', {"workbook": str(tmp_path / 'missing.twb')}, port, token='secret')
+
+
+def test_server_rejects_unauthorized_requests(server, tmp_path):
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+    port = server.server_address[1]
+    path = str(tmp_path / 'testing.twb')
+    shutil.copy(os.path.join(FIXTURE_DIR, 'testing.twb'), path)
+    request = {"workbook": path, "output": str(tmp_path / 'output.twb'), "manifest": {"Dashboard": ["Pie"]}}
+
+    assert "Token" in tabfix.request_server('fix', request, port)["error"]
+    assert "Token" in tabfix.request_server('status', port=port, token='wrong')["error"]
+
+    # A cross-origin form or text/plain post from a web page is refused even with the token
+    url = 'http://127.0.0.1:' + port.__str__() + '/fix'
+    headers = {'Content-Type': 'text/plain', 'X-Tabfix-Token': 'secret'}
+    with pytest.raises(HTTPError) as e:
+        urlopen(Request(url, data=json.dumps(request).encode('utf-8'), headers=headers))
+    assert e.value.code == 415
+    assert not os.path.exists(request["output"])
+
+    # Fixed workbooks can only be written inside the output folder
+    request["output"] = str(tmp_path.parent / 'outside.twb')
+    assert "not inside" in tabfix.request_server('fix', request, port, token='secret')["error"]
+    assert not os.path.exists(request["output"])
+    request["output"] = 'output.twb'
+    assert tabfix.request_server('fix', request, port, token='secret')["output"] == str(tmp_path / 'output.twb')
+
+
+def test_workbook_cache(tmp_path):
+    paths = []
+    for name in ['a.twb', 'b.twb']:
+        paths.append(str(tmp_path / name))
+        shutil.copy(os.path.join(FIXTURE_DIR, 'testing.twb'), paths[-1])
+    workbooks = tabfix.WorkbookCache(max_size=os.path.getsize(paths[0]) + 1)
+    tree = workbooks.get(paths[0])
+    assert workbooks.get(paths[0]) is tree
+    workbooks.get(paths[1])
+    assert workbooks.status()["workbooks"] == [os.path.abspath(paths[1])]
+    os.utime(paths[1], (0, 0))
+    workbooks.get(paths[1])
+    assert (workbooks.hits, workbooks.misses) == (1, 3)
+
+
+def test_workbook_watcher(tmp_path):
+    path = str(tmp_path / 'testing.twb')
+    shutil.copy(os.path.join(FIXTURE_DIR, 'testing.twb'), path)
+    watcher = tabfix.WorkbookWatcher([str(tmp_path)], debounce=1)
+    assert watcher.poll(now=0) == []
+    changes = watcher.poll(now=1)
+    assert changes.__len__() == 1
+    assert sorted(map(str, changes[0]["new"])) == sorted(map(str, tabfix.check_accessibility(path)))
+    assert changes[0]["changed"] == 2
+    assert watcher.poll(now=2) == []
+
+    tree = tabfix.load_workbook(path)
+    for zone in tree.iter('zone'):
+        if tabfix.is_image_zone(zone):
+            zone.set('alt-text', 'A picture')
+    tree.write(path, encoding='utf-8')
+    os.utime(path, ns=(0, 10 ** 9))
+    assert watcher.poll(now=3) == []
+    changes = watcher.poll(now=4)
+    assert [warning["code"] for warning in changes[0]["resolved"]] == ["A4"]
+    assert changes[0]["new"] == []
+    assert changes[0]["changed"] == 1
+    assert "1 resolved" in tabfix.format_watch_change(changes[0])
+
+    os.remove(path)
+    changes = watcher.poll(now=5)
+    assert changes[0]["status"] == "removed"
+    assert watcher.workbooks == {}
+
+
+def run_tabfix(*arguments):
+    return subprocess.run([sys.executable, os.path.join(FIXTURE_DIR, '..', 'tabfix.py')] + list(arguments),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=FIXTURE_DIR)
+
+
+def get_loaded_modules(arguments=None):
+    # The modules loaded by a fresh Python after importing tabfix and, if given, running main
+    code = 'import sys, tabfix\n'
+    if arguments is not None:
+        code += 'try:\n    tabfix.main(' + repr(arguments) + ')\nexcept SystemExit:\n    pass\n'
+    code += 'print(" ".join(sorted(sys.modules)))'
+    result = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, cwd=FIXTURE_DIR,
+                            env=dict(os.environ, PYTHONPATH=os.path.join(FIXTURE_DIR, '..')))
+    # main prints its own output first, so the modules are on the last line
+    return result.stdout.decode('utf-8').splitlines()[-1].split()
+
+
+def test_import_is_lazy():
+    modules = ['yaml', 'csv', 'numpy', 'sqlite3', 'argparse', 'http.server', 'urllib.request',
+               'concurrent.futures.process']
+    loaded = get_loaded_modules()
+    assert 'tabfix' in loaded
+    assert [module for module in modules if module in loaded] == []
+
+
+def test_help_is_lazy():
+    result = run_tabfix('--help')
+    assert result.returncode == 0
+    assert b'usage' in result.stdout
+    modules = ['yaml', 'csv', 'numpy', 'sqlite3', 'http.server', 'urllib.request', 'concurrent.futures.process']
+    loaded = get_loaded_modules(['--help'])
+    assert 'argparse' in loaded
+    assert [module for module in modules if module in loaded] == []
+
+
+def test_check_only_is_lazy():
+    result = run_tabfix('testing.twb', '-t')
+    assert result.returncode == 0
+    assert b'A4 image' in result.stdout
+    # NumPy is only loaded for the colour checks
+    modules = ['yaml', 'csv', 'sqlite3', 'http.server', 'urllib.request', 'concurrent.futures.process']
+    loaded = get_loaded_modules(['testing.twb', '-t'])
+    assert 'argparse' in loaded
+    assert [module for module in modules if module in loaded] == []
+
+
+def test_main(tmp_path, capsys):
+    report_path = str(tmp_path / 'report.jsonl')
+    tabfix.main([os.path.join(FIXTURE_DIR, 'testing.twb'), '-t', '--report', report_path])
+    assert 'Input workbook' in capsys.readouterr().out
+    with open(report_path) as f:
+        assert [json.loads(line) for line in f] == tabfix.as_dicts(
+            tabfix.check_accessibility(os.path.join(FIXTURE_DIR, 'testing.twb')))
+
+
+def test_main_unknown_rules(capsys):
+    assert tabfix.main([os.path.join(FIXTURE_DIR, 'testing.twb'), '-t', '--rules', 'A4,Z9']) == 2
+    assert capsys.readouterr().out.startswith('Unknown rules: Z9.')
+    result = run_tabfix('testing.twb', '-t', '--rules', 'Z9')
+    assert result.returncode == 2
+
+
+def test_catalog(tmp_path):
+    folder = tmp_path / 'team'
+    folder.mkdir()
+    path = str(folder / 'testing.twb')
+    shutil.copy(os.path.join(FIXTURE_DIR, 'testing.twb'), path)
+    shutil.copy(os.path.join(FIXTURE_DIR, 'manifest.yaml'), str(folder / 'manifest.yaml'))
+    database = str(tmp_path / 'catalog.db')
+    with tabfix.WorkbookCatalog(database) as catalog:
+        assert list(catalog.update([str(tmp_path)]).values()) == [1, 0, 0, 0]
+        assert list(catalog.update([str(tmp_path)]).values()) == [0, 0, 1, 0]
+        assert [(item["dashboard"], item["zone_id"]) for item in catalog.find_items('Parameter 2', 'parameter')] == [
+            ("Dashboard", "101"), ("Other Dashboard", "220")]
+        assert catalog.find_items('1114.jpg') == []
+        configuration = tabfix.load_manifest(str(folder / 'manifest.yaml'))
+        errors = []
+        tabfix.fix_tabs_in_tree(tabfix.load_workbook(path), configuration, errors)
+        assert catalog.validate_manifest(path, configuration) == errors
+        assert catalog.validate_manifests()[path][1] == errors
+        assert catalog.count_warnings('code') == tabfix.count_warnings(sorted(
+            tabfix.check_accessibility(path), key=lambda warning: warning["code"]))
+        assert catalog.count_warnings('folder', 'A6') == {str(folder): 2}
+
+        tabfix.fix_tabs(path, path, configuration)
+        assert list(catalog.update([str(tmp_path)]).values()) == [0, 1, 0, 0]
+        assert catalog.find_items('Parameter 2', 'parameter')[0]["zone_id"] == "104"
+        os.remove(path)
+        assert list(catalog.update([str(tmp_path)]).values()) == [0, 0, 0, 1]
+        assert catalog.validate_manifest(path, configuration) is None
+
+
+def test_catalog_items_resolve(xml_fixture):
+    # Every name in the catalog is one that get_item finds
+    index = tabfix.WorkbookIndex(xml_fixture)
+    items = list(tabfix.iter_addressable_items(index))
+    assert set(kind for dashboard_name, kind, name, zone in items) >= {
+        'view', 'button', 'parameter', 'filter', 'text', 'image'}
+    for dashboard_name, kind, name, zone in items:
+        assert tabfix.get_item(xml_fixture, dashboard_name, name, index) is not None
+
+
+def test_catalog_main(tmp_path, capsys):
+    database = str(tmp_path / 'catalog.db')
+    assert tabfix.main(['catalog', database, FIXTURE_DIR, '--find', 'Pie', '--kind', 'view']) == 0
+    output = capsys.readouterr().out
+    assert "2 added" in output
+    assert "testing_2019_4.twb: view 'Pie' in dashboard 'Other Dashboard'" in output
+    assert tabfix.main(['catalog', database, '--validate', '--count', 'code', '--code', 'a4']) == 1
+    output = capsys.readouterr().out
+    assert "(" + os.path.join(FIXTURE_DIR, 'manifest.yaml') + "): ERROR in manifest" in output
+    assert output.endswith("A4: 2\n")
+
+
+@pytest.mark.parametrize("filename", ['testing.twb', 'testing_2019_4.twb'])
+def test_validate_manifest(filename):
+    tree = tabfix.load_workbook(os.path.join(FIXTURE_DIR, filename))
+    configuration = tabfix.load_manifest(os.path.join(FIXTURE_DIR, 'manifest.yaml'))
+    messages = tabfix.validate_manifest(tree, configuration)
+    errors = []
+    tabfix.fix_tabs_in_tree(copy.deepcopy(tree), configuration, errors)
+    assert [message.split(';')[0] for message in messages if message.startswith("ERROR")] == errors
+    assert "ERROR in manifest: object 'Bar Without Mark Labels' does not exist in dashboard 'Dashboard'; " \
+           "did you mean 'Bar With Mark Labels' (view)?" in messages
+    assert "WARNING in manifest: '1114.jpg' in dashboard 'Dashboard' could be 2 images; " \
+           "tabfix will use the first image" in messages
+    assert tabfix.validate_manifest(tree, {"Dashbord": ["Pie"]}) == [
+        "ERROR in manifest: dashboard 'Dashbord' does not exist; did you mean 'Dashboard'?"]
+
+
+def test_validate_manifest_device_layouts():
+    # Images are only listed once, not again for each phone and tablet layout
+    tree = workbook_generator.generate_workbook(dashboards=2, bitmaps=2, device_layouts=2)
+    configuration = workbook_generator.generate_manifest(dashboards=2, bitmaps=2)
+    assert tabfix.validate_manifest(tree, configuration) == []
+    index = tabfix.WorkbookIndex(tree)
+    images = [item for item in tabfix.iter_addressable_items(index) if item[1] == 'image']
+    assert [(dashboard_name, name) for dashboard_name, kind, name, zone in images] == [
+        ("Dashboard 1", "Images/image1.png"), ("Dashboard 1", "Images/image2.png"),
+        ("Dashboard 2", "Images/image1.png"), ("Dashboard 2", "Images/image2.png")]
+
+
+def test_validate_manifest_clash(xml_fixture_2020):
+    # A parameter and a filter with the same name
+    for column in xml_fixture_2020.iter('column'):
+        if column.get('name') == '[Parameter 1]':
+            column.set('caption', 'Region')
+    messages = tabfix.validate_manifest(xml_fixture_2020, {"Dashboard": ["Region", "Parameter 1", "Pie"]})
+    assert messages == [
+        "WARNING in manifest: 'Region' in dashboard 'Dashboard' could be a parameter or a filter; "
+        "tabfix will use the first parameter",
+        "WARNING in manifest: 'Parameter 1' in dashboard 'Dashboard' is the same object as 'Region'"]
+    zone = tabfix.get_item(xml_fixture_2020, "Dashboard", "Region")
+    assert zone.get('param') == '[Parameters].[Parameter 1]'
+
+
+def test_name_index():
+    index = tabfix.NameIndex(['Sales by Region', 'Profit by Region', 'Region', 'Order Date'])
+    assert index.get_matches('Sales by Regoin') == ['Sales by Region']
+    assert index.get_matches('region')[0] == 'Region'
+    assert index.get_matches('Customer') == []
+
+
+def test_validate_main(capsys):
+    path = os.path.join(FIXTURE_DIR, 'testing.twb')
+    assert tabfix.main(['validate', path]) == 1
+    assert "did you mean 'Bar With Mark Labels' (view)?" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_fix_tabs_device_layouts(workers):
+    tree = workbook_generator.generate_workbook(dashboards=3, device_layouts=2)
+    configuration = workbook_generator.generate_manifest(dashboards=3)
+    assert tabfix.verify_zone_ids(tree) == []
+    dashboard = tree.getroot().find('dashboards/dashboard')
+    only_in_layout = SubElement(dashboard.find('devicelayouts/devicelayout/zones'), 'zone', {'id': '9999'})
+    errors = []
+    tabfix.fix_tabs_in_tree(tree, configuration, errors, workers=workers)
+    assert errors == []
+    assert tabfix.verify_zone_ids(tree) == []
+    desktop = [zone.get("id") for zone in dashboard.find('zones').iter('zone')]
+    layouts = dashboard.findall('devicelayouts/devicelayout')
+    assert layouts.__len__() == 2
+    for layout in layouts:
+        ids = [zone.get("id") for zone in layout.iter('zone') if zone is not only_in_layout]
+        assert ids == desktop
+    assert int(only_in_layout.get("id")) == max(int(zone_id) for zone_id in desktop) + 1
+
+
+def test_verify_zone_ids():
+    tree = workbook_generator.generate_workbook(dashboards=2, device_layouts=1)
+    assert tabfix.verify_zone_ids(tree) == []
+    tree.getroot().findall('dashboards/dashboard')[1].find('zones/zone').set('id', '1')
+    problems = tabfix.verify_zone_ids(tree, ["Dashboard 2"])
+    assert problems[0] == "zone id 1 in dashboard 'Dashboard 2' is also used in dashboard 'Dashboard 1'"
+    layout = tree.getroot().find('dashboards/dashboard/devicelayouts/devicelayout/zones')
+    SubElement(layout, 'zone', {'id': '1'})
+    assert "zone id 1 is used twice in the Phone layout of dashboard 'Dashboard 1'" in tabfix.verify_zone_ids(tree)
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_fix_tabs_unlisted_dashboards(workers):
+    # Dashboards that aren't in the manifest keep their ids, and the others are numbered around them
+    tree = workbook_generator.generate_workbook(dashboards=2, zones=120)
+    unlisted = [zone.get("id") for zone in tree.getroot().findall('dashboards/dashboard')[1].iter('zone')]
+    configuration = workbook_generator.generate_manifest(dashboards=1, zones=120)
+    errors = []
+    tabfix.fix_tabs_in_tree(tree, configuration, errors, workers=workers)
+    assert errors == []
+    assert tabfix.verify_zone_ids(tree) == []
+    dashboards = tree.getroot().findall('dashboards/dashboard')
+    assert [zone.get("id") for zone in dashboards[1].iter('zone')] == unlisted
+    ids = [int(zone.get("id")) for zone in dashboards[0].iter('zone')]
+    assert min(ids) == 100
+    assert max(ids) > max(int(zone_id) for zone_id in unlisted)
+    assert all(zone_id.__str__() not in unlisted for zone_id in ids)
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_fix_tabs_reserved_id_in_block(workers, tmp_path):
+    # An id of a dashboard that isn't in the manifest falls among the ids the named items would get
+    tree = workbook_generator.generate_workbook(dashboards=2)
+    tree.getroot().findall('dashboards/dashboard')[1].find('zones/zone').set('id', '103')
+    path = str(tmp_path / 'reserved.twb')
+    tree.write(path, encoding='utf-8')
+    configuration = {"Dashboard 1": workbook_generator.generate_manifest(dashboards=1)["Dashboard 1"]}
+    output = str(tmp_path / 'output.twb')
+    fixed = tabfix.fix_tabs(path, output, configuration, workers=workers)
+    assert tabfix.verify_fix(path, output, configuration) == []
+    ids = [int(tabfix.get_item(fixed, "Dashboard 1", item).get("id")) for item in configuration["Dashboard 1"]]
+    assert ids == list(range(104, 104 + ids.__len__()))
+    assert tabfix.verify_zone_ids(fixed) == []
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_verify_fix_device_layouts(workers, tmp_path):
+    path = str(tmp_path / 'synthetic.twb')
+    workbook_generator.write_workbook(path, dashboards=3, device_layouts=2)
+    configuration = workbook_generator.generate_manifest(dashboards=3)
+    output = str(tmp_path / 'output.twb')
+    tree = tabfix.fix_tabs(path, output, configuration, workers=workers)
+    assert tabfix.verify_fix(path, output, configuration) == []
+
+    # Earlier versions removed device layouts, which is still a valid fix
+    for layouts in list(tree.iter('devicelayouts')):
+        layouts.getparent().remove(layouts)
+    tree.write(output, encoding='utf-8')
+    assert tabfix.verify_fix(path, output, configuration) == []
+    dashboard = tree.getroot().find('dashboards/dashboard')
+    SubElement(dashboard, 'devicelayouts')
+    tree.write(output, encoding='utf-8')
+    assert tabfix.verify_fix(path, output, configuration)[0].endswith(" is <devicelayouts> at line 1 in the output")
+
+
+def test_check_dashboards_order(tmp_path):
+    # Views shown on several dashboards, and more than once on a dashboard, are reported in
+    # the same order whether the dashboards are checked together or one at a time
+    tree = workbook_generator.generate_workbook(dashboards=5, worksheets=3, zones=6)
+    expected = tabfix.check_accessibility_in_tree(tree)
+    assert {"B1", "B3"} <= set(warning["code"] for warning in expected)
+    assert tabfix.check_dashboards(tree) == expected
+    cache = tabfix.ResultCache(str(tmp_path))
+    assert tabfix.check_accessibility_cached(tree, cache) == expected
+    assert tabfix.check_accessibility_cached(tree, cache) == expected
+    assert cache.hits == 5
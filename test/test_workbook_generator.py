@@ -0,0 +1,44 @@
+# SPDX-License-Identifier: MIT
+import tabfix
+from benchmarks import workbook_generator
+import pytest
+import os
+
+
+@pytest.mark.parametrize("style", workbook_generator.STYLES)
+def test_generate_workbook(style):
+    tree = workbook_generator.generate_workbook(dashboards=3, device_layouts=2, style=style)
+    assert tree.xpath("count(//dashboard)") == 3
+    assert tree.xpath("count(//devicelayout)") == 6
+    codes = set(warning["code"] for warning in tabfix.check_accessibility_in_tree(tree))
+    assert codes == {"A4", "A5", "A6", "B1", "B3"}
+
+
+def test_generate_actions():
+    tree = workbook_generator.generate_workbook(dashboards=3, actions=2)
+    index = tabfix.index_actions(tree)
+    assert index.actions.__len__() == 6
+    assert [action["kind"] for action in index.get_actions("Dashboard 2", "Sheet 2")] == ["filter"]
+    assert index.get_targets(index.actions[0]).__len__() == 4
+    # Every generated dashboard has an introduction that can explain its actions
+    assert tabfix.check_interactions(tree) == []
+
+
+@pytest.mark.parametrize("style", workbook_generator.STYLES)
+def test_generate_manifest(style):
+    tree = workbook_generator.generate_workbook(dashboards=3, style=style)
+    configuration = workbook_generator.generate_manifest(dashboards=3)
+    index = tabfix.WorkbookIndex(tree)
+    for dashboard_name in configuration:
+        for item in configuration[dashboard_name]:
+            assert tabfix.get_item(tree, dashboard_name, item, index) is not None
+
+
+def test_write_workbook(tmp_path):
+    path = str(tmp_path / 'synthetic.twb')
+    workbook_generator.write_workbook(path, dashboards=2)
+    assert os.path.getsize(path) > 0
+    configuration = workbook_generator.generate_manifest(dashboards=2)
+    tree = tabfix.fix_tabs(path, str(tmp_path / 'output.twb'), configuration)
+    first = configuration["Dashboard 1"][0]
+    assert "100" == tabfix.get_item(tree, "Dashboard 1", first).get("id")